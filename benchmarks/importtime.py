@@ -0,0 +1,107 @@
+"""\
+Measure the startup cost of culexx in fresh interpreters.
+
+Every target is run ``--runs`` times in a new process and the best and
+median wall times are reported, minus the time of an empty interpreter.
+With ``--check`` it instead verifies that the modules of optional
+features stay off the import path, and exits with 1 if one doesn't.
+
+    $ python benchmarks/importtime.py --runs 20
+    $ python benchmarks/importtime.py --check
+"""
+from __future__ import print_function
+
+import argparse
+import ast
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TARGETS = [
+    ("import culexx.config", "import culexx.config"),
+    ("Config()", "from culexx.config import Config; Config()"),
+    ("Config().parser()", "from culexx.config import Config; Config().parser()"),
+    ("import culexx.mosqtt", "import culexx.mosqtt"),
+    ("import culexx.base", "import culexx.base"),
+    ("culexx --version", "import sys; sys.argv = ['culexx', '--version']; "
+            "from culexx.base import run; run()"),
+]
+
+# modules that are only imported once their feature is used
+FEATURES = ["paho", "culexx.cache", "culexx.consumer", "culexx.rpc",
+        "culexx.stream", "culexx.tracing", "socket", "ctypes"]
+
+LAZY = [
+    ("import culexx.mosqtt", FEATURES + ["culexx.metrics", "culexx.ring",
+        "culexx.topics"]),
+    ("culexx --version", FEATURES),
+]
+
+PROBE = """\
+import sys
+try:
+    %s
+except SystemExit:
+    pass
+sys.stderr.write("\\n%%r\\n" %% [m for m in %r if sys.modules.get(m)])
+"""
+
+
+def env():
+    return dict(os.environ, PYTHONPATH=ROOT, PYTHONDONTWRITEBYTECODE="")
+
+
+def loaded(code, modules):
+    proc = subprocess.Popen([sys.executable, "-c", PROBE % (code, modules)],
+            env=env(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, err = proc.communicate()
+    return ast.literal_eval(err.decode("utf-8").strip().splitlines()[-1])
+
+
+def check():
+    code = dict(TARGETS)
+    failed = False
+    for name, modules in LAZY:
+        found = loaded(code[name], modules)
+        print("%-24s %s" % (name, "imports " + ", ".join(found) if found
+                else "ok"))
+        failed = failed or bool(found)
+    return 1 if failed else 0
+
+
+def timeit(code, runs):
+    samples = []
+    with open(os.devnull, "w") as devnull:
+        for i in range(runs):
+            start = time.time()
+            subprocess.call([sys.executable, "-c", code], env=env(),
+                    stdout=devnull, stderr=devnull)
+            samples.append(time.time() - start)
+    samples.sort()
+    return samples[0], samples[len(samples) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--runs", type=int, default=10)
+    parser.add_argument("--check", action="store_true",
+            help="check that optional modules are imported lazily")
+    args = parser.parse_args()
+    if args.check:
+        return check()
+
+    base_best, base_median = timeit("pass", args.runs)
+    print("%-24s %10s %10s" % ("target", "best ms", "median ms"))
+    print("%-24s %10.1f %10.1f" % ("(interpreter)", base_best * 1000,
+            base_median * 1000))
+    for name, code in TARGETS:
+        best, median = timeit(code, args.runs)
+        print("%-24s %10.1f %10.1f" % (name, (best - base_best) * 1000,
+                (median - base_median) * 1000))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
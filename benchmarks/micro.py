@@ -0,0 +1,325 @@
+"""\
+Micro-benchmarks of the publish and dispatch hot paths and of config loading.
+
+Every case is calibrated to run for at least ``--min-time`` seconds per
+repeat and the best and median rates over ``--repeat`` runs are reported.
+Inputs come from a seeded random generator so runs are comparable. Where
+tracemalloc is available the bytes still allocated per op after a run and
+the peak bytes of a run are reported too. Without it (Python 2) the objects
+tracked by the collector that are still alive per op are reported instead.
+
+The paho client is replaced by one that drops every publish, so the
+publish cases time culexx's own work and not the network.
+
+    $ python benchmarks/micro.py --json before.json
+    $ python benchmarks/micro.py --compare before.json
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import timeit
+
+try:
+    import tracemalloc
+except ImportError: # python 2
+    tracemalloc = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from culexx import util
+from culexx.base import Base
+from culexx.config import Config
+from culexx.mosqtt import Mosqtt, mosquitto
+
+TOPIC = "/sensors/temp"
+
+CONFIG_FILE = """\
+workers = 4
+loglevel = "warning"
+timeout = 30
+flight_recorder_size = 1024
+"""
+
+
+class NullClient(object):
+    """\
+    Stands in for the paho client, accepting every publish.
+    """
+
+    def __init__(self):
+        self.mid = 0
+
+    def loop(self, timeout=1.0):
+        return mosquitto.MQTT_ERR_SUCCESS
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.mid += 1
+        return mosquitto.MQTT_ERR_SUCCESS, self.mid
+
+
+class Message(object):
+
+    def __init__(self, topic, payload, qos=0):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = False
+        self.mid = 0
+
+
+class BenchClient(Mosqtt):
+
+    class Meta(object):
+        signal_handlers = {
+            'on_message': ('handle_message',),
+        }
+        topic_handlers = {
+            TOPIC: 'handle_temp',
+        }
+
+    def handle_message(self, *args, **kwargs):
+        msg = kwargs["msg"]
+        self.topic_mapper.handle_topic(msg.topic, msg.payload)
+
+    def handle_temp(self, payload):
+        return len(payload)
+
+
+def make_client(recorder=True, metrics=False, tracing=False):
+    cls = type("BenchClient", (BenchClient,), {
+        "RECORDER_SIZE": recorder and Mosqtt.RECORDER_SIZE or 0,
+        "COLLECT_METRICS": metrics,
+        "TRACE_SAMPLE_RATE": tracing and 1.0 or 0,
+    })
+    client = cls(prefix="bench", name="000")
+    client._mqtt_client = NullClient()
+    return client
+
+
+def payloads(rng, count=64, size=64):
+    return [bytes(bytearray(rng.getrandbits(8) for _ in range(size)))
+            for _ in range(count)]
+
+
+def bench_publish(rng, qos=1, **kwargs):
+    client = make_client(**kwargs)
+    data = payloads(rng)
+    state = {"i": 0}
+
+    def op():
+        i = state["i"] = (state["i"] + 1) % len(data)
+        client.publish(TOPIC, data[i], qos)
+    return op
+
+
+def bench_normalize_topic(rng):
+    client = make_client()
+    topics = ["/sensors/%d/temp" % rng.randint(0, 1000) for _ in range(64)]
+    state = {"i": 0}
+
+    def op():
+        i = state["i"] = (state["i"] + 1) % len(topics)
+        client.normalize_topic(topics[i])
+    return op
+
+
+def bench_handle_topic(rng):
+    client = make_client()
+    topic = client.normalize_topic(TOPIC)
+    payload = payloads(rng, 1)[0]
+    mapper = client.topic_mapper
+    return lambda: mapper.handle_topic(topic, payload)
+
+
+def bench_dispatch(rng, **kwargs):
+    client = make_client(**kwargs)
+    msg = Message(client.normalize_topic(TOPIC), payloads(rng, 1)[0])
+    dispatch = client.signal_mapper.dispatch
+    return lambda: dispatch(None, None, msg)
+
+
+def bench_config(rng):
+    return Config
+
+
+def bench_config_parse(rng):
+    args = ["--workers", "4", "--log-level", "warning", "app:Client"]
+    return lambda: Config().parser().parse_args(args)
+
+
+def bench_config_file(rng, cached=False):
+    fd, path = tempfile.mkstemp(suffix=".py", prefix="culexx-bench-")
+    with os.fdopen(fd, "w") as f:
+        f.write(CONFIG_FILE)
+    base = Base.__new__(Base)
+    base.cfg = Config()
+
+    def op():
+        if not cached:
+            Base.CONFIG_CACHE.clear()
+            util._compiled_files.clear()
+        base.load_config_from_file(path)
+    op.cleanup = lambda: os.unlink(path)
+    return op
+
+
+CASES = [
+    ("publish qos0", bench_publish, {"qos": 0}),
+    ("publish qos1", bench_publish, {}),
+    ("publish qos1, metrics", bench_publish, {"metrics": True}),
+    ("publish qos1, tracing", bench_publish, {"tracing": True}),
+    ("normalize_topic", bench_normalize_topic, {}),
+    ("handle_topic", bench_handle_topic, {}),
+    ("dispatch", bench_dispatch, {}),
+    ("dispatch, no recorder", bench_dispatch, {"recorder": False}),
+    ("dispatch, metrics", bench_dispatch, {"metrics": True}),
+    ("Config()", bench_config, {}),
+    ("Config().parser().parse_args()", bench_config_parse, {}),
+    ("load config file", bench_config_file, {}),
+    ("load config file, cached", bench_config_file, {"cached": True}),
+]
+
+
+def run_ops(op, n):
+    start = timeit.default_timer()
+    for _ in range(n):
+        op()
+    return timeit.default_timer() - start
+
+
+def calibrate(op, min_time):
+    n = 1
+    while True:
+        elapsed = run_ops(op, n)
+        if elapsed >= min_time:
+            return n
+        if elapsed < min_time / 10:
+            n *= 10
+        else:
+            n = int(n * min_time / elapsed * 1.1) + 1
+
+
+def allocations(op, n):
+    """\
+    Return the bytes still allocated per op after ``n`` ops and the peak
+    bytes, or without tracemalloc the objects still alive per op and None.
+    """
+    if tracemalloc is None:
+        # the collector is disabled while measuring, what it tracks after
+        # the ops and a collection was kept by them
+        gc.collect()
+        start = len(gc.get_objects())
+        for _ in range(n):
+            op()
+        gc.collect()
+        return float(len(gc.get_objects()) - start) / n, None
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        for _ in range(n):
+            op()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return float(current - start) / n, peak - start
+
+
+def measure(name, func, kwargs, args):
+    random.seed(args.seed)
+    op = func(random.Random(args.seed), **kwargs)
+    gc.collect()
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        n = calibrate(op, args.min_time)
+        rates = sorted(n / run_ops(op, n) for _ in range(args.repeat))
+        retained, peak = allocations(op, min(n, 10000))
+    finally:
+        if enabled:
+            gc.enable()
+        if hasattr(op, "cleanup"):
+            op.cleanup()
+    result = {
+        "ops": n,
+        "best": rates[-1],
+        "median": rates[len(rates) // 2],
+        "rates": rates,
+        "retained_bytes_per_op": retained,
+        "peak_bytes": peak,
+    }
+    if tracemalloc is None:
+        result["retained_bytes_per_op"] = None
+        result["retained_objects_per_op"] = retained
+    return result
+
+
+def revision():
+    try:
+        with open(os.devnull, "w") as devnull:
+            out = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                    cwd=ROOT, stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode("ascii").strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("-t", "--min-time", type=float, default=0.2,
+            help="seconds each repeat runs for at least")
+    parser.add_argument("-s", "--seed", type=int, default=1)
+    parser.add_argument("-k", "--filter",
+            help="only run the cases whose name contains this")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare",
+            help="show the change from the results in this file")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    print("%-34s %12s %12s %10s %10s" % ("case", "best op/s", "median op/s",
+        "B/op kept" if tracemalloc else "obj/op kept", "change"))
+    for name, func, kwargs in CASES:
+        if args.filter and args.filter not in name:
+            continue
+        result = results[name] = measure(name, func, kwargs, args)
+        retained = result.get("retained_bytes_per_op")
+        if tracemalloc is None:
+            retained = result["retained_objects_per_op"]
+        change = ""
+        if name in baseline:
+            change = "%+.1f%%" % ((result["median"] /
+                baseline[name]["median"] - 1) * 100)
+        print("%-34s %12.0f %12.0f %10s %10s" % (name, result["best"],
+            result["median"], "-" if retained is None else "%.1f" % retained,
+            change))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "revision": revision(),
+                "python": platform.python_version(),
+                "implementation": platform.python_implementation(),
+                "machine": platform.machine(),
+                "seed": args.seed,
+                "repeat": args.repeat,
+                "results": results,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
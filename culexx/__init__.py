@@ -0,0 +1,2 @@
+version_info = (0, 1, 0)
+__version__ = ".".join([str(v) for v in version_info])
@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -
+#
+# This file is part of culexx released under the MIT license.
+# See the NOTICE for more information.
+
+import errno
+import heapq
+import mmap
+import os
+import struct
+import threading
+import time
+
+try:
+    import queue
+except ImportError: # python 2
+    import Queue as queue
+
+from .logging import default_logger as log
+from .topics import topic_matches, validate_filter
+from .traffic import SUFFIX, TrafficRecorder, segment_paths
+
+INDEX_SUFFIX = ".idx"
+
+
+class IndexedSegmentWriter(TrafficRecorder):
+    """\
+    Writes traffic segments along with a sparse index: every
+    ``index_interval`` bytes of records get an entry in ``<segment>.idx``
+    holding their offsets, the earliest and latest receive time and the
+    topics they contain.
+    """
+
+    # start, end, earliest, latest, number of topics
+    ENTRY = struct.Struct(">QQddH")
+
+    def __init__(self, directory, name=None, segment_size=64 * 1024 * 1024,
+            index_interval=64 * 1024):
+        TrafficRecorder.__init__(self, directory, name, segment_size)
+        self.index_interval = index_interval
+        self.index = None
+        self.path = None
+        self.block_start = 0
+        self.block_topics = set()
+        self.block_min = self.block_max = None
+
+    def open_segment(self):
+        self.end_block()
+        if self.index is not None:
+            self.index.close()
+        TrafficRecorder.open_segment(self)
+        self.path = self.file.name
+        self.index = open(self.path + INDEX_SUFFIX, "wb")
+        self.block_start = self.written
+
+    def write(self, received, topic, payload, qos=0, retain=False):
+        TrafficRecorder.write(self, received, topic, payload, qos, retain)
+        self.block_topics.add(topic)
+        if self.block_min is None or received < self.block_min:
+            self.block_min = received
+        if self.block_max is None or received > self.block_max:
+            self.block_max = received
+        if self.written - self.block_start >= self.index_interval:
+            self.end_block()
+
+    def end_block(self):
+        if not self.block_topics:
+            return
+        parts = [self.ENTRY.pack(self.block_start, self.written,
+            self.block_min, self.block_max, len(self.block_topics))]
+        for topic in self.block_topics:
+            if not isinstance(topic, bytes):
+                topic = topic.encode("utf-8")
+            parts.append(struct.pack(">H", len(topic)) + topic)
+        # the records must be on disk before an entry points at them
+        self.file.flush()
+        self.index.write(b"".join(parts))
+        self.block_start = self.written
+        self.block_topics = set()
+        self.block_min = self.block_max = None
+
+    def flush(self):
+        TrafficRecorder.flush(self)
+        if self.index is not None:
+            self.index.flush()
+
+    def close(self):
+        self.end_block()
+        TrafficRecorder.close(self)
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+
+def read_index(path):
+    """\
+    Return (start, end, earliest, latest, topics) for every complete entry
+    of the index at ``path``.
+    """
+    entry = IndexedSegmentWriter.ENTRY
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+
+    entries = []
+    offset = 0
+    while offset + entry.size <= len(data):
+        start, end, earliest, latest, count = \
+                entry.unpack_from(data, offset)
+        offset += entry.size
+        topics = []
+        for _ in range(count):
+            if offset + 2 > len(data):
+                return entries
+            length = struct.unpack_from(">H", data, offset)[0]
+            topic = data[offset + 2:offset + 2 + length]
+            if len(topic) != length:
+                return entries
+            topics.append(topic.decode("utf-8"))
+            offset += 2 + length
+        entries.append((start, end, earliest, latest, topics))
+    return entries
+
+
+def scan(buf, start, end):
+    """\
+    Yield (offset, receive time, topic, payload, qos, retain) for the
+    records of ``buf`` between ``start`` and ``end``.
+    """
+    record = TrafficRecorder.RECORD
+    offset = start
+    while offset + record.size <= end:
+        received, topic_len, payload_len, flags = \
+                record.unpack_from(buf, offset)
+        topic_at = offset + record.size
+        payload_at = topic_at + topic_len
+        next_offset = payload_at + payload_len
+        if next_offset > end:
+            return
+        yield (offset, received, buf[topic_at:payload_at].decode("utf-8"),
+                buf[payload_at:next_offset], flags & 3, bool(flags & 4))
+        offset = next_offset
+
+
+class Archive(object):
+    """\
+    An append-only store of messages that can be read back by topic
+    filter and time range.
+
+    Messages handed to ``append`` are queued and written in batches by a
+    background thread, so callers on the network thread only pay for the
+    queue. When the queue is full messages are dropped and counted in
+    ``dropped``, those that fail to be written in ``failed``. Records go
+    to traffic segments of about ``segment_size`` bytes with a sparse
+    index (see ``IndexedSegmentWriter``). Reads map the segments and only
+    scan the index blocks whose time range and topics can match, plus the
+    part of the segment being written that isn't indexed yet.
+
+    Segments are removed oldest first once the archive holds more than
+    ``retention_bytes``, or once they're older than ``retention_age``
+    seconds. 0 keeps them.
+    """
+
+    def __init__(self, directory, name=None, segment_size=64 * 1024 * 1024,
+            index_interval=64 * 1024, retention_bytes=0, retention_age=0,
+            flush_interval=1.0, batch_size=1024, queue_size=65536):
+        self.directory = directory
+        self.name = name or "archive-%s" % os.getpid()
+        self.segment_size = segment_size
+        self.index_interval = index_interval
+        self.retention_bytes = retention_bytes
+        self.retention_age = retention_age
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue = queue.Queue(queue_size)
+        self.writer = None
+        self.thread = None
+        self.last_retention = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self):
+        self.writer = IndexedSegmentWriter(self.directory, self.name,
+                self.segment_size, self.index_interval)
+        self.thread = threading.Thread(target=self.run,
+                name="culexx-archive")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def append(self, topic, payload, timestamp=None, qos=0, retain=False):
+        """\
+        Queue a message for writing. Returns False if the queue is full
+        and it was dropped.
+        """
+        try:
+            self.queue.put_nowait((timestamp or time.time(), topic, payload,
+                qos, retain))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def record(self, msg, received=None):
+        self.append(msg.topic, msg.payload, received, msg.qos, msg.retain)
+
+    def flush(self):
+        """\
+        Wait until the queued messages are written and readable.
+        """
+        self.queue.join()
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.writer.close()
+
+    def run(self):
+        writer = self.writer
+        last_flush = time.time()
+        stopping = False
+        while not stopping:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            segment = writer.segment
+            failed = 0
+            for item in batch:
+                if item is None:
+                    stopping = True
+                    continue
+                try:
+                    writer.write(*item)
+                except Exception:
+                    # e.g. a full disk, keep draining the queue
+                    if not failed:
+                        log.exception("Failed to archive a message on %s",
+                                item[1])
+                    failed += 1
+            self.failed += failed
+
+            now = time.time()
+            try:
+                if stopping or self.queue.empty() or \
+                        now - last_flush >= self.flush_interval:
+                    last_flush = now
+                    writer.end_block()
+                    writer.flush()
+                if writer.segment != segment or \
+                        now - self.last_retention >= 60:
+                    self.enforce_retention(now)
+            except Exception:
+                log.exception("Failed to flush the archive")
+            for _ in batch:
+                self.queue.task_done()
+
+    def segments(self):
+        return segment_paths([self.directory])
+
+    def enforce_retention(self, now=None):
+        """\
+        Remove the oldest segments beyond the size and age limits. The
+        workers share the directory: the latest segment of every writer
+        may still be open and is kept, it only counts towards the size.
+        """
+        now = now or time.time()
+        self.last_retention = now
+        if not self.retention_bytes and not self.retention_age:
+            return []
+
+        # segment names sort by writer, then by number
+        paths = self.segments()
+        latest = {}
+        for path in paths:
+            writer = os.path.basename(path)[:-len(SUFFIX)].rpartition("-")[0]
+            latest[writer] = path
+        active = set(latest.values())
+        segments = []
+        total = 0
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            segments.append((st.st_mtime, path, st.st_size))
+            total += st.st_size
+        segments.sort()
+
+        removed = []
+        for mtime, path, size in segments:
+            if path in active:
+                continue
+            too_big = self.retention_bytes and total > self.retention_bytes
+            too_old = self.retention_age and \
+                    mtime < now - self.retention_age
+            if not too_big and not too_old:
+                break
+            for p in (path, path + INDEX_SUFFIX):
+                try:
+                    os.unlink(p)
+                except OSError:
+                    pass
+            total -= size
+            removed.append(path)
+        return removed
+
+    def read(self, topic_filter="#", t0=None, t1=None):
+        """\
+        Yield (receive time, topic, payload, qos, retain) for the archived
+        messages matching ``topic_filter`` received between ``t0`` and
+        ``t1``, in receive order.
+        """
+        validate_filter(topic_filter)
+        matches = {}
+
+        def wanted(topic):
+            m = matches.get(topic)
+            if m is None:
+                m = matches[topic] = topic_matches(topic_filter, topic)
+            return m
+
+        writers = {}
+        for path in self.segments():
+            name = os.path.basename(path).rsplit("-", 1)[0]
+            writers.setdefault(name, []).append(path)
+
+        def chain(paths):
+            for path in sorted(paths):
+                for rec in self.read_segment(path, wanted, t0, t1):
+                    yield rec
+
+        streams = [chain(p) for p in writers.values()]
+        if len(streams) == 1:
+            return streams[0]
+        return heapq.merge(*streams)
+
+    def read_segment(self, path, wanted, t0=None, t1=None):
+        entries = read_index(path + INDEX_SUFFIX)
+        if entries and (t1 is not None and min(e[2] for e in entries) > t1):
+            return
+        try:
+            f = open(path, "rb")
+        except IOError as e:
+            # removed by retention
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= len(TrafficRecorder.MAGIC):
+                return
+            buf = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                ranges = []
+                covered = len(TrafficRecorder.MAGIC)
+                for start, end, earliest, latest, topics in entries:
+                    if end > size:
+                        break
+                    covered = end
+                    if t0 is not None and latest < t0:
+                        continue
+                    if t1 is not None and earliest > t1:
+                        continue
+                    if not any(wanted(t) for t in topics):
+                        continue
+                    ranges.append((start, end))
+                # the records written since the last index entry
+                ranges.append((covered, size))
+
+                for start, end in ranges:
+                    for _, received, topic, payload, qos, retain in \
+                            scan(buf, start, end):
+                        if t0 is not None and received < t0:
+                            continue
+                        if t1 is not None and received > t1:
+                            continue
+                        if wanted(topic):
+                            yield received, topic, payload, qos, retain
+            finally:
+                buf.close()
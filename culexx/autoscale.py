@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -
+#
+# This file is part of culexx released under the MIT license.
+# See the NOTICE for more information.
+
+import math
+import time
+
+
+class Autoscaler(object):
+    """\
+    Decides how many workers the arbiter should run from the dispatch
+    backlog and handler latency the workers report.
+
+    Workers are added when the backlog per worker or the average handler
+    latency is too high, and retired one at a time only once the backlog
+    would stay low with one worker less. Separate cool-down windows keep
+    the count from flapping.
+    """
+
+    def __init__(self, min_workers, max_workers, up_backlog=100,
+            down_backlog=10, max_latency=0.5, up_cooldown=10,
+            down_cooldown=60):
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.up_backlog = max(1, up_backlog)
+        self.down_backlog = down_backlog
+        self.max_latency = max_latency
+        self.up_cooldown = up_cooldown
+        self.down_cooldown = down_cooldown
+        self.last_up = 0
+        self.last_change = time.time()
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(cfg.min_workers, cfg.max_workers,
+                up_backlog=cfg.scale_up_backlog,
+                down_backlog=cfg.scale_down_backlog,
+                max_latency=cfg.scale_latency,
+                up_cooldown=cfg.scale_up_cooldown,
+                down_cooldown=cfg.scale_down_cooldown)
+
+    def clamp(self, count):
+        return min(self.max_workers, max(self.min_workers, count))
+
+    def target(self, current, statuses, now=None):
+        """\
+        Return the number of workers to run.
+
+        ``current`` is the number of active workers and ``statuses`` the
+        status dicts of those already subscribed.
+        """
+        now = now or time.time()
+
+        if current != self.clamp(current):
+            self.last_change = now
+            return self.clamp(current)
+
+        if not statuses:
+            return current
+
+        backlog = sum(s["backlog"] for s in statuses)
+        latency = sum(s["latency"] for s in statuses) / len(statuses)
+
+        overloaded = backlog > self.up_backlog * current or \
+                (self.max_latency and latency > self.max_latency)
+        if overloaded:
+            if current >= self.max_workers:
+                return current
+            if now - self.last_up < self.up_cooldown:
+                return current
+            wanted = int(math.ceil(backlog / float(self.up_backlog)))
+            self.last_up = self.last_change = now
+            return self.clamp(max(current + 1, wanted))
+
+        if current <= self.min_workers:
+            return current
+        if now - self.last_change < self.down_cooldown:
+            return current
+        if backlog >= self.down_backlog * (current - 1):
+            return current
+        if self.max_latency and latency >= self.max_latency / 2.0:
+            return current
+
+        self.last_change = now
+        return current - 1
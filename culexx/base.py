@@ -1,20 +1,44 @@
+import errno
+import gc
 import os
+import random
+import select
+import signal
 import sys
+import time
 from . import util
-from .arbiter import Arbiter
-from .config import Config, get_default_config_file
+from .autoscale import Autoscaler
+from .config import Config, changed_settings, get_default_config_file
+from .errors import AppImportError, HaltServer
+from .metrics import MetricsBuffer, MetricsServer, empty_snapshot, \
+        merge_snapshots, render
+from .reloader import watcher_for
+from .ring import HashRing, RingBuffer
+from .worker import Worker, WorkerStatus
 import traceback
 
 class Base(object):
 
+    WORKER_BOOT_ERROR = 3
+
+    APP_LOAD_ERROR = 4
+
     START_CTX = {}
 
+    WORKERS = {}
+
+    # config file name -> (stamp, validated settings, namespace)
+    CONFIG_CACHE = {}
+
+    # topic (or key) to ring slot lookups remembered by the fanout
+    SLOT_CACHE_SIZE = 65536
+
     PIPE = []
 
     SIG_QUEUE = []
 
     SIGNALS = [getattr(signal, "SIG%s" % x) \
-            for x in "HUP QUIT INT TERM".split()]
+            for x in "HUP QUIT INT TERM USR1 USR2 TTIN".split()]
 
     SIG_NAMES = dict(
         (getattr(signal, name), name[3:].lower()) for name in dir(signal)
@@ -26,6 +50,7 @@ class Base(object):
         self.cfg = None
         self.prog = prog
         self.logger = None
+        self.callable = None
         self.do_load_config()
 
     def init(self, parser, opts, args):
@@ -48,6 +73,15 @@ class Base(object):
         if not os.path.exists(filename):
             raise RuntimeError("%r doesn't exist" % filename)
 
+        # an unchanged file gives the same settings, skip compiling,
+        # running and validating it again
+        stamp = util.file_stamp(filename)
+        cached = self.CONFIG_CACHE.get(filename)
+        if cached is not None and cached[0] == stamp:
+            for k, v in cached[1].items():
+                self.cfg.settings[k].set_validated(v)
+            return cached[2]
+
         cfg = {
             "__builtins__": __builtins__,
             "__name__": "__config__",
@@ -56,12 +90,13 @@ class Base(object):
             "__package__": None
         }
         try:
-            execfile(filename, cfg, cfg)
+            self.exec_config_file(filename, stamp, cfg)
         except Exception:
             print("Failed to read config file: %s" % filename)
             traceback.print_exc()
             sys.exit(1)
 
+        values = {}
         for k, v in cfg.items():
             # Ignore unknown names
             if k not in self.cfg.settings:
@@ -71,9 +106,48 @@ class Base(object):
             except:
                 sys.stderr.write("Invalid value for %s: %s\n\n" % (k, v))
                 raise
+            values[k] = self.cfg.settings[k].get()
 
+        self.CONFIG_CACHE[filename] = (stamp, values, cfg)
         return cfg
 
+    def exec_config_file(self, filename, stamp, namespace):
+        code = util.compile_file(filename, stamp,
+                cache=self.cfg.config_cache)
+        exec(code, namespace, namespace)
+
+    def reread_config(self):
+        """\
+        Load the config file again into a new configuration. Returns the
+        names of the settings that changed and can be applied live, and of
+        those that need a restart. The latter keep their current value.
+        """
+        old = self.cfg
+        self.cfg = Config(self.usage, prog=self.prog)
+        try:
+            if self.config_file is not None:
+                self.load_config_from_file(self.config_file)
+            self.apply_cli_args(self.cli_args)
+        except BaseException:
+            self.cfg = old
+            raise
+
+        changed = changed_settings(old, self.cfg)
+        restart = [n for n in changed if not self.cfg.settings[n].live]
+        for name in restart:
+            self.cfg.settings[name].set_validated(old.settings[name].get())
+        return [n for n in changed if n not in restart], restart
+
+    def apply_cli_args(self, args):
+        # Lastly, update the configuration with any command line
+        # settings.
+        for key, val in args.__dict__.items():
+            if val is None:
+                continue
+            if key == "args":
+                continue
+            self.cfg.set(key.lower(), val)
+
     def load_config(self):
         # init configuration
         self.cfg = Config(self.usage, prog=self.prog)
@@ -86,21 +160,16 @@ class Base(object):
         # optional settings from apps
         cfg = self.init(parser, args, args.args)
 
-        if args.config:
-            self.load_config_from_file(args.config)
-        else:
-            default_config = get_default_config_file()
-            if default_config is not None:
-                self.load_config_from_file(default_config)
+        # needed before the config file is read
+        if args.config_cache:
+            self.cfg.set("config_cache", True)
 
-        # Lastly, update the configuration with any command line
-        # settings.
-        for key, val in args.__dict__.items():
-            if val is None:
-                continue
-            if key == "args":
-                continue
-            self.cfg.set(key.lower(), val)
+        self.config_file = args.config or get_default_config_file()
+        if self.config_file is not None:
+            self.load_config_from_file(self.config_file)
+
+        self.cli_args = args
+        self.apply_cli_args(args)
 
     def load_mosqapp(self):
         self.chdir()
@@ -110,7 +179,34 @@ class Base(object):
 
     @property
     def mosq_app(self):
-        return self.load_mosqapp()
+        if self.callable is None:
+            self.callable = self.load_mosqapp()
+        return self.callable
+
+    def preload(self):
+        """\
+        Import the application once in the master so workers share its
+        code and data through copy-on-write pages instead of importing it
+        themselves.
+        """
+        start = time.time()
+
+        # keep the collector from leaving freed holes in the pages the
+        # workers are going to share
+        gc.disable()
+        try:
+            self.mosq_app
+        finally:
+            if hasattr(gc, "freeze"):
+                gc.freeze()
+                gc.enable()
+            else:
+                # without gc.freeze (Python 2) a collection would write to
+                # every object header: the master keeps the collector off
+                # and collects right before each fork instead
+                gc.collect()
+
+        self.log.info("Preloaded application in %.3fs", time.time() - start)
 
     def chdir(self):
         # chdir to the configured path before loading,
@@ -139,28 +235,228 @@ class Base(object):
 
         self.init_signals()
 
-        self.app.mosq_app.connect()
+        self.init_affinity()
+
+        self.worker_age = 0
+        self.autoscaler = None
+        if self.cfg.max_workers:
+            self.autoscaler = Autoscaler.from_config(self.cfg)
+            self.num_workers = self.autoscaler.clamp(self.cfg.workers)
+            self.log.info("Autoscaling between %s and %s workers",
+                    self.autoscaler.min_workers, self.autoscaler.max_workers)
+        else:
+            self.num_workers = self.cfg.workers
+
+        self.watcher = None
+        if self.cfg.watch_config and self.config_file is not None:
+            self.watcher = watcher_for(self.config_file)
+            self.log.info("Watching config file: %s", self.config_file)
+
+        self.metrics_server = None
+        self.retired_metrics = empty_snapshot()
+        self.reaped_metrics = []
+        if self.cfg.metrics_bind:
+            self.metrics_server = MetricsServer(self.cfg.metrics_bind)
+            self.log.info("Serving metrics at: %s", self.cfg.metrics_bind)
+
+        self.rings = None
+        if self.cfg.fanout:
+            if self.autoscaler is not None:
+                self.log.warning("Autoscaling is disabled with fanout")
+                self.autoscaler = None
+                self.num_workers = self.cfg.workers
+            self.init_fanout()
+
+    def init_fanout(self):
+        """\
+        Set up master side ingestion: one shared memory ring per worker slot
+        and the single subscription of the master feeding them.
+        """
+        self.rings = [RingBuffer(self.cfg.ring_size)
+                for i in range(max(1, self.num_workers))]
+        self.hash_ring = HashRing(range(len(self.rings)))
+        self.slot_cache = {}
+
+        mosq = self.mosq_app
+        topics = self.app_topics()
+        rpc = sorted(topic for topic, name in topics.items()
+                if getattr(getattr(mosq, name, None), "rpc", False))
+        if rpc:
+            # workers have no broker connection to publish responses on
+            raise RuntimeError("RPC handlers can't answer in fanout mode: %s"
+                    % ", ".join(rpc))
+        mosq.update_topics(topics)
+        mosq.signal_mapper.on_message = self.fanout
+        mosq.signal_mapper.sig_on_connect.connect(self.fanout_connect,
+                sender=mosq, weak=False)
+        self.log.info("Fanning out to %s workers", len(self.rings))
+        mosq.connect(loop_forever=False)
+
+    def app_topics(self):
+        """\
+        The topic handlers of the application merged with the
+        ``topic_handlers`` setting.
+        """
+        topics = dict(getattr(self.mosq_app.Meta, "topic_handlers", {}))
+        topics.update(self.cfg.topic_handlers)
+        return topics
+
+    def check_config(self):
+        """\
+        Apply the settings changed in the config file and tell the workers
+        to do the same.
+        """
+        if self.watcher is None or not self.watcher.changed():
+            return
+
+        self.log.info("Config file changed: %s", self.config_file)
+        try:
+            changed, restart = self.reread_config()
+        except BaseException:
+            self.log.exception("Failed to reload config file, keeping the "
+                    "current configuration")
+            return
+
+        if self.rings is not None and "workers" in changed:
+            changed.remove("workers")
+            restart.append("workers")
+            self.cfg.settings["workers"].set_validated(self.num_workers)
+        if restart:
+            self.log.warning("Changed settings need a restart: %s",
+                    ", ".join(sorted(restart)))
+        if not changed:
+            return
+
+        self.log.info("Applying changed settings: %s", ", ".join(changed))
+        self.apply_settings(changed)
+        for worker in self.WORKERS.values():
+            if not worker.draining:
+                self.kill_worker(worker.pid, signal.SIGHUP)
+
+    def apply_settings(self, changed):
+        self.log.setup(self.cfg)
+
+        scaling = [n for n in changed
+                if n == "workers" or n.endswith("_workers") or
+                n.startswith("scale_")]
+        if scaling:
+            if self.cfg.max_workers and self.rings is None:
+                autoscaler = Autoscaler.from_config(self.cfg)
+                if self.autoscaler is not None:
+                    autoscaler.last_up = self.autoscaler.last_up
+                    autoscaler.last_change = self.autoscaler.last_change
+                self.autoscaler = autoscaler
+                self.num_workers = autoscaler.clamp(self.num_workers)
+            else:
+                self.autoscaler = None
+                self.num_workers = self.cfg.workers
+
+        if "topic_handlers" in changed and self.rings is not None:
+            self.mosq_app.update_topics(self.app_topics())
+
+    def fanout_connect(self, sender, **kwargs):
+        sender.setup_subscriptions()
+
+    def fanout(self, mosq, obj, msg):
+        """\
+        Called on the network thread for every message in fanout mode.
+        """
+        self.mosq_app.feed_streams(msg)
+
+        key = msg.topic
+        if self.cfg.fanout_key is not None:
+            key = self.cfg.fanout_key(msg.topic, msg.payload)
+
+        slot = self.slot_cache.get(key)
+        if slot is None:
+            if len(self.slot_cache) >= self.SLOT_CACHE_SIZE:
+                self.slot_cache.clear()
+            slot = self.slot_cache[key] = self.hash_ring.get(key)
+
+        ring = self.rings[slot]
+        while not ring.put(msg.topic, msg.payload, msg.qos, msg.retain):
+            # the worker is behind: hold the network thread so the broker
+            # gets backpressure instead of messages being dropped
+            time.sleep(0.001)
+
+    def handoff_ring(self, worker):
+        """\
+        Pass the ring of an exited worker to the worker that took over its
+        slot, which continues from the first message not yet handled.
+        """
+        ring = worker.ring
+        if ring is None or ring.consumer != worker.pid:
+            return
+        for other in self.WORKERS.values():
+            if other.ring is ring and not other.draining:
+                ring.consumer = other.pid
+                return
+        ring.consumer = 0
 
 
+    def init_affinity(self):
+        """\
+        Pin the master to its own CPU and work out the CPUs the workers are
+        spread over.
+        """
+        self.cpu_pool = None
+
+        master_cpu = self.cfg.master_cpu
+        if self.cfg.cpu_affinity == "auto" or \
+                (not self.cfg.cpu_affinity and master_cpu is not None):
+            # read before the master is pinned below
+            cpus = util.available_cpus()
+        elif self.cfg.cpu_affinity:
+            cpus = util.parse_cpu_list(self.cfg.cpu_affinity)
+        else:
+            cpus = None
+
+        if master_cpu is not None:
+            if util.set_cpu_affinity([master_cpu]):
+                self.log.info("Master pinned to CPU %s", master_cpu)
+            else:
+                self.log.warning("CPU affinity is not supported here")
+
+        if cpus is not None:
+            self.cpu_pool = [c for c in cpus if c != master_cpu] or cpus
+
+    def cpus_for_slot(self, slot):
+        if not self.cpu_pool:
+            return None
+        pool = self.cpu_pool
+        if self.cfg.cpu_affinity:
+            count = min(max(1, self.cfg.cpus_per_worker), len(pool))
+        else:
+            # only the master is pinned, the workers share the rest
+            count = len(pool)
+        start = slot * count
+        return [pool[(start + i) % len(pool)] for i in range(count)]
+
+    def free_slot(self):
+        used = set(w.slot for w in self.active_workers())
+        slot = 0
+        while slot in used:
+            slot += 1
+        return slot
+
     def init_signals(self):
         """\
         Initialize master signal handling. Most of the signals
         are queued. Child signals only wake up the master.
         """
         # close old PIPE
-        # if self.PIPE:
-        #     [os.close(p) for p in self.PIPE]
-
-        # # initialize the pipe
-        # self.PIPE = pair = os.pipe()
-        # for p in pair:
-        #     util.set_non_blocking(p)
-        #     util.close_on_exec(p)
+        if self.PIPE:
+            [os.close(p) for p in self.PIPE]
 
-        # self.log.close_on_exec()
+        # initialize the pipe
+        self.PIPE = pair = os.pipe()
+        for p in pair:
+            util.set_non_blocking(p)
+            util.close_on_exec(p)
 
         # initialize all signals
         [signal.signal(s, self.signal) for s in self.SIGNALS]
+        signal.signal(signal.SIGCHLD, self.handle_chld)
 
 
     def signal(self, sig, frame):
@@ -173,7 +469,7 @@ class Base(object):
 
         os.environ["SERVER_SOFTWARE"] = "culexx"
 
-        self.log = self.cfg.logger_class(app.cfg)
+        self.log = self.cfg.logger_class(self.cfg)
 
         # reopen files
         if 'CULEXX_FD' in os.environ:
@@ -186,7 +482,7 @@ class Base(object):
             self.log.debug("Current configuration:")
             for config, value in sorted(self.cfg.settings.items(),
                     key=lambda setting: setting[1]):
-                self.log.debug("  %s: %s", config, value.value)
+                self.log.debug("  %s: %s", config, value.get())
 
         self.pidfile = None
         self.reexec_pid = 0
@@ -207,41 +503,54 @@ class Base(object):
         self.start()
         util._setproctitle("master [%s]" % self.proc_name)
 
-        # while True:
-        #     try:
-        #         sig = self.SIG_QUEUE.pop(0) if len(self.SIG_QUEUE) else None
-        #         if sig is None:
-        #             self.sleep()
-
-        #             continue
-
-        #         if sig not in self.SIG_NAMES:
-        #             self.log.info("Ignoring unknown signal: %s", sig)
-        #             continue
-
-        #         signame = self.SIG_NAMES.get(sig)
-        #         handler = getattr(self, "handle_%s" % signame, None)
-        #         if not handler:
-        #             self.log.error("Unhandled signal: %s", signame)
-        #             continue
-        #         self.log.info("Handling signal: %s", signame)
-        #         handler()
-        #         self.wakeup()
-        #     except StopIteration:
-        #         self.halt()
-        #     except KeyboardInterrupt:
-        #         self.halt()
-        #     except HaltServer as inst:
-        #         self.halt(reason=inst.reason, exit_status=inst.exit_status)
-        #     except SystemExit:
-        #         raise
-        #     except Exception:
-        #         self.log.info("Unhandled exception in main loop:\n%s",
-        #                     traceback.format_exc())
-        #         self.stop(False)
-        #         if self.pidfile is not None:
-        #             self.pidfile.unlink()
-        #         sys.exit(-1)
+        if self.cfg.preload_app:
+            self.preload()
+
+        try:
+            self.manage_workers()
+
+            while True:
+                sig = self.SIG_QUEUE.pop(0) if len(self.SIG_QUEUE) else None
+                if sig is None:
+                    self.sleep()
+                    self.log.flush_files()
+                    self.check_config()
+                    self.murder_workers()
+                    self.manage_workers()
+                    continue
+
+                if sig not in self.SIG_NAMES:
+                    self.log.info("Ignoring unknown signal: %s", sig)
+                    continue
+
+                signame = self.SIG_NAMES.get(sig)
+                handler = getattr(self, "handle_%s" % signame, None)
+                if not handler:
+                    self.log.error("Unhandled signal: %s", signame)
+                    continue
+                self.log.info("Handling signal: %s", signame)
+                handler()
+                self.wakeup()
+        except StopIteration:
+            self.halt()
+        except KeyboardInterrupt:
+            self.halt()
+        except HaltServer as inst:
+            self.halt(reason=inst.reason, exit_status=inst.exit_status)
+        except SystemExit:
+            raise
+        except Exception:
+            self.log.info("Unhandled exception in main loop:\n%s",
+                        traceback.format_exc())
+            self.stop(False)
+            if self.pidfile is not None:
+                self.pidfile.unlink()
+            sys.exit(-1)
+
+    def handle_chld(self, sig, frame):
+        "SIGCHLD handling"
+        self.reap_workers()
+        self.wakeup()
 
     def handle_hup(self):
         """\
@@ -257,19 +566,62 @@ class Base(object):
     def handle_quit(self):
         "SIGQUIT handling"
         self.log.info("Quit: %s", self.master_name)
-        # raise StopIteration
+        raise StopIteration
 
     def handle_int(self):
         "SIGINT handling"
         self.log.info("SigInt: %s", self.master_name)
         self.stop(False)
-        # raise StopIteration
+        raise StopIteration
 
     def handle_term(self):
         "SIGTERM handling"
         self.log.info("Sigterm: %s", self.master_name)
         self.stop(False)
-        # raise StopIteratioan
+        raise StopIteration
+
+    def handle_usr1(self):
+        """\
+        SIGUSR1 handling.
+        Reopen the log files of the master and the workers, e.g. after
+        logrotate moved them
+        """
+        self.log.reopen_files()
+        self.kill_workers(signal.SIGUSR1)
+
+    def handle_usr2(self):
+        """\
+        SIGUSR2 handling.
+        Run the sampling profiler in the workers for --profile-duration
+        seconds
+        """
+        self.request_workers("profile", self.cfg.profile_duration)
+
+    def request_workers(self, field, value):
+        """\
+        Leave a request in the status block of every worker, they act on it
+        from their loop.
+        """
+        workers = list(self.WORKERS.values())
+        for worker in workers:
+            worker.status.set(field, value)
+        return len(workers)
+
+    def handle_ttin(self):
+        """\
+        SIGTTIN handling.
+        Dump the flight recorders of the workers, and of the master when it
+        handles messages itself
+        """
+        recorder = getattr(self.callable, "recorder", None)
+        if recorder is not None and len(recorder):
+            try:
+                path = recorder.dump_to_dir(self.cfg.diagnostics_dir,
+                        "signal")
+                self.log.info("Dumped flight recorder to %s", path)
+            except (IOError, OSError) as e:
+                self.log.warning("Failed to dump the flight recorder: %s", e)
+        self.kill_workers(signal.SIGTTIN)
 
     def wakeup(self):
         """\
@@ -281,6 +633,103 @@ class Base(object):
             if e.errno not in [errno.EAGAIN, errno.EINTR]:
                 raise
 
+    def halt(self, reason=None, exit_status=0):
+        """ halt arbiter """
+        if self.rings is not None:
+            self.mosq_app.disconnect()
+        self.stop()
+        self.log.info("Shutting down: %s", self.master_name)
+        if reason is not None:
+            self.log.info("Reason: %s", reason)
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        if self.pidfile is not None:
+            self.pidfile.unlink()
+        sys.exit(exit_status)
+
+    def sleep(self):
+        """\
+        Sleep until PIPE is readable or we timeout.
+        A readable PIPE means a signal occurred.
+        """
+        fds = [self.PIPE[0]]
+        if self.watcher is not None and self.watcher.fileno() is not None:
+            fds.append(self.watcher.fileno())
+        if self.metrics_server is not None:
+            fds.append(self.metrics_server.fileno())
+        try:
+            ready = select.select(fds, [], [], 1.0)
+            if self.metrics_server is not None and \
+                    self.metrics_server.fileno() in ready[0]:
+                self.metrics_server.handle(self.handle_request)
+            if self.PIPE[0] not in ready[0]:
+                return
+            while os.read(self.PIPE[0], 1):
+                pass
+        except (select.error, OSError) as e:
+            if e.args[0] not in [errno.EAGAIN, errno.EINTR]:
+                raise
+        except KeyboardInterrupt:
+            sys.exit()
+
+    def handle_request(self, method, path):
+        """\
+        Answer a request to the metrics address.
+        """
+        path, _, query = path.partition("?")
+        if path not in ("/profile", "/memory"):
+            return "200 OK", self.render_metrics()
+
+        if method != "POST":
+            return "405 Method Not Allowed", "POST to %s\n" % path
+
+        if path == "/memory":
+            count = self.request_workers("memory", 1)
+            self.log.info("Memory report requested from %d workers", count)
+            return "200 OK", "memory report requested from %d workers\n" \
+                    % count
+
+        seconds = self.cfg.profile_duration
+        for arg in query.split("&"):
+            name, _, value = arg.partition("=")
+            if name == "seconds":
+                try:
+                    seconds = float(value)
+                except ValueError:
+                    return "400 Bad Request", "invalid seconds\n"
+        if seconds <= 0:
+            return "400 Bad Request", "invalid seconds\n"
+        count = self.request_workers("profile", seconds)
+        self.log.info("Profiling %d workers for %ss", count, seconds)
+        return "200 OK", "profiling %d workers for %ss\n" % (count, seconds)
+
+    def render_metrics(self):
+        """\
+        Sum up the metrics of the workers, and of those that exited since
+        the start so the counters never go backwards.
+        """
+        reaped, self.reaped_metrics = self.reaped_metrics, []
+        if reaped:
+            for snap in reaped:
+                snap["gauges"] = {}
+            self.retired_metrics = merge_snapshots(
+                    [self.retired_metrics] + reaped)
+
+        snapshots = [self.retired_metrics]
+        workers = []
+        for pid, worker in list(self.WORKERS.items()):
+            workers.append((pid, worker.status.read()))
+            if worker.metrics_buf is not None:
+                snap = worker.metrics_buf.read()
+                if snap:
+                    snapshots.append(snap)
+
+        merged = merge_snapshots(snapshots)
+        if self.rings is not None:
+            merged["gauges"]["fanout_backlog"] = \
+                    sum(ring.pending() for ring in self.rings)
+        return render(merged, workers)
+
     def stop(self, graceful=True):
         """\
         Stop workers
@@ -292,6 +741,235 @@ class Base(object):
         if not graceful:
             sig = signal.SIGTERM
         limit = time.time() + self.cfg.graceful_timeout
+        # instruct the workers to exit
+        self.kill_workers(sig)
+        # wait until the graceful timeout
+        while self.WORKERS and time.time() < limit:
+            time.sleep(0.1)
+
+        self.kill_workers(signal.SIGKILL)
+
+    def active_workers(self):
+        """\
+        Workers that are neither draining nor being replaced, oldest first.
+        """
+        workers = [w for w in self.WORKERS.values()
+                if not w.draining and w.replacement is None]
+        return sorted(workers, key=lambda w: w.age)
+
+    def recycle_workers(self):
+        """\
+        Replace workers that hit ``max_messages`` or ``max_rss``. The
+        replacement is started first and the old worker only drains once the
+        new one is subscribed.
+        """
+        for worker in list(self.WORKERS.values()):
+            if worker.draining:
+                continue
+
+            if worker.replacement is None:
+                if worker.status.get("recycle"):
+                    self.log.info("Recycling worker (pid: %s)", worker.pid)
+                    worker.replacement = self.spawn_worker(slot=worker.slot)
+                continue
+
+            new = self.WORKERS.get(worker.replacement)
+            if new is None:
+                # the replacement died before it was ready, try again
+                worker.replacement = None
+            elif new.status.get("state") == WorkerStatus.RUNNING:
+                self.retire_worker(worker)
+
+    def manage_workers(self):
+        """\
+        Maintain the number of workers by spawning or retiring workers as
+        required. With autoscaling enabled the number follows the backlog
+        and handler latency the workers report.
+        """
+        self.recycle_workers()
+        workers = self.active_workers()
+
+        for worker in workers:
+            if not worker.reported:
+                self.report_worker(worker)
+
+        if self.autoscaler is not None:
+            statuses = [w.status.read() for w in workers]
+            statuses = [s for s in statuses
+                    if s["state"] == WorkerStatus.RUNNING]
+            target = self.autoscaler.target(len(workers), statuses)
+            if target != self.num_workers:
+                self.log.info("Scaling workers from %s to %s",
+                        self.num_workers, target)
+            self.num_workers = target
+
+        if len(workers) < self.num_workers:
+            self.spawn_workers(self.num_workers - len(workers))
+
+        # retire the workers with the least work left so draining is quick
+        excess = len(workers) - self.num_workers
+        if excess > 0:
+            workers.sort(key=lambda w: w.status.get("backlog"))
+            for worker in workers[:excess]:
+                self.retire_worker(worker)
+
+    def report_worker(self, worker):
+        status = worker.status.read()
+        if status["state"] != WorkerStatus.RUNNING:
+            return
+        worker.reported = True
+        self.log.info("Worker ready (pid: %s) in %.3fs, rss %d KiB "
+                "(%d KiB shared)", worker.pid, status["startup"],
+                status["rss"] // 1024, status["shared"] // 1024)
+
+    def spawn_worker(self, slot=None):
+        self.worker_age += 1
+        worker = Worker(self.worker_age, self.pid, self, self.cfg,
+                self.log, WorkerStatus())
+        if self.metrics_server is not None:
+            worker.metrics_buf = MetricsBuffer()
+        worker.slot = self.free_slot() if slot is None else slot
+        worker.cpus = self.cpus_for_slot(worker.slot)
+        if self.rings is not None:
+            worker.ring = self.rings[worker.slot % len(self.rings)]
+
+        # objects allocated since the preload must not be touched by the
+        # collector in the child either
+        if self.cfg.preload_app:
+            if hasattr(gc, "freeze"):
+                gc.freeze()
+            else:
+                gc.collect()
+
+        worker.spawned = time.time()
+        pid = os.fork()
+        if pid != 0:
+            worker.pid = pid
+            self.WORKERS[pid] = worker
+            if worker.ring is not None and \
+                    worker.ring.consumer not in self.WORKERS:
+                worker.ring.consumer = pid
+            return pid
+
+        # Process Child
+        worker.pid = os.getpid()
+        if not gc.isenabled():
+            gc.enable()
+        try:
+            util._setproctitle("worker [%s]" % self.proc_name)
+            self.log.info("Booting worker with pid: %s", worker.pid)
+            worker.init_process()
+            sys.exit(0)
+        except SystemExit:
+            raise
+        except AppImportError as e:
+            self.log.debug("Exception while loading the application",
+                    exc_info=True)
+            sys.stderr.write("%s\n" % e)
+            sys.stderr.flush()
+            sys.exit(self.APP_LOAD_ERROR)
+        except:
+            self.log.exception("Exception in worker process")
+            worker.dump_recorder("crash")
+            if not worker.booted:
+                sys.exit(self.WORKER_BOOT_ERROR)
+            sys.exit(-1)
+        finally:
+            self.log.info("Worker exiting (pid: %s)", worker.pid)
+
+    def spawn_workers(self, count):
+        for i in range(count):
+            self.spawn_worker()
+            time.sleep(0.1 * random.random())
+
+    def retire_worker(self, worker):
+        """\
+        Gracefully take a worker out of rotation. It unsubscribes, finishes
+        the messages it already received and exits.
+        """
+        worker.draining = True
+        worker.drain_started = time.time()
+        self.kill_worker(worker.pid, signal.SIGQUIT)
+
+    def murder_workers(self):
+        """\
+        Kill workers that stopped reporting or are draining for longer
+        than the graceful timeout.
+        """
+        now = time.time()
+        for (pid, worker) in list(self.WORKERS.items()):
+            if worker.draining:
+                if now - worker.drain_started <= self.cfg.graceful_timeout:
+                    continue
+                self.log.warning("Worker draining too long (pid:%s)", pid)
+            else:
+                heartbeat = worker.status.get("heartbeat")
+                if not heartbeat or now - heartbeat <= self.cfg.timeout:
+                    continue
+                self.log.critical("WORKER TIMEOUT (pid:%s)", pid)
+            self.kill_worker(pid, signal.SIGKILL)
+
+    def reap_workers(self):
+        """\
+        Reap workers to avoid zombie processes
+        """
+        try:
+            while True:
+                wpid, status = os.waitpid(-1, os.WNOHANG)
+                if not wpid:
+                    break
+
+                # A worker said it cannot boot. We'll shutdown
+                # to avoid infinite start/stop cycles.
+                exitcode = status >> 8
+                if exitcode == self.WORKER_BOOT_ERROR:
+                    reason = "Worker failed to boot."
+                    raise HaltServer(reason, self.WORKER_BOOT_ERROR)
+                if exitcode == self.APP_LOAD_ERROR:
+                    reason = "App failed to load."
+                    raise HaltServer(reason, self.APP_LOAD_ERROR)
+
+                worker = self.WORKERS.pop(wpid, None)
+                if not worker:
+                    continue
+                self.handoff_ring(worker)
+                worker.status.close()
+                if worker.metrics_buf is not None:
+                    snap = worker.metrics_buf.read()
+                    if snap:
+                        self.reaped_metrics.append(snap)
+                    worker.metrics_buf.close()
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise
+
+    def kill_workers(self, sig):
+        """\
+        Kill all workers with the signal `sig`
+        :attr sig: `signal.SIG*` value
+        """
+        for pid in list(self.WORKERS.keys()):
+            self.kill_worker(pid, sig)
+
+    def kill_worker(self, pid, sig):
+        """\
+        Kill a worker
+
+        :attr pid: int, worker pid
+        :attr sig: `signal.SIG*` value
+        """
+        try:
+            os.kill(pid, sig)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                try:
+                    worker = self.WORKERS.pop(pid)
+                    self.handoff_ring(worker)
+                    worker.status.close()
+                    return
+                except (KeyError, OSError):
+                    return
+            raise
 
     def run(self):
         # if self.cfg.check_config:
@@ -324,3 +1002,10 @@ class Base(object):
             sys.stderr.write("\nError: %s\n\n" % e)
             sys.stderr.flush()
             sys.exit(1)
+
+
+def run():
+    """\
+    The ``culexx`` command line runner for launching an application.
+    """
+    Base("%(prog)s [OPTIONS] [APP_MODULE]").run()
@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -
+#
+# This file is part of culexx released under the MIT license.
+# See the NOTICE for more information.
+
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import struct
+import sys
+import threading
+import time
+
+from .metrics import Histogram
+from .mosqtt import Mosqtt
+
+PREFIX = "bench"
+NAME = "0"
+
+# publish time, publisher, sequence number
+HEADER = struct.Struct(">dII")
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def topic_name(index):
+    return "/load/%d" % index
+
+
+def subscriber_topics(index, opts):
+    count = opts.topics_per_subscriber or opts.topics
+    return [(index + i) % opts.topics for i in range(min(count, opts.topics))]
+
+
+class BenchClient(Mosqtt):
+    """\
+    A publisher or subscriber of the load. Every client shares the client
+    id (and so the topics) of the others, the session suffix tells their
+    connections apart.
+    """
+
+    def __init__(self, opts, role, topics=()):
+        Mosqtt.__init__(self, prefix=PREFIX, name=NAME, broker=opts.host,
+                port=opts.port)
+        self.session_suffix = "-%s" % role
+        self.topic_mapper.topic_handlers = dict((topic_name(t),
+            "handle_load") for t in topics)
+        if opts.shared:
+            self.share_group = PREFIX
+        self.connected = threading.Event()
+        self.acked = 0
+        self.subscribed = 0
+        self.received = 0
+        self.latency = Histogram()
+
+        sm = self.signal_mapper
+        sm.sig_on_connect.connect(self.on_connect, sender=self, weak=False)
+        sm.sig_on_publish.connect(self.on_publish, sender=self, weak=False)
+        sm.sig_on_subscribe.connect(self.on_subscribe, sender=self,
+                weak=False)
+        sm.sig_on_message.connect(self.on_message, sender=self, weak=False)
+
+    def on_connect(self, sender, **kwargs):
+        self.connected.set()
+
+    def on_publish(self, sender, **kwargs):
+        self.acked += 1
+
+    def on_subscribe(self, sender, **kwargs):
+        self.subscribed += 1
+
+    def on_message(self, sender, msg=None, **kwargs):
+        self.topic_mapper.handle_topic(msg.topic, msg.payload)
+
+    def handle_load(self, payload):
+        sent = HEADER.unpack_from(payload)[0]
+        self.received += 1
+        self.latency.add(max(0.0, time.time() - sent))
+
+    def close(self):
+        for sig in (self.signal_mapper.sig_on_connect,
+                self.signal_mapper.sig_on_publish,
+                self.signal_mapper.sig_on_subscribe,
+                self.signal_mapper.sig_on_message):
+            sig.disconnect(getattr(self, sig.name), sender=self)
+        try:
+            self.disconnect()
+        except Exception:
+            pass
+
+
+def publish_loop(client, index, opts, rate, go, result):
+    """\
+    Publish to the topics in turn at ``rate`` messages per second, or as
+    fast as possible when it is 0, for ``opts.duration`` seconds.
+    """
+    padding = b"\x00" * max(0, opts.size - HEADER.size)
+    per_topic = [0] * opts.topics
+    interval = 1.0 / rate if rate else 0
+    go.wait()
+    start = next_time = time.time()
+    deadline = start + opts.duration
+    seq = 0
+    errors = 0
+    while True:
+        now = time.time()
+        if now >= deadline:
+            break
+        if interval:
+            if now < next_time:
+                time.sleep(next_time - now)
+            next_time += interval
+        topic = (index + seq) % opts.topics
+        payload = HEADER.pack(time.time(), index, seq) + padding
+        try:
+            client.publish(topic_name(topic), payload, opts.qos)
+        except Exception:
+            errors += 1
+        else:
+            per_topic[topic] += 1
+        seq += 1
+    elapsed = time.time() - start
+
+    # wait for the acks of the last messages
+    drain_until = time.time() + opts.drain
+    while client.acked < sum(per_topic) and time.time() < drain_until:
+        client.mqtt_client.loop(0.05)
+    result.update(sent=per_topic, acked=client.acked, errors=errors,
+            elapsed=elapsed)
+
+
+def publisher_process(indexes, opts, rate, ready, go, results):
+    clients = []
+    for index in indexes:
+        client = BenchClient(opts, "pub%d" % index)
+        client.connect(loop_forever=False)
+        if not client.connected.wait(10):
+            ready.put(("error", "publisher %d failed to connect" % index))
+            return
+        # Mosqtt.publish runs the network loop itself
+        client.mqtt_client.loop_stop()
+        clients.append(client)
+    ready.put(("ready", len(clients)))
+
+    threads = []
+    outcome = [{} for _ in clients]
+    for index, client, result in zip(indexes, clients, outcome):
+        t = threading.Thread(target=publish_loop,
+                args=(client, index, opts, rate, go, result))
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    for client in clients:
+        client.close()
+    results.put(("publishers", outcome))
+
+
+def subscriber_process(indexes, opts, ready, stop, results):
+    clients = []
+    for index in indexes:
+        topics = subscriber_topics(index, opts)
+        client = BenchClient(opts, "sub%d" % index, topics)
+        client.connect(loop_forever=False)
+        if not client.connected.wait(10):
+            ready.put(("error", "subscriber %d failed to connect" % index))
+            return
+        for t in topics:
+            client.subscribe(topic_name(t), opts.qos)
+        clients.append(client)
+
+    deadline = time.time() + 10
+    while any(c.subscribed < len(c.topics) for c in clients):
+        if time.time() > deadline:
+            ready.put(("error", "subscriptions were not acknowledged"))
+            return
+        time.sleep(0.01)
+    ready.put(("ready", len(clients)))
+
+    stop.wait()
+    for client in clients:
+        client.close()
+    results.put(("subscribers", [(c.received, c.latency.dump())
+        for c in clients]))
+
+
+def split(count, parts):
+    parts = max(1, min(parts, count))
+    return [list(range(i, count, parts)) for i in range(parts)]
+
+
+def expected_deliveries(opts, sent):
+    """\
+    The number of messages the subscribers should get for ``sent``, the
+    number of messages published per topic.
+    """
+    readers = [0] * opts.topics
+    for index in range(opts.subscribers):
+        for t in subscriber_topics(index, opts):
+            readers[t] += 1
+    if opts.shared:
+        readers = [min(1, r) for r in readers]
+    return sum(s * r for s, r in zip(sent, readers))
+
+
+def collect(queue, count, timeout, kind):
+    items = []
+    deadline = time.time() + timeout
+    while len(items) < count:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise RuntimeError("timed out waiting for the %s" % kind)
+        try:
+            status, value = queue.get(timeout=remaining)
+        except Exception:
+            continue
+        if status == "error":
+            raise RuntimeError(value)
+        items.append(value)
+    return items
+
+
+def run_step(opts, rate):
+    ready = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    go = multiprocessing.Event()
+    stop = multiprocessing.Event()
+
+    sub_groups = split(opts.subscribers, opts.subscriber_processes) \
+            if opts.subscribers else []
+    pub_groups = split(opts.publishers, opts.publisher_processes)
+    procs = []
+    try:
+        for group in sub_groups:
+            procs.append(multiprocessing.Process(target=subscriber_process,
+                args=(group, opts, ready, stop, results)))
+            procs[-1].start()
+        collect(ready, len(sub_groups), 30, "subscribers")
+
+        for group in pub_groups:
+            procs.append(multiprocessing.Process(target=publisher_process,
+                args=(group, opts, rate, ready, go, results)))
+            procs[-1].start()
+        collect(ready, len(pub_groups), 30, "publishers")
+
+        go.set()
+        timeout = opts.duration + opts.drain + 30
+        sent = [0] * opts.topics
+        acked = errors = 0
+        elapsed = []
+        for outcome in collect(results, len(pub_groups), timeout,
+                "publishers"):
+            for result in outcome:
+                sent = [a + b for a, b in zip(sent, result["sent"])]
+                acked += result["acked"]
+                errors += result["errors"]
+                elapsed.append(result["elapsed"])
+
+        # give the last messages time to arrive
+        time.sleep(opts.drain)
+        stop.set()
+        received = 0
+        latency = Histogram()
+        for outcome in collect(results, len(sub_groups), 30, "subscribers"):
+            for count, dump in outcome:
+                received += count
+                latency.merge(Histogram.load(dump))
+    finally:
+        stop.set()
+        for p in procs:
+            p.join(5)
+            if p.is_alive():
+                p.terminate()
+
+    duration = max(elapsed) if elapsed else opts.duration
+    published = sum(sent)
+    expected = expected_deliveries(opts, sent)
+    return {
+        "rate": rate,
+        "offered": rate * opts.publishers if rate else None,
+        "published": published,
+        "publish_rate": published / duration,
+        "acked": acked,
+        "errors": errors,
+        "expected": expected,
+        "received": received,
+        "delivery_rate": received / duration,
+        "loss": 1.0 - float(received) / expected if expected else 0.0,
+        "latency": dict(("p%g" % (q * 100), latency.percentile(q))
+            for q in QUANTILES),
+        "latency_mean": latency.mean,
+        "latency_max": latency.max,
+    }
+
+
+def print_header():
+    print("%10s %10s %11s %7s %9s %9s %9s %9s %9s" % ("rate/pub",
+        "publish/s", "delivered/s", "loss", "p50 ms", "p90 ms", "p99 ms",
+        "p99.9 ms", "max ms"))
+
+
+def print_step(step):
+    lat = step["latency"]
+    print("%10s %10.0f %11.0f %6.2f%% %9.2f %9.2f %9.2f %9.2f %9.2f" % (
+        step["rate"] or "max", step["publish_rate"], step["delivery_rate"],
+        step["loss"] * 100, lat["p50"] * 1000, lat["p90"] * 1000,
+        lat["p99"] * 1000, lat["p99.9"] * 1000, step["latency_max"] * 1000))
+    sys.stdout.flush()
+
+
+def saturated(step, previous, opts):
+    """\
+    True when raising the rate stopped raising the throughput: publishers
+    can't keep up with the rate, messages are lost or deliveries grow much
+    less than the load.
+    """
+    if step["offered"] and step["publish_rate"] < 0.9 * step["offered"]:
+        return True
+    if step["loss"] > opts.max_loss:
+        return True
+    if previous is not None and previous["delivery_rate"] and \
+            step["delivery_rate"] < 1.1 * previous["delivery_rate"]:
+        return True
+    return False
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(prog="culexx-bench",
+            description="Load a broker with culexx publishers and "
+                "subscribers and report throughput, latency and loss.")
+    parser.add_argument("--broker", metavar="HOST:PORT",
+            help="the broker to load, a local test broker is started "
+                "when it isn't given")
+    parser.add_argument("-p", "--publishers", type=int, default=1)
+    parser.add_argument("-s", "--subscribers", type=int, default=1)
+    parser.add_argument("--publisher-processes", type=int, default=1,
+            help="processes the publishers are spread over, each "
+                "publisher runs in a thread")
+    parser.add_argument("--subscriber-processes", type=int, default=1)
+    parser.add_argument("-t", "--topics", type=int, default=1,
+            help="topics the publishers publish to in turn")
+    parser.add_argument("--topics-per-subscriber", type=int, default=0,
+            help="topics each subscriber subscribes to, all by default")
+    parser.add_argument("--shared", action="store_true",
+            help="subscribe through a shared subscription, each message "
+                "goes to one subscriber")
+    parser.add_argument("-q", "--qos", type=int, choices=(0, 1, 2),
+            default=0)
+    parser.add_argument("--size", type=int, default=64,
+            help="payload size in bytes, at least %d" % HEADER.size)
+    parser.add_argument("-r", "--rate", type=float, default=0,
+            help="messages per second of each publisher, 0 publishes as "
+                "fast as possible")
+    parser.add_argument("-d", "--duration", type=float, default=10)
+    parser.add_argument("--drain", type=float, default=2,
+            help="seconds to wait for the last messages")
+    parser.add_argument("--ramp", type=float, default=0, metavar="FACTOR",
+            help="multiply the rate by FACTOR after every step until the "
+                "throughput saturates")
+    parser.add_argument("--steps", type=int, default=10,
+            help="most steps of a ramp")
+    parser.add_argument("--max-loss", type=float, default=0.01,
+            help="share of lost messages that counts as saturation")
+    parser.add_argument("--json", help="write the results to this file")
+    opts = parser.parse_args(args)
+
+    if opts.ramp and (opts.ramp <= 1 or not opts.rate):
+        parser.error("--ramp needs a factor above 1 and a starting --rate")
+    if opts.topics < 1 or opts.publishers < 1 or opts.subscribers < 0:
+        parser.error("need at least one topic and one publisher")
+    opts.host, opts.port = None, None
+    if opts.broker:
+        host, _, port = opts.broker.rpartition(":")
+        try:
+            opts.host, opts.port = host or "127.0.0.1", int(port)
+        except ValueError:
+            parser.error("--broker must be HOST:PORT")
+    return opts
+
+
+def run(args=None):
+    """\
+    The ``culexx-bench`` load generator.
+    """
+    opts = parse_args(args)
+    broker = None
+    if opts.host is None:
+        from .broker import Broker
+        broker = Broker().start()
+        opts.host, opts.port = broker.host, broker.port
+        print("Started a local test broker on %s:%s, it is likely to "
+              "saturate before culexx does" % (opts.host, opts.port))
+
+    steps = []
+    try:
+        print_header()
+        rate = opts.rate
+        for i in range(opts.steps if opts.ramp else 1):
+            step = run_step(opts, rate)
+            print_step(step)
+            previous = steps[-1] if steps else None
+            steps.append(step)
+            if opts.ramp and saturated(step, previous, opts):
+                break
+            rate *= opts.ramp
+    except RuntimeError as e:
+        sys.stderr.write("Error: %s\n" % e)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if broker is not None:
+            broker.stop()
+
+    if opts.ramp and steps:
+        best = max(steps, key=lambda s: s["delivery_rate"])
+        print("Saturates at about %.0f deliveries/s, %.0f publishes/s "
+              "(%s messages/s per publisher)" % (best["delivery_rate"],
+                  best["publish_rate"], best["rate"]))
+
+    if opts.json:
+        with open(opts.json, "w") as f:
+            json.dump({"options": dict((k, v) for k, v in
+                vars(opts).items()), "steps": steps}, f, indent=2,
+                sort_keys=True)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -
+#
+# This file is part of culexx released under the MIT license.
+# See the NOTICE for more information.
+
+import socket
+import struct
+import sys
+import threading
+
+try:
+    import socketserver
+except ImportError: # python 2
+    import SocketServer as socketserver
+
+from .topics import TopicTree, topic_matches, validate_filter
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+# CONNACK return codes
+ACCEPTED = 0
+BAD_PROTOCOL = 1
+BAD_CLIENT_ID = 2
+
+SUBACK_FAILURE = 0x80
+
+_byte = struct.Struct("B")
+_short = struct.Struct(">H")
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_length(length):
+    out = []
+    while True:
+        digit = length % 128
+        length //= 128
+        if length:
+            digit |= 0x80
+        out.append(_byte.pack(digit))
+        if not length:
+            return b"".join(out)
+
+
+def encode_string(value):
+    if not isinstance(value, bytes):
+        value = value.encode("utf-8")
+    return _short.pack(len(value)) + value
+
+
+def decode_string(data, offset):
+    length = _short.unpack_from(data, offset)[0]
+    start = offset + 2
+    value = data[start:start + length]
+    if len(value) != length:
+        raise ProtocolError("truncated string")
+    return value.decode("utf-8"), start + length
+
+
+def packet(kind, flags, body=b""):
+    return _byte.pack(kind << 4 | flags) + encode_length(len(body)) + body
+
+
+def publish_packet(topic, payload, qos, retain, mid=0, dup=False):
+    flags = qos << 1 | bool(retain) | (dup and 0x8 or 0)
+    body = encode_string(topic)
+    if qos:
+        body += _short.pack(mid)
+    return packet(PUBLISH, flags, body + payload)
+
+
+class Subscription(object):
+
+    __slots__ = ("session", "topic_filter", "qos")
+
+    def __init__(self, session, topic_filter, qos):
+        self.session = session
+        self.topic_filter = topic_filter
+        self.qos = qos
+
+
+class SharedGroup(object):
+    """\
+    The members of a ``$share/<group>/<filter>`` subscription, each
+    message goes to one of them in turn.
+    """
+
+    def __init__(self, name, topic_filter):
+        self.name = name
+        self.topic_filter = topic_filter
+        self.members = []
+        self.next = 0
+
+    def pick(self):
+        if not self.members:
+            return None
+        self.next = (self.next + 1) % len(self.members)
+        return self.members[self.next]
+
+
+class Session(object):
+
+    def __init__(self, broker, sock, client_id):
+        self.broker = broker
+        self.sock = sock
+        self.client_id = client_id
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+        self.last_mid = 0
+        # outgoing QoS 1 and 2 messages waiting for their acks
+        self.inflight = {}
+        # incoming QoS 2 message ids waiting for PUBREL
+        self.received = set()
+        self.will = None
+        self.closed = False
+
+    def send(self, data):
+        with self.lock:
+            if self.closed:
+                return False
+            try:
+                self.sock.sendall(data)
+            except (socket.error, socket.timeout):
+                self.closed = True
+                return False
+        return True
+
+    def next_mid(self):
+        with self.lock:
+            for _ in range(65535):
+                self.last_mid = self.last_mid % 65535 + 1
+                if self.last_mid not in self.inflight:
+                    return self.last_mid
+        raise ProtocolError("no free message ids")
+
+    def deliver(self, topic, payload, qos, retain=False):
+        mid = 0
+        if qos:
+            mid = self.next_mid()
+            self.inflight[mid] = qos
+        if self.send(publish_packet(topic, payload, qos, retain, mid)):
+            self.broker.count("delivered")
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, OSError):
+            pass
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.rfile = self.request.makefile("rb")
+
+    def read_packet(self):
+        header = self.rfile.read(1)
+        if not header:
+            return None, None, None
+        first = _byte.unpack(header)[0]
+        length = 0
+        multiplier = 1
+        for _ in range(4):
+            byte = self.rfile.read(1)
+            if not byte:
+                return None, None, None
+            digit = _byte.unpack(byte)[0]
+            length += (digit & 0x7f) * multiplier
+            multiplier *= 128
+            if not digit & 0x80:
+                break
+        else:
+            raise ProtocolError("malformed remaining length")
+        body = self.rfile.read(length)
+        if len(body) != length:
+            return None, None, None
+        return first >> 4, first & 0x0f, body
+
+    def handle(self):
+        broker = self.server.broker
+        session = None
+        clean = False
+        try:
+            kind, flags, body = self.read_packet()
+            if kind != CONNECT:
+                return
+            session = broker.connect(self.request, body)
+            if session is None:
+                return
+            while True:
+                kind, flags, body = self.read_packet()
+                if kind is None:
+                    break
+                if kind == DISCONNECT:
+                    clean = True
+                    break
+                broker.handle(session, kind, flags, body)
+        except (socket.error, socket.timeout, ProtocolError, struct.error):
+            pass
+        finally:
+            if session is not None:
+                broker.disconnect(session, clean)
+
+    def finish(self):
+        self.rfile.close()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Broker(object):
+    """\
+    A small MQTT 3.1.1 broker running in threads of the calling process,
+    for tests and benchmarks that need real framing without an external
+    server.
+
+    It supports QoS 0, 1 and 2 both ways, wildcard and ``$share/<group>/``
+    shared subscriptions, retained messages and wills. Sessions are
+    always clean and nothing is retransmitted, it is not meant to face
+    unreliable networks.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.lock = threading.Lock()
+        self.tree = TopicTree()
+        self.groups = {}
+        self.sessions = {}
+        self.retained = {}
+        self.stats = {"received": 0, "delivered": 0, "connects": 0}
+        self.server = None
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self.server = _Server((self.host, self.port), _Handler)
+        self.server.broker = self
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                kwargs={"poll_interval": 0.1}, name="culexx-broker")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        with self.lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            session.close()
+        self.thread.join()
+        self.server = None
+
+    def count(self, name, n=1):
+        # only read by tests and benchmarks, losing an increment to a
+        # race is fine
+        self.stats[name] += n
+
+    def connect(self, sock, body):
+        protocol, offset = decode_string(body, 0)
+        level, flags, keepalive = struct.unpack_from(">BBH", body, offset)
+        offset += 4
+        if protocol not in ("MQTT", "MQIsdp") or level not in (3, 4):
+            sock.sendall(packet(CONNACK, 0, b"\x00" + _byte.pack(BAD_PROTOCOL)))
+            return None
+
+        client_id, offset = decode_string(body, offset)
+        if not client_id:
+            if not flags & 0x02:
+                sock.sendall(packet(CONNACK, 0,
+                    b"\x00" + _byte.pack(BAD_CLIENT_ID)))
+                return None
+            client_id = "culexx-%x" % id(sock)
+
+        session = Session(self, sock, client_id)
+        if flags & 0x04:
+            will_topic, offset = decode_string(body, offset)
+            length = _short.unpack_from(body, offset)[0]
+            offset += 2
+            will_payload = body[offset:offset + length]
+            session.will = (will_topic, will_payload, (flags >> 3) & 0x03,
+                    bool(flags & 0x20))
+
+        if keepalive:
+            sock.settimeout(keepalive * 1.5)
+
+        with self.lock:
+            old = self.sessions.get(client_id)
+            self.sessions[client_id] = session
+        if old is not None:
+            old.will = None
+            old.close()
+
+        self.count("connects")
+        session.send(packet(CONNACK, 0, b"\x00" + _byte.pack(ACCEPTED)))
+        return session
+
+    def disconnect(self, session, clean):
+        with self.lock:
+            if self.sessions.get(session.client_id) is session:
+                del self.sessions[session.client_id]
+            for topic_filter in list(session.subscriptions):
+                self._unsubscribe(session, topic_filter)
+        session.close()
+        if not clean and session.will is not None:
+            self.publish(*session.will)
+
+    def handle(self, session, kind, flags, body):
+        if kind == PUBLISH:
+            self.handle_publish(session, flags, body)
+        elif kind == PUBACK or kind == PUBCOMP:
+            session.inflight.pop(_short.unpack_from(body)[0], None)
+        elif kind == PUBREC:
+            mid = _short.unpack_from(body)[0]
+            session.send(packet(PUBREL, 0x02, _short.pack(mid)))
+        elif kind == PUBREL:
+            mid = _short.unpack_from(body)[0]
+            session.received.discard(mid)
+            session.send(packet(PUBCOMP, 0, _short.pack(mid)))
+        elif kind == SUBSCRIBE:
+            self.handle_subscribe(session, body)
+        elif kind == UNSUBSCRIBE:
+            self.handle_unsubscribe(session, body)
+        elif kind == PINGREQ:
+            session.send(packet(PINGRESP, 0))
+        else:
+            raise ProtocolError("unexpected packet type %d" % kind)
+
+    def handle_publish(self, session, flags, body):
+        qos = (flags >> 1) & 0x03
+        retain = bool(flags & 0x01)
+        topic, offset = decode_string(body, 0)
+        mid = 0
+        if qos:
+            mid = _short.unpack_from(body, offset)[0]
+            offset += 2
+        payload = body[offset:]
+        self.count("received")
+
+        if qos == 2:
+            if mid not in session.received:
+                session.received.add(mid)
+                self.publish(topic, payload, qos, retain)
+            session.send(packet(PUBREC, 0, _short.pack(mid)))
+            return
+
+        self.publish(topic, payload, qos, retain)
+        if qos == 1:
+            session.send(packet(PUBACK, 0, _short.pack(mid)))
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        """\
+        Route a message to the matching subscriptions, as if a client had
+        published it.
+        """
+        if not isinstance(payload, bytes):
+            payload = payload.encode("utf-8")
+
+        targets = {}
+        with self.lock:
+            if retain:
+                if payload:
+                    self.retained[topic] = (payload, qos)
+                else:
+                    self.retained.pop(topic, None)
+            for value in self.tree.match(topic):
+                if isinstance(value, SharedGroup):
+                    value = value.pick()
+                    if value is None:
+                        continue
+                granted = min(qos, value.qos)
+                if granted > targets.get(value.session, -1):
+                    targets[value.session] = granted
+
+        for session, granted in targets.items():
+            session.deliver(topic, payload, granted)
+
+    def handle_subscribe(self, session, body):
+        mid = _short.unpack_from(body)[0]
+        offset = 2
+        codes = []
+        retained = []
+        while offset < len(body):
+            topic_filter, offset = decode_string(body, offset)
+            qos = _byte.unpack_from(body, offset)[0] & 0x03
+            offset += 1
+            try:
+                shared = self._subscribe(session, topic_filter, qos)
+            except ValueError:
+                codes.append(SUBACK_FAILURE)
+                continue
+            codes.append(qos)
+            if not shared:
+                retained.append((topic_filter, qos))
+        session.send(packet(SUBACK, 0, _short.pack(mid) +
+            b"".join(_byte.pack(c) for c in codes)))
+
+        for topic_filter, qos in retained:
+            with self.lock:
+                matches = [(t, p, q) for t, (p, q) in self.retained.items()
+                        if topic_matches(topic_filter, t)]
+            for topic, payload, retained_qos in matches:
+                session.deliver(topic, payload, min(qos, retained_qos), True)
+
+    def _subscribe(self, session, topic_filter, qos):
+        group = None
+        real_filter = topic_filter
+        if topic_filter.startswith("$share/"):
+            parts = topic_filter.split("/", 2)
+            if len(parts) != 3 or not parts[1]:
+                raise ValueError("invalid shared subscription")
+            group, real_filter = parts[1], parts[2]
+        validate_filter(real_filter)
+
+        with self.lock:
+            if topic_filter in session.subscriptions:
+                self._unsubscribe(session, topic_filter)
+            sub = Subscription(session, topic_filter, qos)
+            session.subscriptions[topic_filter] = sub
+            if group is None:
+                self.tree.add(real_filter, sub)
+            else:
+                shared = self.groups.get((group, real_filter))
+                if shared is None:
+                    shared = SharedGroup(group, real_filter)
+                    self.groups[(group, real_filter)] = shared
+                    self.tree.add(real_filter, shared)
+                shared.members.append(sub)
+        return group is not None
+
+    def _unsubscribe(self, session, topic_filter):
+        sub = session.subscriptions.pop(topic_filter, None)
+        if sub is None:
+            return
+        if not topic_filter.startswith("$share/"):
+            self.tree.remove(topic_filter, sub)
+            return
+        _, group, real_filter = topic_filter.split("/", 2)
+        shared = self.groups.get((group, real_filter))
+        if shared is None:
+            return
+        shared.members.remove(sub)
+        if not shared.members:
+            del self.groups[(group, real_filter)]
+            self.tree.remove(real_filter, shared)
+
+    def handle_unsubscribe(self, session, body):
+        mid = _short.unpack_from(body)[0]
+        offset = 2
+        with self.lock:
+            while offset < len(body):
+                topic_filter, offset = decode_string(body, offset)
+                self._unsubscribe(session, topic_filter)
+        session.send(packet(UNSUBACK, 0, _short.pack(mid)))
+
+
+def main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+            description="Run the culexx test broker in the foreground.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    opts = parser.parse_args(args)
+
+    broker = Broker(opts.host, opts.port).start()
+    sys.stdout.write("Broker listening on %s:%s\n" % (opts.host, broker.port))
+    sys.stdout.flush()
+    try:
+        while broker.thread.is_alive():
+            broker.thread.join(1.0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -
+#
+# This file is part of culexx released under the MIT license.
+# See the NOTICE for more information.
+
+import threading
+import time
+from collections import OrderedDict
+
+from .topics import TopicTree, validate_filter
+
+
+class LastValueCache(object):
+    """\
+    Keeps the latest payload of every topic a client receives.
+
+    Lookups by topic are a dict access. Wildcard queries walk a tree of
+    the cached topics and only visit the branches the filter can match.
+    At most ``max_entries`` topics are kept, the least recently updated
+    or read going first, and with a ``ttl`` values older than ``ttl``
+    seconds are dropped when they're looked at or on ``expire``.
+
+    Callbacks registered with ``on_change`` run after an update that
+    changed the payload of a topic matching their filter, or removed it,
+    with the topic, the new payload (None once removed) and the previous
+    one.
+    """
+
+    def __init__(self, max_entries=10000, ttl=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        # topic -> (payload, timestamp, qos, retain)
+        self.entries = OrderedDict()
+        self.tree = TopicTree()
+        self.listeners = TopicTree()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, topic):
+        return self.get(topic) is not None
+
+    def on_change(self, callback, topic_filter="#"):
+        validate_filter(topic_filter)
+        with self.lock:
+            self.listeners.add(topic_filter, callback)
+
+    def remove_listener(self, callback, topic_filter="#"):
+        with self.lock:
+            return self.listeners.remove(topic_filter, callback)
+
+    def record(self, msg, received=None):
+        return self.update(msg.topic, msg.payload, received, msg.qos,
+                msg.retain)
+
+    def update(self, topic, payload, timestamp=None, qos=0, retain=False):
+        """\
+        Store ``payload`` as the value of ``topic``. An empty retained
+        payload removes it, as it clears the retained message on the
+        broker. Returns True if the value changed.
+        """
+        timestamp = timestamp or time.time()
+        with self.lock:
+            old = self.entries.pop(topic, None)
+            if retain and not payload:
+                if old is None:
+                    return False
+                self.tree.remove(topic, topic)
+                payload = None
+            else:
+                self.entries[topic] = (payload, timestamp, qos, retain)
+                if old is None:
+                    self.tree.add(topic, topic)
+                    if len(self.entries) > self.max_entries:
+                        self.evict()
+            old_payload = old[0] if old is not None else None
+            if old_payload == payload:
+                return False
+            listeners = self.listeners.match(topic)
+
+        for callback in listeners:
+            callback(topic, payload, old_payload)
+        return True
+
+    def evict(self):
+        topic, _ = self.entries.popitem(last=False)
+        self.tree.remove(topic, topic)
+        self.evicted += 1
+
+    def expired(self, entry, now):
+        return self.ttl and entry[1] < now - self.ttl
+
+    def entry(self, topic):
+        """\
+        Return (payload, timestamp, qos, retain) for ``topic`` or None.
+        """
+        with self.lock:
+            entry = self.entries.pop(topic, None)
+            if entry is None:
+                return None
+            if self.expired(entry, time.time()):
+                self.tree.remove(topic, topic)
+                return None
+            self.entries[topic] = entry
+            return entry
+
+    def get(self, topic, default=None):
+        entry = self.entry(topic)
+        return entry[0] if entry is not None else default
+
+    def query(self, topic_filter):
+        """\
+        Return {topic: payload} for the cached topics matching
+        ``topic_filter``.
+        """
+        validate_filter(topic_filter)
+        now = time.time()
+        result = {}
+        with self.lock:
+            for topic in self.tree.find(topic_filter):
+                entry = self.entries[topic]
+                if not self.expired(entry, now):
+                    result[topic] = entry[0]
+        return result
+
+    def expire(self, now=None):
+        """\
+        Drop the values older than the TTL. Returns how many were dropped.
+        """
+        if not self.ttl:
+            return 0
+        now = now or time.time()
+        with self.lock:
+            stale = [t for t, e in self.entries.items()
+                    if self.expired(e, now)]
+            for topic in stale:
+                del self.entries[topic]
+                self.tree.remove(topic, topic)
+        return len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tree = TopicTree()
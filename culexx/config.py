@@ -5,19 +5,13 @@
 
 import copy
 import grp
-import inspect
-try:
-    import argparse
-except ImportError: # python 2.6
-    from . import argparse_compat as argparse
 import os
 import pwd
 import sys
 import textwrap
-import logging
 
 from . import __version__
-from errors import ConfigError
+from .errors import ConfigError
 from . import util
 from gunicorn import six
 
@@ -34,10 +28,9 @@ def make_settings(ignore=None):
     settings = {}
     ignore = ignore or ()
     for s in KNOWN_SETTINGS:
-        setting = s()
-        if setting.name in ignore:
+        if s.name in ignore:
             continue
-        settings[setting.name] = setting.copy()
+        settings[s.name] = s()
     return settings
 
 class Config(object):
@@ -64,6 +57,12 @@ class Config(object):
         self.settings[name].set(value)
 
     def parser(self):
+        # argparse is only needed on the command line
+        try:
+            import argparse
+        except ImportError: # python 2.6
+            from . import argparse_compat as argparse
+
         kwargs = {
             "usage": self.usage,
             "prog": self.prog
@@ -169,7 +168,7 @@ class SettingMeta(type):
 
 class Setting(object):
     name = None
-    value = None
+    live = False
     section = None
     cli = None
     validator = None
@@ -181,11 +180,14 @@ class Setting(object):
     desc = None
     nargs = None
     const = None
+    # validate a default of None too, to resolve it on first read
+    lazy_default = False
 
 
     def __init__(self):
-        if self.default is not None:
-            self.set(self.default)
+        # defaults are validated on first use, most are never read
+        self._pending = self.default is not None or self.lazy_default
+        self._value = None
 
     def add_option(self, parser):
         if not self.cli:
@@ -220,12 +222,24 @@ class Setting(object):
     def copy(self):
         return copy.copy(self)
 
+    @property
+    def value(self):
+        return self.get()
+
     def get(self):
-        return self.value
+        if self._pending:
+            self._pending = False
+            self._value = self.validator(self.default)
+        return self._value
 
     def set(self, val):
         assert six.callable(self.validator), "Invalid validator: %s" % self.name
-        self.value = self.validator(val)
+        self._value = self.validator(val)
+        self._pending = False
+
+    def set_validated(self, val):
+        self._value = val
+        self._pending = False
 
     def __lt__(self, other):
         return (self.section == other.section and
@@ -265,6 +279,13 @@ def validate_pos_int(val):
     return val
 
 
+def validate_pos_float(val):
+    val = float(val)
+    if val < 0:
+        raise ValueError("Value must be positive: %s" % val)
+    return val
+
+
 def validate_string(val):
     if val is None:
         return None
@@ -294,6 +315,7 @@ def validate_string_to_list(val):
 
 
 def validate_class(val):
+    import inspect
     if inspect.isfunction(val) or inspect.ismethod(val):
         val = val()
     if inspect.isclass(val):
@@ -303,6 +325,7 @@ def validate_class(val):
 
 def validate_callable(arity):
     def _validate_callable(val):
+        import inspect
         if isinstance(val, six.string_types):
             try:
                 mod_name, obj_name = val.rsplit(".", 1)
@@ -353,6 +376,28 @@ def validate_group(val):
         except KeyError:
             raise ConfigError("No such group: '%s'" % val)
 
+def validate_cpu(val):
+    if val is None:
+        return None
+    cpu = validate_pos_int(val)
+    if cpu not in util.available_cpus():
+        raise ConfigError("CPU %d is not available" % cpu)
+    return cpu
+
+
+def validate_cpu_list(val):
+    val = validate_string(val)
+    if not val or val == "auto":
+        return val
+    try:
+        cpus = util.parse_cpu_list(val)
+    except ValueError:
+        raise ConfigError("Invalid CPU list: %r" % val)
+    if not cpus:
+        raise ConfigError("Invalid CPU list: %r" % val)
+    return val
+
+
 def validate_chdir(val):
     # valid if the value is a string
     val = validate_string(val)
@@ -384,6 +429,21 @@ def validate_file(val):
     return path
 
 
+def changed_settings(old, new):
+    """\
+    Names of the settings whose value differs between two configurations.
+    Functions defined in config files compare by their code.
+    """
+    changed = []
+    for name, setting in new.settings.items():
+        a = getattr(old.settings[name].get(), "__code__", None) or \
+                old.settings[name].get()
+        b = getattr(setting.get(), "__code__", None) or setting.get()
+        if a != b:
+            changed.append(name)
+    return sorted(changed)
+
+
 def get_default_config_file():
     config_path = os.path.join(os.path.abspath(os.getcwd()),
             'culexx.conf.py')
@@ -415,6 +475,40 @@ class ConfigFile(Setting):
         application specific configuration.
         """
 
+class ConfigCache(Setting):
+    name = "config_cache"
+    section = "Config File"
+    cli = ["--config-cache"]
+    validator = validate_bool
+    action = "store_true"
+    default = False
+    desc = """\
+        Cache the compiled config file on disk next to it.
+
+        The code is stored in ``<config file>.culexx-cache`` together with
+        the mtime and size of the file it was compiled from, and is reused
+        by later starts and workers while the file is unchanged. Nothing is
+        written with ``PYTHONDONTWRITEBYTECODE`` set. The compiled code and
+        the validated settings are always cached in memory.
+        """
+
+class WatchConfig(Setting):
+    name = "watch_config"
+    section = "Config File"
+    cli = ["--watch-config"]
+    validator = validate_bool
+    action = "store_true"
+    default = False
+    desc = """\
+        Watch the config file and apply changed settings without a restart.
+
+        inotify is used where available, otherwise the file is checked once
+        a second. Settings such as the log level, topic handlers, worker
+        counts and limits are applied live, without reconnecting to the
+        broker. Changes to any other setting are logged as requiring a
+        restart and ignored until then.
+        """
+
 class Debug(Setting):
     name = "debug"
     section = "Debugging"
@@ -429,12 +523,281 @@ class Debug(Setting):
         handling that's sent to clients.
         """
 
+class FlightRecorderSize(Setting):
+    name = "flight_recorder_size"
+    section = "Debugging"
+    cli = ["--flight-recorder-size"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 4096
+    desc = """\
+        The number of recent messages and connection events each worker
+        keeps in memory.
+
+        The records are written to ``--diagnostics-dir`` when a worker
+        crashes, when a handler raises (at most once a minute) and when the
+        master receives SIGTTIN. Set to 0 to turn the recorder off.
+        """
+
+class DiagnosticsDir(Setting):
+    name = "diagnostics_dir"
+    section = "Debugging"
+    cli = ["--diagnostics-dir"]
+    meta = "DIR"
+    validator = validate_string
+    default = None
+    desc = """\
+        The directory flight recorder dumps, profiles and memory reports
+        are written to.
+
+        Defaults to the system's temporary directory.
+        """
+
+class ProfileDuration(Setting):
+    name = "profile_duration"
+    live = True
+    section = "Debugging"
+    cli = ["--profile-duration"]
+    meta = "FLOAT"
+    validator = validate_pos_float
+    type = float
+    default = 30.0
+    desc = """\
+        How long the sampling profiler runs, in seconds.
+
+        The profiler is started in the workers when the master receives
+        SIGUSR2, in a single worker when it receives SIGUSR2 itself, or by
+        ``POST /profile?seconds=N`` on the ``--metrics-bind`` address. It
+        writes a ``.folded`` file of collapsed stacks to
+        ``--diagnostics-dir``, with the frames of topic handlers labelled
+        by handler and topic.
+        """
+
+class ProfileInterval(Setting):
+    name = "profile_interval"
+    live = True
+    section = "Debugging"
+    cli = ["--profile-interval"]
+    meta = "FLOAT"
+    validator = validate_pos_float
+    type = float
+    default = 0.01
+    desc = """\
+        The time between two samples of the profiler, in seconds.
+        """
+
+class TraceSampleRate(Setting):
+    name = "trace_sample_rate"
+    section = "Metrics"
+    cli = ["--trace-sample-rate"]
+    meta = "FLOAT"
+    validator = validate_pos_float
+    type = float
+    default = 0
+    desc = """\
+        The share of published messages, between 0 and 1, traced from
+        ``publish`` to the end of their handlers.
+
+        Traced payloads carry a small envelope with a trace id and the
+        publish time, which receivers take off before the handlers run.
+        The time in transit, queued, in the handlers and in total is added
+        to the ``culexx_trace_seconds`` histograms of ``--metrics-bind``.
+        Every client exchanging traced messages must have tracing on. 0
+        turns tracing off.
+        """
+
+class TraceSlow(Setting):
+    name = "trace_slow"
+    section = "Metrics"
+    cli = ["--trace-slow"]
+    meta = "FLOAT"
+    validator = validate_pos_float
+    type = float
+    default = 0
+    desc = """\
+        Log traced messages taking longer than this many seconds from
+        publish to the end of their handlers, with the time of each stage.
+
+        0 doesn't log them.
+        """
+
+class MemoryProfile(Setting):
+    name = "memory_profile"
+    section = "Debugging"
+    cli = ["--memory-profile"]
+    validator = validate_bool
+    action = "store_true"
+    default = False
+    desc = """\
+        Track memory growth by topic handler in the workers from the start.
+
+        Each ``POST /memory`` on the ``--metrics-bind`` address makes the
+        workers write to ``--diagnostics-dir`` the objects their topic
+        handlers left alive since the last report and since tracking
+        started, along with the sizes of the internal queues and tables.
+        Without this setting tracking starts with the first request.
+
+        Objects are counted by type around one in
+        ``--memory-profile-sample`` calls of each handler, which walks the
+        whole heap. With tracemalloc (Python 3.4+) allocations are traced
+        too and the report adds bytes and allocation sites.
+        """
+
+class MemoryProfileFrames(Setting):
+    name = "memory_profile_frames"
+    section = "Debugging"
+    cli = ["--memory-profile-frames"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 16
+    desc = """\
+        The number of frames tracemalloc keeps per traced allocation.
+        """
+
+class MemoryProfileSample(Setting):
+    name = "memory_profile_sample"
+    section = "Debugging"
+    cli = ["--memory-profile-sample"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 100
+    desc = """\
+        Count the objects around one in this many calls of each handler
+        while tracking memory growth.
+        """
+
+class MemoryProfileInterval(Setting):
+    name = "memory_profile_interval"
+    live = True
+    section = "Debugging"
+    cli = ["--memory-profile-interval"]
+    meta = "FLOAT"
+    validator = validate_pos_float
+    type = float
+    default = 0
+    desc = """\
+        Write a memory report every this many seconds while tracing.
+
+        0 only writes them on request.
+        """
+
+class TrafficDir(Setting):
+    name = "traffic_dir"
+    section = "Debugging"
+    cli = ["--traffic-dir"]
+    meta = "DIR"
+    validator = validate_string
+    default = None
+    desc = """\
+        Record the messages every worker receives to segment files in this
+        directory.
+
+        The segments can be replayed through the handlers of an
+        application or republished to a broker with ``python -m
+        culexx.traffic``, at the recorded pace, faster or as fast as
+        possible.
+        """
+
+class TrafficSegmentSize(Setting):
+    name = "traffic_segment_size"
+    section = "Debugging"
+    cli = ["--traffic-segment-size"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 64 * 1024 * 1024
+    desc = """\
+        The size in bytes past which a new traffic segment is started.
+        """
+
+class ArchiveDir(Setting):
+    name = "archive_dir"
+    section = "Archive"
+    cli = ["--archive-dir"]
+    meta = "DIR"
+    validator = validate_string
+    default = None
+    desc = """\
+        Archive every message the workers receive in this directory.
+
+        Messages are written in batches by a background thread of each
+        worker, to segment files with a sparse index by topic and time.
+        Handlers read them back with ``self.archive.read(topic_filter, t0,
+        t1)``.
+        """
+
+class ArchiveSegmentSize(Setting):
+    name = "archive_segment_size"
+    section = "Archive"
+    cli = ["--archive-segment-size"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 64 * 1024 * 1024
+    desc = """\
+        The size in bytes past which a new archive segment is started.
+        """
+
+class ArchiveRetentionBytes(Setting):
+    name = "archive_retention_bytes"
+    section = "Archive"
+    cli = ["--archive-retention-bytes"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 0
+    desc = """\
+        Remove the oldest archive segments once the archive is larger than
+        this many bytes.
+
+        0 doesn't limit the size.
+        """
+
+class ArchiveRetentionAge(Setting):
+    name = "archive_retention_age"
+    section = "Archive"
+    cli = ["--archive-retention-age"]
+    meta = "FLOAT"
+    validator = validate_pos_float
+    type = float
+    default = 0
+    desc = """\
+        Remove archive segments last written more than this many seconds
+        ago.
+
+        0 keeps them whatever their age.
+        """
+
+class MetricsBind(Setting):
+    name = "metrics_bind"
+    section = "Metrics"
+    cli = ["--metrics-bind"]
+    meta = "ADDRESS"
+    validator = validate_string
+    default = None
+    desc = """\
+        Collect metrics in the workers and serve them from the master.
+
+        ``HOST:PORT`` serves them over HTTP on a TCP address, ``unix:PATH``
+        over HTTP on a Unix socket (``curl --unix-socket PATH
+        http://localhost/``). The text format is the one Prometheus reads:
+        messages and bytes in and out per topic, handler latency and
+        publish to PUBACK latency histograms, reconnects and per worker
+        queue depths, summed over the workers.
+
+        ``POST /profile?seconds=N`` starts the profiler in the workers,
+        ``POST /memory`` asks them for a memory report.
+        """
+
 class Chdir(Setting):
     name = "chdir"
     section = "Server Mechanics"
     cli = ["--chdir"]
     validator = validate_chdir
-    default = util.getcwd()
+    default = "."
     desc = """\
         Chdir to specified directory before apps loading.
         """
@@ -486,13 +849,30 @@ class Pidfile(Setting):
         If not set, no PID file will be written.
         """
 
+class PreloadApp(Setting):
+    name = "preload_app"
+    section = "Server Mechanics"
+    cli = ["--preload"]
+    validator = validate_bool
+    action = "store_true"
+    default = False
+    desc = """\
+        Load application code before the worker processes are forked.
+
+        The application is imported once in the master and the workers share
+        its code and read-only data through copy-on-write pages, which saves
+        memory and speeds up worker boot. The startup time and memory of
+        every worker are logged when it is ready.
+        """
+
 class User(Setting):
     name = "user"
     section = "Server Mechanics"
     cli = ["-u", "--user"]
     meta = "USER"
     validator = validate_user
-    default = os.geteuid()
+    default = None
+    lazy_default = True
     desc = """\
         Switch worker processes to run as this user.
 
@@ -507,7 +887,8 @@ class Group(Setting):
     cli = ["-g", "--group"]
     meta = "GROUP"
     validator = validate_group
-    default = os.getegid()
+    default = None
+    lazy_default = True
     desc = """\
         Switch worker process to run as this group.
 
@@ -534,8 +915,327 @@ class Umask(Setting):
         "0xFF", "0022" are valid for decimal, hex, and octal representations)
         """
 
+class TopicHandlers(Setting):
+    name = "topic_handlers"
+    live = True
+    section = "Application"
+    validator = validate_dict
+    default = {}
+    desc = """\
+        Topic handlers added to those of the application's ``Meta``.
+
+        A dict of topic to handler method name. Topics added or removed
+        while running are subscribed or unsubscribed on the existing
+        connection.
+        """
+
+class Workers(Setting):
+    name = "workers"
+    live = True
+    section = "Worker Processes"
+    cli = ["-w", "--workers"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 1
+    desc = """\
+        The number of worker processes to start with.
+
+        Each worker loads the application and holds its own connection to
+        the broker. When autoscaling is enabled this is only the initial
+        count, clamped between ``min_workers`` and ``max_workers``.
+        """
+
+class MinWorkers(Setting):
+    name = "min_workers"
+    live = True
+    section = "Worker Processes"
+    cli = ["--min-workers"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 1
+    desc = """\
+        The lower bound on the worker count when autoscaling.
+        """
+
+class MaxWorkers(Setting):
+    name = "max_workers"
+    live = True
+    section = "Worker Processes"
+    cli = ["--max-workers"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 0
+    desc = """\
+        The upper bound on the worker count when autoscaling.
+
+        0 disables autoscaling and the arbiter keeps exactly ``workers``
+        processes running.
+        """
+
+class ScaleUpBacklog(Setting):
+    name = "scale_up_backlog"
+    live = True
+    section = "Worker Processes"
+    cli = ["--scale-up-backlog"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 100
+    desc = """\
+        Per worker dispatch backlog above which a worker is added.
+
+        The backlog is the number of received messages a worker has not yet
+        handed to its topic handlers.
+        """
+
+class ScaleDownBacklog(Setting):
+    name = "scale_down_backlog"
+    live = True
+    section = "Worker Processes"
+    cli = ["--scale-down-backlog"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 10
+    desc = """\
+        Per worker dispatch backlog below which a worker is retired.
+
+        The backlog is measured as if one worker less were running, and this
+        should stay well below ``scale_up_backlog`` so the worker count
+        doesn't flap.
+        """
+
+class ScaleLatency(Setting):
+    name = "scale_latency"
+    live = True
+    section = "Worker Processes"
+    cli = ["--scale-latency"]
+    meta = "FLOAT"
+    validator = validate_pos_float
+    type = float
+    default = 0.5
+    desc = """\
+        Average handler latency in seconds above which a worker is added.
+
+        Workers are only retired while latency is below half of this value.
+        0 ignores handler latency when scaling.
+        """
+
+class ScaleUpCooldown(Setting):
+    name = "scale_up_cooldown"
+    live = True
+    section = "Worker Processes"
+    cli = ["--scale-up-cooldown"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 10
+    desc = """\
+        Seconds to wait after adding workers before adding more.
+        """
+
+class ScaleDownCooldown(Setting):
+    name = "scale_down_cooldown"
+    live = True
+    section = "Worker Processes"
+    cli = ["--scale-down-cooldown"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 60
+    desc = """\
+        Seconds to wait after any change in the worker count before a worker
+        is retired.
+        """
+
+class MaxMessages(Setting):
+    name = "max_messages"
+    live = True
+    section = "Worker Processes"
+    cli = ["--max-messages"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 0
+    desc = """\
+        The maximum number of messages a worker will handle before it is
+        recycled.
+
+        A replacement worker is started and subscribed before the old one
+        unsubscribes, so throughput doesn't dip. This is a simple method to
+        help limit the damage of memory leaks.
+
+        If this is set to zero (the default) then the automatic worker
+        recycling by message count is disabled.
+        """
+
+class MaxMessagesJitter(Setting):
+    name = "max_messages_jitter"
+    live = True
+    section = "Worker Processes"
+    cli = ["--max-messages-jitter"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 0
+    desc = """\
+        The maximum jitter to add to the ``max_messages`` setting.
+
+        The jitter causes the limit per worker to be randomized by
+        ``randint(0, max_messages_jitter)``. This is intended to stagger
+        worker restarts to avoid all workers recycling at the same time.
+        """
+
+class MaxRss(Setting):
+    name = "max_rss"
+    live = True
+    section = "Worker Processes"
+    cli = ["--max-rss"]
+    meta = "MB"
+    validator = validate_pos_int
+    type = int
+    default = 0
+    desc = """\
+        The resident memory in megabytes above which a worker is recycled.
+
+        Replacement works as for ``max_messages``. 0 disables it.
+        """
+
+class CpuAffinity(Setting):
+    name = "cpu_affinity"
+    section = "Worker Processes"
+    cli = ["--cpu-affinity"]
+    meta = "CPUS"
+    validator = validate_cpu_list
+    default = None
+    desc = """\
+        Pin every worker to its own set of CPUs.
+
+        Either ``auto`` to use all the CPUs the master may run on, or a CPU
+        list such as ``0-3,8-11``. Each worker gets ``cpus_per_worker`` CPUs
+        from the list, assigned round-robin by worker slot so a replacement
+        worker takes over the CPUs of the one it replaces. The CPU of the
+        master, if pinned, is left out.
+
+        Linux only: uses ``os.sched_setaffinity``, or the one of libc on
+        Python 2.
+        """
+
+class CpusPerWorker(Setting):
+    name = "cpus_per_worker"
+    section = "Worker Processes"
+    cli = ["--cpus-per-worker"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 1
+    desc = """\
+        The number of CPUs each worker is pinned to with ``cpu_affinity``.
+        """
+
+class MasterCpu(Setting):
+    name = "master_cpu"
+    section = "Worker Processes"
+    cli = ["--master-cpu"]
+    meta = "INT"
+    validator = validate_cpu
+    type = int
+    default = None
+    desc = """\
+        Pin the master process to this CPU and keep workers off it.
+
+        Without ``cpu_affinity`` the workers share all the other CPUs the
+        master may run on.
+        """
+
+class Fanout(Setting):
+    name = "fanout"
+    section = "Worker Processes"
+    cli = ["--fanout"]
+    validator = validate_bool
+    action = "store_true"
+    default = False
+    desc = """\
+        Ingest messages in the master and fan them out to the workers.
+
+        The master holds the only subscription and writes every message into
+        the shared memory ring of one worker, chosen by consistent hashing of
+        ``fanout_key``. Messages with the same key are handled in order by
+        the same worker and no extra broker connections are made.
+
+        Workers don't connect to the broker in this mode and the worker
+        count is fixed to ``workers``. They can't answer requests either, an
+        application with RPC handlers doesn't start, and ``publish`` from a
+        handler or stream raises ``MQTTException``.
+        """
+
+class FanoutKey(Setting):
+    name = "fanout_key"
+    section = "Worker Processes"
+    validator = validate_callable(2)
+    type = six.callable
+    default = None
+    desc = """\
+        Called with the topic and payload of a message to get the key it is
+        hashed by with ``fanout``. The topic is used when not set.
+
+        The callable needs to accept two instance variables for the topic
+        and the payload.
+        """
+
+class RingSize(Setting):
+    name = "ring_size"
+    section = "Worker Processes"
+    cli = ["--ring-size"]
+    meta = "BYTES"
+    validator = validate_pos_int
+    type = int
+    default = 4 * 1024 * 1024
+    desc = """\
+        The size in bytes of the shared memory ring of each worker with
+        ``fanout``.
+
+        When a worker falls behind and its ring fills up the master stops
+        reading from the broker until there is room again.
+        """
+
+class Timeout(Setting):
+    name = "timeout"
+    live = True
+    section = "Worker Processes"
+    cli = ["-t", "--timeout"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 30
+    desc = """\
+        Workers silent for more than this many seconds are killed and
+        restarted.
+        """
+
+class GracefulTimeout(Setting):
+    name = "graceful_timeout"
+    live = True
+    section = "Worker Processes"
+    cli = ["--graceful-timeout"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 30
+    desc = """\
+        Timeout for graceful workers restart.
+
+        After receiving a restart signal, workers unsubscribe and have this
+        much time to finish handling the messages they already received.
+        Workers still alive after the timeout are force killed.
+        """
+
 class ErrorLog(Setting):
     name = "errorlog"
+    live = True
     section = "Logging"
     cli = ["--error-logfile", "--log-file"]
     meta = "FILE"
@@ -549,6 +1249,7 @@ class ErrorLog(Setting):
 
 class Loglevel(Setting):
     name = "loglevel"
+    live = True
     section = "Logging"
     cli = ["--log-level"]
     meta = "LEVEL"
@@ -566,17 +1267,110 @@ class Loglevel(Setting):
         * critical
         """
 
+class LogQueue(Setting):
+    name = "log_queue"
+    section = "Logging"
+    cli = ["--log-queue"]
+    validator = validate_bool
+    action = "store_true"
+    default = False
+    desc = """\
+        Write logs from a background thread.
+
+        Records are put on a bounded queue and formatted and written by a
+        listener thread, so logging never blocks the network thread or the
+        message handlers on I/O. When the queue is full records are dropped
+        and the number of dropped records is logged.
+        """
+
+class LogQueueSize(Setting):
+    name = "log_queue_size"
+    section = "Logging"
+    cli = ["--log-queue-size"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 10000
+    desc = """\
+        The number of records the log queue holds before dropping them.
+        """
+
+class LogBufferSize(Setting):
+    name = "log_buffer_size"
+    live = True
+    section = "Logging"
+    cli = ["--log-buffer-size"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 65536
+    desc = """\
+        The number of bytes of formatted records a log file buffers before
+        writing them out.
+
+        Errors and critical records are written right away. Set to 0 to
+        write every record as it comes.
+        """
+
+class LogFlushInterval(Setting):
+    name = "log_flush_interval"
+    live = True
+    section = "Logging"
+    cli = ["--log-flush-interval"]
+    meta = "FLOAT"
+    validator = validate_pos_float
+    type = float
+    default = 1.0
+    desc = """\
+        The longest time in seconds buffered records wait before they are
+        written to the log file.
+
+        Records are written, never fsynced, so they reach the disk whenever
+        the kernel writes back the page cache.
+        """
+
+class LogMaxBytes(Setting):
+    name = "log_max_bytes"
+    live = True
+    section = "Logging"
+    cli = ["--log-max-bytes"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 0
+    desc = """\
+        Rotate the log file once it grows past this many bytes.
+
+        The file is renamed to ``FILE.1``, older backups are shifted up to
+        ``--log-backup-count``. 0 leaves rotation to an external tool such
+        as logrotate, which should send SIGUSR1 to the master so the files
+        are reopened.
+        """
+
+class LogBackupCount(Setting):
+    name = "log_backup_count"
+    live = True
+    section = "Logging"
+    cli = ["--log-backup-count"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 5
+    desc = """\
+        The number of rotated log files to keep.
+        """
+
 class LoggerClass(Setting):
     name = "logger_class"
     section = "Logging"
     cli = ["--logger-class"]
     meta = "STRING"
     validator = validate_class
-    default = "lib.culexx.clogging.Logger"
+    default = "culexx.logging.Logger"
     desc = """\
         The logger you want to use to log events in culexx.
 
-        The default class (``lib.culexx.clogging.Logger``) handle most of
+        The default class (``culexx.logging.Logger``) handle most of
         normal usages in logging. It provides error and access logging.
 
         You can provide your own worker by giving culexx a
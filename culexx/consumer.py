@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -
+#
+# This file is part of culexx released under the MIT license.
+# See the NOTICE for more information.
+
+import collections
+import threading
+import time
+
+from .topics import validate_filter
+
+# what a full iterator does with the next message
+PAUSE = "pause"
+DROP = "drop"
+
+
+class MessageIterator(object):
+    """\
+    The messages on a topic filter, as an iterator and an async iterator,
+    buffered in a queue of at most ``maxsize`` messages::
+
+        for msg in mosq.messages("/orders/+", maxsize=100):
+            ...
+
+        async for msg in mosq.messages("/orders/+"):
+            ...
+
+    When the queue is full the ``pause`` policy holds the thread
+    delivering the message until the consumer takes one. When that is
+    the network thread of the client, nothing more is read from the
+    socket and the broker is slowed down by TCP flow control. It waits
+    at most ``timeout`` seconds, then drops the message: keepalives
+    aren't sent meanwhile either. The ``drop`` policy drops the message
+    right away. Dropped messages are counted in ``dropped``. While it
+    pauses, ``on_wait`` is called about every ``WAIT_INTERVAL`` seconds so
+    the thread can keep up its heartbeat.
+
+    Iteration ends once the iterator is closed and the queue is empty.
+    """
+
+    WAIT_INTERVAL = 1.0
+
+    def __init__(self, topic_filter, maxsize=1000, policy=PAUSE,
+            timeout=None, on_wait=None):
+        validate_filter(topic_filter)
+        if policy not in (PAUSE, DROP):
+            raise ValueError("unknown policy %r" % policy)
+        self.topic_filter = topic_filter
+        self.maxsize = maxsize
+        self.policy = policy
+        self.timeout = timeout
+        self.on_wait = on_wait
+        self.cond = threading.Condition()
+        self.items = collections.deque()
+        # (event loop, future) of the async consumers waiting
+        self.waiters = collections.deque()
+        self.closed = False
+        self.dropped = 0
+        self.on_close = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def put(self, msg):
+        """\
+        Queue ``msg`` for the consumer. Returns False if it was dropped.
+        """
+        with self.cond:
+            if self.closed:
+                return False
+            while self.waiters:
+                loop, future = self.waiters.popleft()
+                if not future.done():
+                    loop.call_soon_threadsafe(self._resolve, future, msg)
+                    return True
+
+            if len(self.items) >= self.maxsize:
+                if self.policy == DROP:
+                    self.dropped += 1
+                    return False
+                deadline = None
+                if self.timeout is not None:
+                    deadline = time.time() + self.timeout
+                while len(self.items) >= self.maxsize and not self.closed:
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self.dropped += 1
+                            return False
+                    if self.on_wait is None:
+                        self.cond.wait(remaining)
+                        continue
+                    self.cond.wait(min(remaining or self.WAIT_INTERVAL,
+                        self.WAIT_INTERVAL))
+                    self.cond.release()
+                    try:
+                        self.on_wait()
+                    finally:
+                        self.cond.acquire()
+                if self.closed:
+                    return False
+            self.items.append(msg)
+            self.cond.notify_all()
+            return True
+
+    def _resolve(self, future, msg):
+        if not future.cancelled():
+            future.set_result(msg)
+            return
+        # the consumer is gone, the next one gets the message unless the
+        # queue filled up meanwhile: this runs in the event loop, which
+        # must not wait for room
+        with self.cond:
+            while self.waiters:
+                loop, waiter = self.waiters.popleft()
+                if not waiter.done():
+                    loop.call_soon_threadsafe(self._resolve, waiter, msg)
+                    return
+            if len(self.items) >= self.maxsize:
+                self.dropped += 1
+                return
+            self.items.appendleft(msg)
+            self.cond.notify_all()
+
+    def get(self, timeout=None):
+        """\
+        Return the next message, waiting at most ``timeout`` seconds when
+        there is none. Raises StopIteration once closed and drained.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.cond:
+            while not self.items:
+                if self.closed:
+                    raise StopIteration()
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                self.cond.wait(remaining)
+            msg = self.items.popleft()
+            self.cond.notify_all()
+            return msg
+
+    def __next__(self):
+        return self.get()
+
+    next = __next__
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        import asyncio
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        with self.cond:
+            if self.items:
+                future.set_result(self.items.popleft())
+                self.cond.notify_all()
+            elif self.closed:
+                future.set_exception(StopAsyncIteration())
+            else:
+                self.waiters.append((loop, future))
+        return future
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+            waiters, self.waiters = self.waiters, collections.deque()
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(self._stop, future)
+        if self.on_close is not None:
+            self.on_close(self)
+
+    def _stop(self, future):
+        if not future.done():
+            future.set_exception(StopAsyncIteration())
@@ -4,3 +4,11 @@ class AppImportError(Exception):
 
 class ConfigError(Exception):
     """ Exception raised when loading an application """
+
+class HaltServer(BaseException):
+    def __init__(self, reason, exit_status=1):
+        self.reason = reason
+        self.exit_status = exit_status
+
+    def __str__(self):
+        return "<HaltServer %r %d>" % (self.reason, self.exit_status)
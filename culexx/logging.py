@@ -1,6 +1,18 @@
+from __future__ import absolute_import
+
+import errno
+import fcntl
 import os, sys
 import logging
-from logging.config import fileConfig
+import threading
+import time
+
+try:
+    import queue
+except ImportError: # python 2
+    import Queue as queue
+
+from . import util
 
 LOGGING_DEFAULTS = {
     'version': 1,
@@ -47,6 +59,277 @@ ch.setLevel(logging.INFO)
 ch.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 default_logger.addHandler(ch)
 
+class QueueHandler(logging.Handler):
+    """\
+    Hands records to a background thread that formats and writes them
+    through ``target``, so the thread logging never waits on I/O.
+
+    The queue is bounded: when it is full records are dropped and counted
+    instead of blocking the caller, and the count is logged once there is
+    room again.
+    """
+
+    def __init__(self, target, maxsize=10000):
+        logging.Handler.__init__(self, target.level)
+        self.target = target
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self.reported = 0
+        self.drop_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name="culexx-log")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        if record.exc_info and not record.exc_text:
+            # the frames of a traceback don't wait for the listener
+            record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.drop_lock:
+                self.dropped += 1
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            if self.dropped != self.reported:
+                self.report_dropped(record.name)
+            self.target.handle(record)
+
+    def report_dropped(self, name):
+        with self.drop_lock:
+            count = self.dropped - self.reported
+            self.reported = self.dropped
+        record = logging.LogRecord(name, logging.WARNING, __file__, 0,
+                "Dropped %d log records, the log queue was full",
+                (count,), None)
+        self.target.handle(record)
+
+    def setFormatter(self, fmt):
+        self.target.setFormatter(fmt)
+
+    def after_fork(self):
+        """\
+        Make the copy a forked process inherited safe to drop. The
+        listener thread didn't survive the fork and may have held the
+        locks, the records left in the queue are written by the parent.
+        """
+        self.createLock()
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.drop_lock = threading.Lock()
+        _after_fork(self.target)
+
+    def flush(self):
+        self.target.flush()
+
+    def stop(self):
+        """\
+        Write out the queue and stop the listener, leaving ``target`` open.
+        """
+        if self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=1.0)
+            except queue.Full:
+                pass
+            self.thread.join(1.0)
+        self.target.flush()
+
+    def close(self):
+        self.stop()
+        self.target.close()
+        logging.Handler.close(self)
+
+
+class BufferedFileHandler(logging.Handler):
+    """\
+    Appends formatted records to a file through an in-memory buffer.
+
+    The buffer is written out once it holds ``buffer_size`` bytes, once
+    ``flush_interval`` seconds passed since the last write, or right away
+    for records at ``flush_level`` and above. The file is written to but
+    never fsynced.
+
+    With ``max_bytes`` set the file is rotated by size. The arbiter and the
+    workers append to the same file, so the rotation is done under a lock
+    and a process finding the file was rotated by another one just reopens
+    it.
+    """
+
+    def __init__(self, filename, buffer_size=65536, flush_interval=1.0,
+            max_bytes=0, backup_count=5, flush_level=logging.ERROR):
+        logging.Handler.__init__(self)
+        self.filename = os.path.abspath(filename)
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_level = flush_level
+        self.buffer = []
+        self.buffered = 0
+        self.last_flush = time.time()
+        self.pid = os.getpid()
+        self.fd = None
+        self.open()
+
+    @classmethod
+    def from_config(cls, filename, cfg):
+        return cls(filename, buffer_size=cfg.log_buffer_size,
+                flush_interval=cfg.log_flush_interval,
+                max_bytes=cfg.log_max_bytes,
+                backup_count=cfg.log_backup_count)
+
+    def open(self):
+        self.fd = os.open(self.filename,
+                os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        util.close_on_exec(self.fd)
+
+    def check_fork(self):
+        # a forked worker inherits the records the arbiter still buffers,
+        # the arbiter writes those itself
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.buffer = []
+            self.buffered = 0
+
+    def after_fork(self):
+        """\
+        Make the copy a forked process inherited safe to drop, without
+        going through the lock a thread of the parent may have held.
+        """
+        self.createLock()
+        self.check_fork()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def emit(self, record):
+        try:
+            self.check_fork()
+            data = self.format(record) + "\n"
+            if not isinstance(data, bytes):
+                data = data.encode("utf-8")
+            self.buffer.append(data)
+            self.buffered += len(data)
+            if self.buffered >= self.buffer_size or \
+                    record.levelno >= self.flush_level or \
+                    record.created - self.last_flush >= self.flush_interval:
+                self._write()
+        except Exception:
+            self.handleError(record)
+
+    def _write(self):
+        self.check_fork()
+        self.last_flush = time.time()
+        if not self.buffer or self.fd is None:
+            return
+        data = b"".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+
+        if self.max_bytes:
+            self.check_rotate(len(data))
+
+        while data:
+            try:
+                written = os.write(self.fd, data)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            data = data[written:]
+
+    def flush(self):
+        self.acquire()
+        try:
+            self._write()
+        finally:
+            self.release()
+
+    def flush_due(self, now=None):
+        """\
+        Write out records buffered for longer than ``flush_interval``.
+        Gives up rather than wait when another thread holds the handler.
+        """
+        if not self.buffer:
+            return
+        if (now or time.time()) - self.last_flush < self.flush_interval:
+            return
+        if not self.lock.acquire(False):
+            return
+        try:
+            self._write()
+        finally:
+            self.lock.release()
+
+    def check_rotate(self, size):
+        st = os.fstat(self.fd)
+        if not st.st_size or st.st_size + size <= self.max_bytes:
+            return
+
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            try:
+                current = os.stat(self.filename)
+            except OSError:
+                current = None
+            if current is not None and current.st_ino == st.st_ino and \
+                    current.st_dev == st.st_dev:
+                self.rotate()
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self._reopen()
+
+    def rotate(self):
+        if self.backup_count <= 0:
+            os.unlink(self.filename)
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            src = "%s.%d" % (self.filename, i)
+            if os.path.exists(src):
+                os.rename(src, "%s.%d" % (self.filename, i + 1))
+        os.rename(self.filename, self.filename + ".1")
+
+    def _reopen(self):
+        fd = self.fd
+        self.open()
+        if fd is not None:
+            os.close(fd)
+
+    def reopen(self):
+        """\
+        Write out the buffer and reopen the file, after logrotate moved it.
+        """
+        self.acquire()
+        try:
+            self._write()
+            self._reopen()
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            self._write()
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+
+def _after_fork(handler):
+    after_fork = getattr(handler, "after_fork", None)
+    if after_fork is not None:
+        after_fork()
+    else:
+        handler.createLock()
+
+
 def loggers():
     """ get list of all loggers """
     root = logging.root
@@ -79,18 +362,41 @@ class Logger(object):
         loglevel = self.LOG_LEVELS.get(cfg.loglevel.lower(), logging.INFO)
         self.error_log.setLevel(loglevel)
 
-        # set gunicorn.error handler
+        # set culexx.error handler
         self._set_handler(self.error_log, cfg.errorlog,
-                logging.Formatter(self.error_fmt, self.datefmt))
+                logging.Formatter(self.error_fmt, self.datefmt), cfg)
+
+        # the mosqtt message path logs through the root logger
+        self._set_root_queue(cfg)
 
         if cfg.logconfig:
             if os.path.exists(cfg.logconfig):
+                from logging.config import fileConfig
                 fileConfig(cfg.logconfig, defaults=LOGGING_DEFAULTS,
                         disable_existing_loggers=False)
             else:
                 raise RuntimeError("Error: log config '%s' not found" %
                         cfg.logconfig)
 
+    def after_fork(self):
+        """\
+        Drop the handlers inherited from the arbiter in a new worker,
+        before ``setup`` adds its own. They aren't closed: a listener or
+        flush thread of the arbiter may have held their locks at fork
+        time, and Python 2 doesn't reset them, so closing could hang. The
+        other handlers get new locks for the same reason.
+        """
+        root = logging.getLogger()
+        for log in (self.error_log, root):
+            for h in list(log.handlers):
+                if getattr(h, "_culexx", False):
+                    log.handlers.remove(h)
+                    _after_fork(h)
+                    if log is root and isinstance(h, QueueHandler):
+                        log.handlers.append(h.target)
+                else:
+                    h.createLock()
+
     def critical(self, msg, *args, **kwargs):
         self.error_log.critical(msg, *args, **kwargs)
 
@@ -119,20 +425,63 @@ class Logger(object):
             if getattr(h, "_culexx", False) == True:
                 return h
 
-    def _set_handler(self, log, output, fmt):
-        # remove previous gunicorn log handler
+    def _file_handlers(self):
+        for h in self.error_log.handlers:
+            h = getattr(h, "target", h)
+            if isinstance(h, BufferedFileHandler):
+                yield h
+
+    def reopen_files(self):
+        """ reopen the log files, on SIGUSR1 """
+        for h in self._file_handlers():
+            h.reopen()
+
+    def flush_files(self):
+        """ write out log records buffered for too long """
+        now = time.time()
+        for h in self._file_handlers():
+            h.flush_due(now)
+
+    def dropped_records(self):
+        """ number of records dropped by full log queues """
+        handlers = self.error_log.handlers + logging.getLogger().handlers
+        return sum(getattr(h, "dropped", 0) for h in handlers
+                if getattr(h, "_culexx", False))
+
+    def _set_root_queue(self, cfg):
+        root = logging.getLogger()
+        h = self._get_culexx_handler(root)
+        if h:
+            root.removeHandler(h)
+            # the stream handler stays on the root logger
+            h.stop()
+            root.addHandler(h.target)
+
+        if cfg.log_queue and ch in root.handlers:
+            root.removeHandler(ch)
+            h = QueueHandler(ch, cfg.log_queue_size)
+            h._culexx = True
+            root.addHandler(h)
+
+    def _set_handler(self, log, output, fmt, cfg=None):
+        # remove previous culexx log handler
         h = self._get_culexx_handler(log)
         if h:
             log.handlers.remove(h)
+            h.close()
 
         if output is not None:
             if output == "-":
                 h = logging.StreamHandler()
             else:
-                pass
-                # util.check_is_writeable(output)
-                # h = logging.FileHandler(output)
+                util.check_is_writeable(output)
+                if cfg is not None:
+                    h = BufferedFileHandler.from_config(output, cfg)
+                else:
+                    h = BufferedFileHandler(output)
 
             h.setFormatter(fmt)
-            h._gunicorn = True
+            if cfg is not None and cfg.log_queue:
+                h = QueueHandler(h, cfg.log_queue_size)
+            h._culexx = True
             log.addHandler(h)
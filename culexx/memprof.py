@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -
+#
+# This file is part of culexx released under the MIT license.
+# See the NOTICE for more information.
+
+import gc
+import os
+import time
+
+try:
+    import tracemalloc
+except ImportError: # python 2
+    tracemalloc = None
+
+
+def structure_sizes(mosq):
+    """\
+    The number of entries in the bookkeeping structures of ``mosq`` that
+    grow with traffic.
+    """
+    sizes = {
+        "_subscribe_mids": len(mosq._subscribe_mids),
+        "_unsubscribe_mids": len(mosq._unsubscribe_mids),
+        "subscriptions": len(mosq.subscriptions),
+    }
+    if mosq.recorder is not None:
+        sizes["recorder"] = len(mosq.recorder)
+    if mosq.metrics is not None:
+        sizes["metrics topics"] = len(mosq.metrics.topics)
+        sizes["metrics inflight"] = len(mosq.metrics.inflight)
+    return sizes
+
+
+def type_counts():
+    """\
+    Count the objects tracked by the garbage collector by type name.
+    """
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def count_diff(after, before):
+    diff = {}
+    for name, n in after.items():
+        n -= before.get(name, 0)
+        if n:
+            diff[name] = n
+    for name, n in before.items():
+        if name not in after:
+            diff[name] = -n
+    return diff
+
+
+class Growth(object):
+    """\
+    What the calls of one handler left behind.
+    """
+
+    __slots__ = ("calls", "sampled", "types", "size")
+
+    def __init__(self):
+        self.calls = 0
+        self.sampled = 0
+        # type name -> objects
+        self.types = {}
+        self.size = 0
+
+    @property
+    def objects(self):
+        return sum(self.types.values())
+
+    def add(self, types, size):
+        self.sampled += 1
+        for name, n in types.items():
+            self.types[name] = self.types.get(name, 0) + n
+        self.size += size
+
+
+class AllocationTracker(object):
+    """\
+    Attributes memory growth to the topic handlers.
+
+    While a tracker is set as ``Mosqtt.memory``, ``TopicMapper.handle_topic``
+    runs every handler through ``call``, tagged with the handler name and
+    its topic. One call in ``sample_every`` of each handler is measured:
+    after a collection, the objects the garbage collector tracks are
+    counted by type before and after it, so what is left is what the call
+    kept alive. This walks the whole heap twice per sampled call and is
+    only meant as a diagnostics mode.
+
+    Where tracemalloc is available (Python 3.4+) it is started as well:
+    the traced size is read around every call, and reports list the
+    allocation sites that grew.
+    """
+
+    TOP = 10
+
+    def __init__(self, frames=16, sample_every=100):
+        self.frames = frames
+        self.sample_every = max(1, sample_every)
+        self.total = {}
+        self.recent = {}
+        self.noise = {}
+        self.tracing = False
+        self.last = None
+        self.started = None
+        self.last_time = None
+
+    def start(self):
+        if tracemalloc is not None:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+            self.tracing = True
+            self.last = self.snapshot()
+        # what measuring leaves behind itself, once warmed up
+        for _ in range(2):
+            gc.collect()
+            before = type_counts()
+            gc.collect()
+            self.noise = count_diff(type_counts(), before)
+        self.started = self.last_time = time.time()
+
+    def stop(self):
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+        self.last = None
+
+    def call(self, label, func, payload):
+        growth = self.total.get(label)
+        if growth is None:
+            growth = self.total[label] = Growth()
+            self.recent[label] = Growth()
+        growth.calls += 1
+        self.recent[label].calls += 1
+        sample = (growth.calls - 1) % self.sample_every == 0
+
+        if not sample and not self.tracing:
+            return func(payload)
+
+        if sample:
+            gc.collect()
+            before = type_counts()
+        size = tracemalloc.get_traced_memory()[0] if self.tracing else 0
+        result = func(payload)
+        if self.tracing:
+            size = tracemalloc.get_traced_memory()[0] - size
+        types = {}
+        if sample:
+            gc.collect()
+            types = count_diff(count_diff(type_counts(), before), self.noise)
+            growth.add(types, size)
+            self.recent[label].add(types, size)
+        else:
+            growth.size += size
+            self.recent[label].size += size
+        return result
+
+    def snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, os.path.splitext(__file__)[0] + ".py"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
+
+    def format_growth(self, title, growths):
+        lines = [title]
+        for label, g in sorted(growths.items(), key=lambda g: -g[1].objects):
+            line = "  %-40s %9d calls %7d sampled %+9d objects" % (label,
+                    g.calls, g.sampled, g.objects)
+            if self.tracing:
+                line += " %+12d B" % g.size
+            lines.append(line)
+            top = sorted(g.types.items(), key=lambda t: -abs(t[1]))
+            for name, n in top[:self.TOP]:
+                lines.append("      %+9d  %s" % (n, name))
+        return lines
+
+    def report(self, sizes=None):
+        """\
+        Return the report text of the growth since the previous report and
+        since tracking started.
+        """
+        now = time.time()
+        lines = ["# culexx memory report, pid %s, %s" % (os.getpid(),
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now))),
+            "objects tracked by the garbage collector: %d"
+                % len(gc.get_objects()),
+            "objects are counted around 1 in %d calls of each handler"
+                % self.sample_every]
+        if self.tracing:
+            lines.append("traced: %d B, peak %d B"
+                    % tracemalloc.get_traced_memory())
+        lines.append("")
+
+        lines.extend(self.format_growth("growth over the last %.0fs:"
+                % (now - self.last_time), self.recent))
+        lines.append("")
+        lines.extend(self.format_growth("growth since tracking started "
+                "%.0fs ago:" % (now - self.started), self.total))
+
+        if self.tracing:
+            snapshot = self.snapshot()
+            lines.append("")
+            lines.append("allocation sites that grew over the last %.0fs:"
+                    % (now - self.last_time))
+            diffs = [d for d in snapshot.compare_to(self.last, "lineno")
+                    if d.size_diff > 0]
+            for diff in diffs[:self.TOP]:
+                lines.append("  %+12d B %+9d blocks  %s" % (diff.size_diff,
+                    diff.count_diff, diff.traceback.format(limit=1)[0]
+                        .strip()))
+            self.last = snapshot
+
+        if sizes:
+            lines.append("")
+            lines.append("structure sizes:")
+            for name, size in sorted(sizes.items()):
+                lines.append("  %-40s %d" % (name, size))
+
+        self.recent = dict((label, Growth()) for label in self.total)
+        self.last_time = now
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,513 @@
+# -*- coding: utf-8 -
+#
+# This file is part of culexx released under the MIT license.
+# See the NOTICE for more information.
+
+import errno
+import marshal
+import math
+import mmap
+import os
+import select
+import struct
+import threading
+import time
+
+from . import util
+
+# only the metrics server needs it
+socket = util.LazyModule("socket")
+
+
+class Histogram(object):
+    """\
+    Counts values in log-linear buckets: every power of two between
+    ``2 ** MIN_EXP`` and ``2 ** MAX_EXP`` is split in ``SUB_BUCKETS``
+    linear buckets, so any value is known within 1 / SUB_BUCKETS of its
+    magnitude whatever the range. Smaller values go to the first bucket
+    and larger ones to the last.
+
+    With the defaults seconds are counted from about a microsecond to two
+    minutes in 226 buckets.
+    """
+
+    MIN_EXP = -20
+    MAX_EXP = 7
+    SUB_BUCKETS = 8
+
+    SIZE = (MAX_EXP - MIN_EXP + 1) * SUB_BUCKETS + 2
+    LOWEST = 2.0 ** (MIN_EXP - 1)
+
+    def __init__(self):
+        self.counts = [0] * self.SIZE
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    @classmethod
+    def bucket(cls, value):
+        if value <= cls.LOWEST:
+            return 0
+        m, e = math.frexp(value)
+        if e > cls.MAX_EXP:
+            return cls.SIZE - 1
+        return (e - cls.MIN_EXP) * cls.SUB_BUCKETS + \
+                int((m - 0.5) * 2 * cls.SUB_BUCKETS) + 1
+
+    @classmethod
+    def upper_bound(cls, index):
+        if index == 0:
+            return cls.LOWEST
+        if index >= cls.SIZE - 1:
+            return float("inf")
+        e, sub = divmod(index - 1, cls.SUB_BUCKETS)
+        return (0.5 + (sub + 1) / (2.0 * cls.SUB_BUCKETS)) * \
+                2.0 ** (e + cls.MIN_EXP)
+
+    def add(self, value):
+        self.counts[self.bucket(value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            if n:
+                self.counts[i] += n
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """\
+        Return the upper bound of the bucket holding the ``q`` quantile,
+        ``q`` between 0 and 1.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(self.upper_bound(i), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def dump(self):
+        """\
+        Return the histogram as a marshallable tuple, keeping only the
+        buckets in use.
+        """
+        counts = dict((i, n) for i, n in enumerate(self.counts) if n)
+        return (counts, self.count, self.sum, self.max)
+
+    @classmethod
+    def load(cls, data):
+        h = cls()
+        counts, h.count, h.sum, h.max = data
+        for i, n in counts.items():
+            h.counts[i] = n
+        return h
+
+
+class Metrics(object):
+    """\
+    Counters and histograms of one Mosqtt client.
+
+    Messages and bytes are counted per topic in and out, handler run times
+    and publish to PUBACK times go to histograms. Everything is kept in
+    plain dicts and lists updated in place; ``snapshot`` turns them into a
+    marshallable dict the arbiter merges across workers.
+    """
+
+    # distinct topics counted before the rest is counted as OTHER
+    MAX_TOPICS = 10000
+    OTHER = "__other__"
+
+    # publishes waiting for their PUBACK, and how long they may wait
+    MAX_INFLIGHT = 10000
+    INFLIGHT_TIMEOUT = 60
+
+    def __init__(self):
+        # topic -> [messages in, bytes in, messages out, bytes out]
+        self.topics = {}
+        self.handlers = {}
+        self.puback = Histogram()
+        self.inflight = {}
+        # PUBACKs that came in before the publish returned their mid
+        self.acked = {}
+        self.ack_lock = threading.Lock()
+        self.connects = 0
+        self.gauges = {}
+        # stage -> Histogram, filled by the tracer
+        self.stages = {}
+        # request topic -> Histogram of RPC round trips
+        self.rpc = {}
+
+    def _topic(self, topic):
+        stats = self.topics.get(topic)
+        if stats is None:
+            if len(self.topics) >= self.MAX_TOPICS:
+                topic = self.OTHER
+            stats = self.topics.setdefault(topic, [0, 0, 0, 0])
+        return stats
+
+    def message_in(self, topic, size):
+        stats = self._topic(topic)
+        stats[0] += 1
+        stats[1] += size
+
+    def message_out(self, topic, size, mid=None, start=None):
+        stats = self._topic(topic)
+        stats[2] += 1
+        stats[3] += size
+        if mid is None:
+            return
+        start = start or time.time()
+        with self.ack_lock:
+            acked = self.acked.pop(mid, None)
+            # an ack from before the publish was for an earlier use of mid
+            if acked is None or acked < start:
+                if len(self.inflight) < self.MAX_INFLIGHT:
+                    self.inflight[mid] = start
+                return
+        self.puback.add(acked - start)
+
+    def published(self, mid):
+        now = time.time()
+        with self.ack_lock:
+            start = self.inflight.pop(mid, None)
+            if start is None:
+                # the network thread may get the PUBACK before the
+                # publishing thread counts the publish, or it was QoS 0
+                if len(self.acked) >= self.MAX_INFLIGHT:
+                    self.acked.clear()
+                self.acked[mid] = now
+                return
+        self.puback.add(now - start)
+
+    def handled(self, handler, seconds):
+        h = self.handlers.get(handler)
+        if h is None:
+            h = self.handlers[handler] = Histogram()
+        h.add(seconds)
+
+    def rpc_done(self, topic, seconds):
+        h = self.rpc.get(topic)
+        if h is None:
+            if len(self.rpc) >= self.MAX_TOPICS:
+                topic = self.OTHER
+            h = self.rpc.setdefault(topic, Histogram())
+        h.add(seconds)
+
+    def connected(self):
+        self.connects += 1
+
+    @property
+    def reconnects(self):
+        return max(0, self.connects - 1)
+
+    def expire_inflight(self, now=None):
+        limit = (now or time.time()) - self.INFLIGHT_TIMEOUT
+        with self.ack_lock:
+            for mid, start in list(self.inflight.items()):
+                if start < limit:
+                    del self.inflight[mid]
+            for mid, acked in list(self.acked.items()):
+                if acked < limit:
+                    del self.acked[mid]
+
+    def snapshot(self):
+        self.expire_inflight()
+        self.gauges["publishes_inflight"] = len(self.inflight)
+        return {
+            "topics": dict((t, list(s)) for t, s in self.topics.items()),
+            "handlers": dict((name, h.dump())
+                for name, h in self.handlers.items()),
+            "puback": self.puback.dump(),
+            "reconnects": self.reconnects,
+            "gauges": dict(self.gauges),
+            "stages": dict((name, h.dump())
+                for name, h in self.stages.items()),
+            "rpc": dict((topic, h.dump()) for topic, h in self.rpc.items()),
+        }
+
+
+def empty_snapshot():
+    return {"topics": {}, "handlers": {}, "puback": Histogram().dump(),
+            "reconnects": 0, "gauges": {}, "stages": {}, "rpc": {}}
+
+
+def merge_snapshots(snapshots):
+    """\
+    Add up snapshots of several clients. Gauges are summed too.
+    """
+    topics = {}
+    handlers = {}
+    stages = {}
+    rpc = {}
+    puback = Histogram()
+    reconnects = 0
+    gauges = {}
+    for snap in snapshots:
+        for topic, stats in snap["topics"].items():
+            total = topics.setdefault(topic, [0, 0, 0, 0])
+            for i, n in enumerate(stats):
+                total[i] += n
+        for merged, histograms in ((handlers, snap["handlers"]),
+                (stages, snap.get("stages", {})),
+                (rpc, snap.get("rpc", {}))):
+            for name, data in histograms.items():
+                h = merged.get(name)
+                if h is None:
+                    merged[name] = Histogram.load(data)
+                else:
+                    h.merge(Histogram.load(data))
+        puback.merge(Histogram.load(snap["puback"]))
+        reconnects += snap["reconnects"]
+        for name, value in snap["gauges"].items():
+            gauges[name] = gauges.get(name, 0) + value
+    return {"topics": topics,
+            "handlers": dict((n, h.dump()) for n, h in handlers.items()),
+            "puback": puback.dump(), "reconnects": reconnects,
+            "gauges": gauges,
+            "stages": dict((n, h.dump()) for n, h in stages.items()),
+            "rpc": dict((n, h.dump()) for n, h in rpc.items())}
+
+
+class MetricsBuffer(object):
+    """\
+    Anonymous shared memory a worker publishes its metrics snapshot in
+    for the arbiter to read.
+
+    The writer bumps a sequence number to odd before writing and back to
+    even after, a reader retries until it sees the same even number
+    before and after copying the data. A snapshot too big for the buffer
+    isn't written and is counted in ``overflows``, the reader keeps
+    seeing the previous one.
+    """
+
+    HEADER = struct.Struct("=QQ")
+
+    def __init__(self, size=1024 * 1024):
+        self.size = size
+        self.buf = mmap.mmap(-1, size)
+        self.overflows = 0
+
+    def write(self, snapshot):
+        data = marshal.dumps(snapshot)
+        if self.HEADER.size + len(data) > self.size:
+            self.overflows += 1
+            return False
+        seq = self.HEADER.unpack_from(self.buf, 0)[0]
+        self.HEADER.pack_into(self.buf, 0, seq + 1, 0)
+        start = self.HEADER.size
+        self.buf[start:start + len(data)] = data
+        self.HEADER.pack_into(self.buf, 0, seq + 2, len(data))
+        return True
+
+    def read(self, retries=100):
+        for _ in range(retries):
+            seq, length = self.HEADER.unpack_from(self.buf, 0)
+            if seq & 1:
+                continue
+            start = self.HEADER.size
+            data = self.buf[start:start + length]
+            if self.HEADER.unpack_from(self.buf, 0)[0] != seq:
+                continue
+            if not length:
+                return None
+            return marshal.loads(data)
+        return None
+
+    def close(self):
+        self.buf.close()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+            .replace("\n", "\\n")
+
+
+def _histogram_lines(name, labels, data):
+    h = Histogram.load(data)
+    lines = []
+    cumulative = 0
+    for i, n in enumerate(h.counts):
+        if not n:
+            continue
+        cumulative += n
+        if i < Histogram.SIZE - 1:
+            lines.append('%s_bucket{%sle="%.9g"} %d'
+                    % (name, labels, Histogram.upper_bound(i), cumulative))
+    lines.append('%s_bucket{%sle="+Inf"} %d' % (name, labels, h.count))
+    labels = labels.rstrip(",")
+    labels = "{%s}" % labels if labels else ""
+    lines.append('%s_sum%s %.9g' % (name, labels, h.sum))
+    lines.append('%s_count%s %d' % (name, labels, h.count))
+    return lines
+
+
+def render(snapshot, workers=()):
+    """\
+    Render a merged snapshot in the Prometheus text format. ``workers``
+    are (pid, status dict) pairs, their queue depth and latency are shown
+    per worker.
+    """
+    lines = []
+
+    counters = (
+        ("culexx_messages_received_total", 0),
+        ("culexx_bytes_received_total", 1),
+        ("culexx_messages_published_total", 2),
+        ("culexx_bytes_published_total", 3),
+    )
+    topics = sorted(snapshot["topics"].items())
+    for name, index in counters:
+        lines.append("# TYPE %s counter" % name)
+        for topic, stats in topics:
+            lines.append('%s{topic="%s"} %d'
+                    % (name, _escape(topic), stats[index]))
+
+    lines.append("# TYPE culexx_handler_seconds histogram")
+    for handler, data in sorted(snapshot["handlers"].items()):
+        lines.extend(_histogram_lines("culexx_handler_seconds",
+                'handler="%s",' % _escape(handler), data))
+
+    lines.append("# TYPE culexx_puback_seconds histogram")
+    lines.extend(_histogram_lines("culexx_puback_seconds", "",
+            snapshot["puback"]))
+
+    if snapshot.get("stages"):
+        lines.append("# TYPE culexx_trace_seconds histogram")
+        for stage, data in sorted(snapshot["stages"].items()):
+            lines.extend(_histogram_lines("culexx_trace_seconds",
+                    'stage="%s",' % stage, data))
+
+    if snapshot.get("rpc"):
+        lines.append("# TYPE culexx_rpc_seconds histogram")
+        for topic, data in sorted(snapshot["rpc"].items()):
+            lines.extend(_histogram_lines("culexx_rpc_seconds",
+                    'topic="%s",' % _escape(topic), data))
+
+    lines.append("# TYPE culexx_reconnects_total counter")
+    lines.append("culexx_reconnects_total %d" % snapshot["reconnects"])
+
+    for name, value in sorted(snapshot["gauges"].items()):
+        lines.append("# TYPE culexx_%s gauge" % name)
+        lines.append("culexx_%s %.9g" % (name, value))
+
+    workers = sorted(workers)
+    lines.append("# TYPE culexx_workers gauge")
+    lines.append("culexx_workers %d" % len(workers))
+    for name, field, fmt in (("queue_depth", "backlog", "%d"),
+            ("handler_latency_seconds", "latency", "%.9g"),
+            ("messages_processed", "processed", "%d")):
+        lines.append("# TYPE culexx_worker_%s gauge" % name)
+        for pid, status in workers:
+            lines.append(('culexx_worker_%s{pid="%s"} ' + fmt)
+                    % (name, pid, status[field]))
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer(object):
+    """\
+    Answers HTTP requests from the arbiter's loop, on a Unix socket
+    (``unix:PATH``) or a TCP address (``HOST:PORT``). Serves the metrics
+    and takes a few control commands, the arbiter decides which.
+    """
+
+    # the longest the arbiter's loop is held answering requests
+    DEADLINE = 0.2
+    MAX_REQUEST = 8192
+
+    def __init__(self, bind):
+        self.bind = bind
+        self.path = None
+        if bind.startswith("unix:"):
+            self.path = bind[5:]
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(self.path)
+        else:
+            host, _, port = bind.rpartition(":")
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind((host or "127.0.0.1", int(port)))
+        self.sock.listen(16)
+        self.sock.setblocking(False)
+        util.close_on_exec(self.sock.fileno())
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def handle(self, respond):
+        """\
+        Answer the pending connections. ``respond(method, path)`` returns
+        the status line and the text of the response. Clients that don't
+        send their request before the deadline are disconnected.
+        """
+        deadline = time.time() + self.DEADLINE
+        while time.time() < deadline:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK,
+                        errno.EINTR, errno.ECONNABORTED):
+                    return
+                raise
+            try:
+                request = self.read_request(conn, deadline)
+                if request is None:
+                    continue
+                parts = request.split(b"\r\n", 1)[0].split()
+                if len(parts) < 2:
+                    status, body = "400 Bad Request", "bad request\n"
+                else:
+                    method, path = [p.decode("latin-1") for p in parts[:2]]
+                    status, body = respond(str(method), str(path))
+                if not isinstance(body, bytes):
+                    body = body.encode("utf-8")
+                conn.settimeout(max(deadline - time.time(), 0.05))
+                conn.sendall(b"HTTP/1.0 " + status.encode("ascii") +
+                        b"\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                        b"Content-Length: " + str(len(body)).encode("ascii") +
+                        b"\r\nConnection: close\r\n\r\n" + body)
+            except (socket.error, socket.timeout, select.error):
+                pass
+            finally:
+                conn.close()
+
+    def read_request(self, conn, deadline):
+        """\
+        Read the request head without blocking past ``deadline``, or
+        return None.
+        """
+        conn.setblocking(False)
+        request = b""
+        while b"\r\n\r\n" not in request and \
+                len(request) < self.MAX_REQUEST:
+            remaining = deadline - time.time()
+            if remaining <= 0 or \
+                    not select.select([conn], [], [], remaining)[0]:
+                return None
+            chunk = conn.recv(4096)
+            if not chunk:
+                break
+            request += chunk
+        return request
+
+    def close(self):
+        self.sock.close()
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
@@ -1,8 +1,21 @@
+from __future__ import absolute_import
+
+import collections
+import logging
+import random
 import re
+import struct
 import sys
-import paho.mqtt.client as mosquitto
-from blinker import signal
-from .clogging import default_logger as log
+import threading
+import time
+from . import util
+from .logging import default_logger as log
+from .recorder import MESSAGE, HANDLER, CONNECT, DISCONNECT, SUBSCRIBE, \
+        UNSUBSCRIBE, OK
+
+# paho is only imported once a client is actually created, and the
+# modules of optional features once they are turned on
+mosquitto = util.LazyModule("paho.mqtt.client")
 
 class MQTTException(Exception):
 
@@ -44,21 +57,48 @@ class TopicMapper(object):
             raise TypeError("Expected dict but got %s" % type(topic_handlers))
         self.mosqtt = mosqtt
         self.topic_handlers = topic_handlers
+        self.streams = None
 
     @property
     def topics(self):
         return self.topic_handlers
 
+    def stream(self, topic_filter, value=float, per_topic=False):
+        from .stream import Stream, StreamSet
+        if self.streams is None:
+            self.streams = StreamSet()
+        s = Stream(self.mosqtt, topic_filter, value, per_topic)
+        self.streams.add(s)
+        return s
+
     def handle_topic(self, topic, payload):
         m = re.match(self.TOPIC_FILTER_REGEX, topic)
+        func = None
         try:
             topic = m.group('topic_name')
             func = self.topic_handlers.get(topic, None)
-            log.debug(topic)
-            log.debug(func)
-            if hasattr(self.mosqtt, func):
-                return getattr(self.mosqtt, func)(payload)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("%s -> %s", topic, func)
+            if func is not None and hasattr(self.mosqtt, func):
+                start = time.time()
+                handler = getattr(self.mosqtt, func)
+                memory = self.mosqtt.memory
+                if memory is None:
+                    result = handler(payload)
+                else:
+                    result = memory.call("%s [%s]" % (func, topic), handler,
+                            payload)
+                metrics = self.mosqtt.metrics
+                if metrics is not None:
+                    metrics.handled(func, time.time() - start)
+                recorder = self.mosqtt.recorder
+                if recorder is not None:
+                    recorder.record(HANDLER, topic, len(payload), func, OK)
+                return result
         except Exception as e:
+            recorder = self.mosqtt.recorder
+            if recorder is not None:
+                recorder.record(HANDLER, topic, len(payload), func, repr(e))
             log.warn(e)
 
 
@@ -67,6 +107,7 @@ from types import MethodType
 class SignalMapper(object):
 
     def __init__(self, mosqtt, callbacks={}):
+        from blinker import signal
         self.mosqtt = mosqtt
         self.sig_on_message = signal('on_message')
         self.sig_on_connect = signal('on_connect')
@@ -89,29 +130,153 @@ class SignalMapper(object):
                     if func:
                         setattr(self.mosqtt, f_name, sig.connect(MethodType(func, self.mosqtt)))
 
-    def on_connect(self, mosq, obj, rc):
+    def record(self, kind, topic=None, size=0, outcome=OK):
+        recorder = self.mosqtt.recorder
+        if recorder is not None:
+            recorder.record(kind, topic, size, None, outcome)
+
+    def on_connect(self, mosq, obj, *args):
+        # paho passes the connect flags before the result code, mosquitto.py
+        # only the result code
+        rc = args[-1]
+        self.record(CONNECT, outcome="rc=%s" % rc)
+        if self.mosqtt.metrics is not None:
+            self.mosqtt.metrics.connected()
         self.sig_on_connect.send(self.mosqtt, mosq=mosq, obj=obj, rc=rc)
 
     def on_publish(self, mosq, obj, rc):
+        # paho passes the message id
+        if self.mosqtt.metrics is not None:
+            self.mosqtt.metrics.published(rc)
         self.sig_on_publish.send(self.mosqtt, mosq=mosq, obj=obj, rc=rc)
 
     def on_subscribe(self, mosq, obj, mid, granted_qos):
+        self.record(SUBSCRIBE, self.mosqtt.pending_subscribe(mid))
         self.sig_on_subscribe.send(self.mosqtt, mosq=mosq, obj=obj, mid=mid, qos=granted_qos)
 
     def on_unsubscribe(self, mosq, obj, mid):
+        self.record(UNSUBSCRIBE, self.mosqtt.pending_unsubscribe(mid))
         self.sig_on_unsubscribe.send(self.mosqtt, mosq=mosq, obj=obj, mid=mid)
 
     def on_disconnect(self, mosq, obj, rc):
+        self.record(DISCONNECT, outcome="rc=%s" % rc)
         self.sig_on_disconnect.send(self.mosqtt, mosq=mosq, obj=obj, rc=rc)
 
     def on_message(self, mosq, obj, msg):
-        self.sig_on_message.send(self.mosqtt, mosq=mosq, obj=obj, msg=msg)
+        self.dispatch(mosq, obj, msg)
+
+    def dispatch(self, mosq, obj, msg, received=None):
+        """
+        Run the message handlers. ``received`` is when the message came in,
+        if it was queued before being dispatched.
+        """
+        echoes = self.mosqtt.echoes
+        if echoes is not None and echoes.seen(msg):
+            return
+
+        rpc = self.mosqtt.rpc
+        if rpc is not None and rpc.handle_reply(msg):
+            return
+
+        traffic = self.mosqtt.traffic
+        if traffic is not None:
+            traffic.record(msg, received)
+
+        archive = self.mosqtt.archive
+        if archive is not None:
+            archive.record(msg, received)
+
+        tracer = self.mosqtt.tracer
+        trace = tracer.receive(msg, received) if tracer is not None else None
+
+        cache = self.mosqtt.cache
+        if cache is not None:
+            cache.record(msg, received)
+
+        metrics = self.mosqtt.metrics
+        if metrics is not None:
+            metrics.message_in(msg.topic, len(msg.payload))
+
+        consumers = self.mosqtt.consumers
+        if consumers is not None:
+            self.mosqtt.feed_consumers(consumers.match(msg.topic), msg,
+                    received)
+        self.mosqtt.feed_streams(msg, received)
+
+        recorder = self.mosqtt.recorder
+        if recorder is None:
+            self.sig_on_message.send(self.mosqtt, mosq=mosq, obj=obj, msg=msg)
+        else:
+            recorder.record(MESSAGE, msg.topic, len(msg.payload), None, OK)
+            try:
+                self.sig_on_message.send(self.mosqtt, mosq=mosq, obj=obj, msg=msg)
+            except Exception as e:
+                recorder.record(MESSAGE, msg.topic, len(msg.payload), None, repr(e))
+                raise
+
+        if trace is not None:
+            tracer.finish(trace, msg.topic)
 
     def on_log(self, mosq, obj, level, string):
         # log messages
         self.sig_on_log.send(self.mosqtt, mosq=mosq, obj=obj, level=level, string=string)
 
 
+class EchoFilter(object):
+    """\
+    Remembers the messages delivered locally so the copies the broker
+    sends back can be dropped. MQTT 3.1.1 doesn't tell a client its own
+    messages from others, so the published payload is wrapped in an
+    envelope with a random id. Other subscribers get the envelope too,
+    like the one of a traced message.
+    """
+
+    MAGIC = b"\xc1\x7eEC"
+    ENVELOPE = struct.Struct(">4sQ")
+
+    def __init__(self, timeout=10.0):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.order = collections.deque()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def stamp(self, payload):
+        """\
+        Return ``payload`` in an envelope whose echo is expected.
+        """
+        echo_id = random.getrandbits(64)
+        with self.lock:
+            self.pending.add(echo_id)
+            self.order.append((time.time() + self.timeout, echo_id))
+        return self.ENVELOPE.pack(self.MAGIC, echo_id) + payload
+
+    def seen(self, msg):
+        """\
+        Take the envelope off ``msg``. Return True if the message is an
+        expected echo, forgetting it.
+        """
+        payload = msg.payload
+        if not isinstance(payload, bytes) or \
+                not payload.startswith(self.MAGIC) or \
+                len(payload) < self.ENVELOPE.size:
+            return False
+        _, echo_id = self.ENVELOPE.unpack_from(payload)
+        msg.payload = payload[self.ENVELOPE.size:]
+        with self.lock:
+            now = time.time()
+            order = self.order
+            # echoes that never came, e.g. while unsubscribed
+            while order and order[0][0] < now:
+                self.pending.discard(order.popleft()[1])
+            if echo_id not in self.pending:
+                return False
+            self.pending.remove(echo_id)
+            return True
+
+
 class Mosqtt(object):
 
     MQTTHOST = "127.0.0.1"
@@ -120,8 +285,43 @@ class Mosqtt(object):
 
     _signals_class = SignalMapper
     _topics_class = TopicMapper
+    # classes or their dotted paths, loaded when the feature is used
+    _recorder_class = "culexx.recorder.FlightRecorder"
+    _metrics_class = "culexx.metrics.Metrics"
+    _cache_class = "culexx.cache.LastValueCache"
+    _rpc_class = "culexx.rpc.RPCClient"
+
+    # records kept by the flight recorder, 0 turns it off
+    RECORDER_SIZE = 4096
+
+    # count messages and time handlers
+    COLLECT_METRICS = False
+
+    # share of the published messages traced, 0 turns tracing off
+    TRACE_SAMPLE_RATE = 0
+
+    # topics whose latest payload is kept, 0 turns the cache off
+    LAST_VALUE_CACHE_SIZE = 0
 
-    _default_sig_handlers = { 'on_connect': (,), 'on_disconnect': (,) }
+    # seconds a cached value stays valid, 0 keeps it until replaced
+    LAST_VALUE_TTL = 0
+
+    # dispatch messages published to topics the client is subscribed to
+    # directly, besides sending them to the broker. Off for clients in a
+    # share group, the broker hands the message to one of them.
+    LOCAL_DELIVERY = False
+
+    # drop the copies of locally delivered messages the broker sends back
+    SUPPRESS_ECHO = False
+
+    # how long the echo of a locally delivered message is waited for
+    ECHO_TIMEOUT = 10.0
+
+    # seconds a request waits for its response, and how many may wait
+    RPC_TIMEOUT = 10.0
+    RPC_MAX_PENDING = 10000
+
+    _default_sig_handlers = { 'on_connect': (), 'on_disconnect': () }
 
     class Meta(object):
         pass
@@ -138,8 +338,46 @@ class Mosqtt(object):
         self._subscriptions = None
         self._unsubscribe_mids = {}
         self._subscribe_mids = {}
+        self.share_group = None
+        # whether the streams of this client are fed and subscribed here,
+        # only one of the processes sharing a subscription aggregates
+        self.stream_owner = True
+        # False in the workers of the fanout mode, they hold no connection
+        self.can_publish = True
+        self.session_suffix = ''
+        self.recorder = None
+        if self.RECORDER_SIZE:
+            self.recorder = util.load_class(self._recorder_class)(
+                    self.RECORDER_SIZE)
+        self.metrics = None
+        if self.COLLECT_METRICS:
+            self.metrics = util.load_class(self._metrics_class)()
+        self.traffic = None
+        self.archive = None
+        self.echoes = None
+        if self.LOCAL_DELIVERY and self.SUPPRESS_ECHO:
+            self.echoes = EchoFilter(self.ECHO_TIMEOUT)
+        # (topic handlers, TopicTree of their filters) for local delivery
+        self._handler_filters = None
+        self.cache = None
+        if self.LAST_VALUE_CACHE_SIZE:
+            cache_class = util.load_class(self._cache_class)
+            self.cache = cache_class(self.LAST_VALUE_CACHE_SIZE,
+                    self.LAST_VALUE_TTL)
+        # created by the first request
+        self.rpc = None
+        # an AllocationTracker while memory profiling
+        self.memory = None
+        # normalized filter -> MessageIterator, see messages()
+        self.consumers = None
+        # called while a full consumer pauses the dispatching thread
+        self.on_pause = None
+        self.tracer = None
+        if self.TRACE_SAMPLE_RATE:
+            from .tracing import Tracer
+            self.tracer = Tracer(self.TRACE_SAMPLE_RATE, log=log)
         self.signal_mapper = self._signals_class(self, getattr(self.Meta, 'signal_handlers',{}))
-        self.topic_mapper = self._topics_class(getattr(self.Meta, 'topic_handlers',{}))
+        self.topic_mapper = self._topics_class(self, getattr(self.Meta, 'topic_handlers',{}))
 
     def setup_callbacks(self):
         log.debug("setting up callbacks...")
@@ -168,7 +406,7 @@ class Mosqtt(object):
     @property
     def mqtt_client(self):
         if self._mqtt_client is None:
-            self._mqtt_client = mosquitto.Mosquitto(self.client_id)
+            self._mqtt_client = mosquitto.Mosquitto(self.client_id + self.session_suffix)
         return self._mqtt_client
 
     @property
@@ -179,6 +417,116 @@ class Mosqtt(object):
     def normalize_topic(self, topic):
         return  "{0}{1}".format(self.client_id, topic)
 
+    def last_value(self, topic, default=None):
+        """\
+        The latest payload received on ``topic``, from the last-value
+        cache.
+        """
+        return self.cache.get(self.normalize_topic(topic), default)
+
+    def last_values(self, topic_filter):
+        """\
+        Return {topic: latest payload} for the cached topics matching
+        ``topic_filter``.
+        """
+        prefix = len(self.client_id)
+        values = self.cache.query(self.normalize_topic(topic_filter))
+        return dict((t[prefix:], v) for t, v in values.items())
+
+    def subscription_filter(self, normalized_topic):
+        # workers of one arbiter share the load of a topic through a
+        # shared subscription
+        if self.share_group:
+            return "$share/{0}/{1}".format(self.share_group, normalized_topic)
+        return normalized_topic
+
+    def stream(self, topic_filter, value=float, per_topic=False):
+        """\
+        Start a windowed aggregation of the messages on ``topic_filter``,
+        see ``culexx.stream.Stream``. The filter is subscribed along with
+        the topic handlers and streams are fed by ``dispatch``.
+
+        A window must see every message on its filter, so with a
+        ``share_group`` the filter is subscribed outside of the group,
+        and only by the client that is the ``stream_owner``. A message
+        also matching a topic handler reaches that client twice when the
+        broker hands it the shared copy as well: keep the filters of
+        streams apart from the handler topics of workers.
+        """
+        s = self.topic_mapper.stream(topic_filter, value, per_topic)
+        if self._setup and self.stream_subscription(topic_filter):
+            self.subscribe(topic_filter, shared=False)
+        return s
+
+    def stream_subscription(self, topic_filter):
+        if not self.stream_owner:
+            return False
+        if self.share_group:
+            return True
+        if topic_filter in self.topics:
+            return False
+        return self.consumers is None or \
+                not self.consumers.get(self.normalize_topic(topic_filter))
+
+    def messages(self, topic_filter, maxsize=1000, policy="pause",
+            timeout=None):
+        """\
+        Return an iterator, and async iterator, of the messages on
+        ``topic_filter`` queued for at most ``maxsize`` messages, see
+        ``culexx.consumer.MessageIterator``. The messages are
+        ``RingMessage`` objects with the topic relative to the client.
+
+        The client must run its network loop in another thread. A
+        ``pause`` waits ``timeout`` seconds, half the keepalive by
+        default, and calls ``on_pause`` meanwhile if set.
+        """
+        if timeout is None:
+            timeout = self.timeout / 2.0
+        from .consumer import MessageIterator
+        from .topics import TopicTree
+        it = MessageIterator(topic_filter, maxsize, policy, timeout,
+                self._paused)
+        it.on_close = self.remove_consumer
+        if self.consumers is None:
+            self.consumers = TopicTree()
+        normalized_filter = self.normalize_topic(topic_filter)
+        subscribed = self.consumers.get(normalized_filter)
+        self.consumers.add(normalized_filter, it)
+        if self._setup and not subscribed and topic_filter not in self.topics:
+            self.subscribe(topic_filter)
+        return it
+
+    def remove_consumer(self, it):
+        normalized_filter = self.normalize_topic(it.topic_filter)
+        self.consumers.remove(normalized_filter, it)
+        if not self._setup or self.consumers.get(normalized_filter) or \
+                it.topic_filter in self.topics:
+            return
+        streams = self.topic_mapper.streams
+        if streams is None or not self.stream_owner or self.share_group or \
+                it.topic_filter not in streams.filters():
+            self.unsubscribe(it.topic_filter)
+
+    def _paused(self):
+        if self.on_pause is not None:
+            self.on_pause()
+
+    def feed_consumers(self, consumers, msg, received=None):
+        if not consumers:
+            return
+        from .ring import RingMessage
+        prefix = len(self.client_id)
+        msg = RingMessage(msg.topic[prefix:], msg.payload, msg.qos,
+                msg.retain, received or time.time())
+        for it in consumers:
+            it.put(msg)
+
+    def feed_streams(self, msg, received=None):
+        streams = self.topic_mapper.streams
+        if streams is None or not self.stream_owner:
+            return
+        streams.feed(msg.topic[len(self.client_id):], msg.payload, received)
+
     def handler_for_topic(self, topic):
         return self.topic_mapper.handler_for_topic(topic)
 
@@ -188,16 +536,19 @@ class Mosqtt(object):
     def pending_unsubscribe(self, mid):
         return self._unsubscribe_mids.get(mid, None)
 
-    def subscribe(self, topic, qos=0):
+    def subscribe(self, topic, qos=0, shared=True):
         normalized_topic = self.normalize_topic(topic)
-        rc, mid = self.mqtt_client.subscribe(normalized_topic, qos)
+        if shared:
+            rc, mid = self.mqtt_client.subscribe(self.subscription_filter(normalized_topic), qos)
+        else:
+            rc, mid = self.mqtt_client.subscribe(normalized_topic, qos)
         self.subscriptions[normalized_topic] = SubscriptionState.PENDING # fixme
         self._subscribe_mids[mid] = normalized_topic # fixme
         return (rc, mid)
 
     def unsubscribe(self, topic):
         normalized_topic = self.normalize_topic(topic)
-        rc, mid =  self.mqtt_client.unsubscribe(normalized_topic)
+        rc, mid =  self.mqtt_client.unsubscribe(self.subscription_filter(normalized_topic))
         self._unsubscribe_mids[mid] = normalized_topic # fixme
         return (rc, mid)
 
@@ -209,10 +560,36 @@ class Mosqtt(object):
     def cleanup(self):
         log.debug("cleaning up...")
 
+    def update_topics(self, topic_handlers):
+        """
+        Replace the topic handlers. When connected, topics that were added
+        are subscribed and topics that were removed unsubscribed on the
+        current connection.
+        """
+        old = set(self.topics)
+        self.topic_mapper.topic_handlers = dict(topic_handlers)
+        if not self._setup:
+            return
+        for topic in set(topic_handlers) - old:
+            self.subscribe(topic)
+        for topic in old - set(topic_handlers):
+            self.unsubscribe(topic)
+
     def setup_subscriptions(self):
         log.debug("setting up subscriptions...")
         for topic in self.topics.keys():
             self.subscribe(topic)
+        if self.consumers is not None:
+            prefix = len(self.client_id)
+            filters = set(f[prefix:] for f, _ in self.consumers.items())
+            for topic_filter in filters:
+                if topic_filter not in self.topics:
+                    self.subscribe(topic_filter)
+        streams = self.topic_mapper.streams
+        if streams is not None:
+            for topic_filter in streams.filters():
+                if self.stream_subscription(topic_filter):
+                    self.subscribe(topic_filter, shared=False)
 
     def connect(self, loop_forever=True):
         if self._setup == True:
@@ -230,6 +607,74 @@ class Mosqtt(object):
         else:
             self.mqtt_client.loop_start()
 
+    def count_publish(self, topic, payload, qos, result, start=None):
+        try:
+            size = len(payload)
+        except TypeError:
+            size = 0
+        # only QoS 1 and 2 publishes are acknowledged by the broker
+        mid = None
+        if qos and result is not None:
+            mid = getattr(result, "mid", None)
+            if mid is None and isinstance(result, tuple):
+                mid = result[1]
+        self.metrics.message_out(topic, size, mid, start)
+
+    def deliver_local(self, topic, payload, qos=0, retain=False):
+        """\
+        Dispatch a message published to one of the client's own topics
+        in the publishing thread, without waiting for the broker to send
+        it back. Returns the payload as it should be published.
+        """
+        from .ring import RingMessage
+        payload = util.payload_bytes(payload)
+        now = time.time()
+        try:
+            self.signal_mapper.dispatch(None, None,
+                    RingMessage(topic, payload, qos, retain, now), now)
+        except Exception:
+            log.exception("Local delivery on %s failed", topic)
+        if self.echoes is not None:
+            payload = self.echoes.stamp(payload)
+        return payload
+
+    def subscribed_to(self, topic):
+        """\
+        Whether a message on ``topic`` comes back to this client through
+        its topic handlers, streams or consumers.
+        """
+        handlers = self.topic_mapper.topic_handlers
+        if self._handler_filters is None or \
+                self._handler_filters[0] is not handlers:
+            from .topics import TopicTree
+            tree = TopicTree()
+            for topic_filter in handlers:
+                tree.add(topic_filter, topic_filter)
+            self._handler_filters = (handlers, tree)
+        if self._handler_filters[1].match(topic):
+            return True
+        streams = self.topic_mapper.streams
+        if streams is not None and self.stream_owner and \
+                streams.match(topic):
+            return True
+        return self.consumers is not None and \
+                bool(self.consumers.match(self.normalize_topic(topic)))
+
+    def request(self, topic, payload, timeout=None, qos=1):
+        """\
+        Publish ``payload`` to a handler decorated with ``rpc.rpc`` and
+        return a future of its response. ``result()`` raises
+        ``RPCTimeout`` when none came within ``timeout`` seconds,
+        ``RPC_TIMEOUT`` by default.
+
+        The client must be connected and its network loop running in
+        another thread, or the response can't arrive.
+        """
+        if self.rpc is None:
+            rpc_class = util.load_class(self._rpc_class)
+            self.rpc = rpc_class(self, self.RPC_TIMEOUT, self.RPC_MAX_PENDING)
+        return self.rpc.request(topic, payload, timeout, qos)
+
     def reconnect(self):
         try:
             return self.mqtt_client.reconnect()
@@ -238,7 +683,23 @@ class Mosqtt(object):
             raise
 
     def publish(self, topic, payload, qos=1, retain=False):
-        rc = self.mqtt_client.loop()
+        return self._publish(topic, self.normalize_topic(topic), payload,
+                qos, retain)
+
+    def publish_absolute(self, topic, payload, qos=1, retain=False):
+        """\
+        Publish to ``topic`` as it is instead of relative to the client,
+        like the reply topic of a request. It isn't delivered locally.
+        """
+        return self._publish(None, topic, payload, qos, retain)
+
+    def _publish(self, topic, normalized_topic, payload, qos, retain):
+        if not self.can_publish:
+            raise MQTTException(mosquitto.MQTT_ERR_NOT_SUPPORTED)
+
+        # only service the network, waiting for traffic here would hold
+        # every publish up for as long as the broker stays quiet
+        rc = self.mqtt_client.loop(0)
 
         if rc == mosquitto.MQTT_ERR_NO_CONN:
             log.debug("reconnect result: %s" % rc)
@@ -246,7 +707,18 @@ class Mosqtt(object):
 
         if rc == mosquitto.MQTT_ERR_SUCCESS:
             try:
-                return self.mqtt_client.publish(self.normalize_topic(topic), payload, qos, retain)
+                if self.tracer is not None:
+                    payload = self.tracer.stamp(payload)
+                if self.LOCAL_DELIVERY and topic is not None and \
+                        not self.share_group and self.subscribed_to(topic):
+                    payload = self.deliver_local(normalized_topic, payload,
+                            qos, retain)
+                start = time.time()
+                result = self.mqtt_client.publish(normalized_topic, payload, qos, retain)
+                if self.metrics is not None:
+                    self.count_publish(normalized_topic, payload, qos, result,
+                            start)
+                return result
             except:
                 e = sys.exc_info()[0]
                 log.warn("uh-oh! time to die: %s" % e)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -
+#
+# This file is part of culexx released under the MIT license.
+# See the NOTICE for more information.
+
+import os
+import sys
+import threading
+import time
+
+
+def handler_codes(mosq):
+    """\
+    Map the code objects of the topic handlers of ``mosq`` to a label
+    naming the handler and its topic.
+    """
+    codes = {}
+    for topic, name in mosq.topics.items():
+        func = getattr(mosq, name, None)
+        func = getattr(func, "__func__", func)
+        code = getattr(func, "__code__", None)
+        if code is not None:
+            codes[code] = "%s [%s]" % (name, topic)
+    return codes
+
+
+class SamplingProfiler(object):
+    """\
+    Samples the stacks of every thread of the process from a background
+    thread, every ``interval`` seconds for ``duration`` seconds, and
+    writes them in the collapsed stack format flamegraph.pl and
+    speedscope read.
+
+    Frames of topic handlers are labelled with the handler name and its
+    topic, so the time of each handler shows up as its own tower. Nothing
+    runs while the profiler is off.
+    """
+
+    def __init__(self, path, duration=30, interval=0.01, handlers=None,
+            log=None):
+        self.path = path
+        self.duration = duration
+        self.interval = interval
+        self.handlers = handlers or {}
+        self.log = log
+        self.stacks = {}
+        self.labels = {}
+        self.samples = 0
+        self.handler_samples = {}
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,
+                name="culexx-profiler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            handler = self.handlers.get(code)
+            if handler is not None:
+                label = "handler:%s" % handler
+            else:
+                label = "%s (%s:%d)" % (code.co_name,
+                        os.path.basename(code.co_filename),
+                        code.co_firstlineno)
+            self.labels[code] = label
+        return label
+
+    def sample(self):
+        me = threading.current_thread().ident
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            handler = None
+            while frame is not None:
+                code = frame.f_code
+                if code in self.handlers:
+                    handler = self.handlers[code]
+                stack.append(self.label(code))
+                frame = frame.f_back
+            stack.append("thread:%s" % names.get(ident, ident))
+            stack.reverse()
+            key = ";".join(stack)
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            if handler is not None:
+                self.handler_samples[handler] = \
+                        self.handler_samples.get(handler, 0) + 1
+        self.samples += 1
+
+    def run(self):
+        deadline = time.time() + self.duration
+        while time.time() < deadline:
+            self.sample()
+            if self.stopping.wait(self.interval):
+                break
+        try:
+            self.write()
+        except (IOError, OSError) as e:
+            if self.log is not None:
+                self.log.warning("Failed to write profile %s: %s",
+                        self.path, e)
+            return
+        if self.log is not None:
+            top = sorted(self.handler_samples.items(), key=lambda x: -x[1])
+            self.log.info("Wrote %d samples to %s, busiest handlers: %s",
+                    self.samples, self.path, ", ".join("%s %d" % h
+                        for h in top[:5]) or "none")
+
+    def write(self):
+        tmp = "%s.%s" % (self.path, os.getpid())
+        with open(tmp, "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write("%s %d\n" % (stack, count))
+        os.rename(tmp, self.path)
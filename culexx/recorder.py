@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -
+#
+# This file is part of culexx released under the MIT license.
+# See the NOTICE for more information.
+
+import os
+import time
+
+from . import util
+
+# record kinds
+MESSAGE = "message"
+HANDLER = "handler"
+CONNECT = "connect"
+DISCONNECT = "disconnect"
+SUBSCRIBE = "subscribe"
+UNSUBSCRIBE = "unsubscribe"
+
+# outcomes
+OK = "ok"
+ERROR = "error"
+
+
+class FlightRecorder(object):
+    """\
+    Keeps the last ``capacity`` messages and connection events of a
+    process in memory, so there is some context when a handler fails
+    with debug logging off.
+
+    Records are plain tuples of (time, kind, topic, size, handler,
+    outcome) stored in a preallocated list that is overwritten in a
+    circle. Recording one is a tuple and a list store, nothing is
+    formatted until the recorder is dumped.
+    """
+
+    def __init__(self, capacity=4096):
+        if capacity < 1:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self.records = [None] * capacity
+        self.count = 0
+
+    def record(self, kind, topic=None, size=0, handler=None, outcome=OK):
+        self.records[self.count % self.capacity] = \
+                (time.time(), kind, topic, size, handler, outcome)
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def snapshot(self):
+        """\
+        Return the records held, oldest first.
+        """
+        count, capacity = self.count, self.capacity
+        if count <= capacity:
+            records = self.records[:count]
+        else:
+            start = count % capacity
+            records = self.records[start:] + self.records[:start]
+        return [r for r in records if r is not None]
+
+    def format(self, record):
+        ts, kind, topic, size, handler, outcome = record
+        return "%s.%06d %s %s size=%d handler=%s %s" % (
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts)),
+                int((ts % 1) * 1000000), kind, topic or "-", size or 0,
+                handler or "-", outcome)
+
+    def dump(self, path, reason=None):
+        """\
+        Write the records to ``path``, oldest first, and return the number
+        of records written.
+        """
+        records = self.snapshot()
+        tmp = "%s.%s" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write("# culexx flight recorder, pid %s, %d of %d records%s\n"
+                    % (os.getpid(), len(records), self.count,
+                        ", %s" % reason if reason else ""))
+            for record in records:
+                f.write(self.format(record) + "\n")
+        os.rename(tmp, path)
+        return len(records)
+
+    def dump_to_dir(self, directory=None, reason=None):
+        path = util.diagnostics_path(directory, "recorder", "log")
+        self.dump(path, reason)
+        return path
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -
+#
+# This file is part of culexx released under the MIT license.
+# See the NOTICE for more information.
+
+import errno
+import os
+import struct
+import time
+
+from . import util
+
+
+class StatWatcher(object):
+    """\
+    Notices changes to a file by comparing its mtime and size, at most
+    once per ``interval`` seconds.
+    """
+
+    def __init__(self, filename, interval=1.0):
+        self.filename = filename
+        self.interval = interval
+        self.last_check = time.time()
+        self.stamp = self._stamp()
+
+    def _stamp(self):
+        try:
+            return util.file_stamp(self.filename)
+        except OSError:
+            return None
+
+    def fileno(self):
+        return None
+
+    def changed(self):
+        now = time.time()
+        if now - self.last_check < self.interval:
+            return False
+        self.last_check = now
+
+        stamp = self._stamp()
+        if stamp is None or stamp == self.stamp:
+            return False
+        self.stamp = stamp
+        return True
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """\
+    Notices changes to a file through inotify. The directory is watched
+    rather than the file so that editors replacing the file are seen too.
+    The descriptor can be added to a select loop.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.name = os.path.basename(filename)
+        if not isinstance(self.name, bytes):
+            self.name = self.name.encode("utf-8")
+
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        path = os.path.dirname(os.path.abspath(filename))
+        if not isinstance(path, bytes):
+            path = path.encode("utf-8")
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | \
+                self.IN_CREATE
+        if libc.inotify_add_watch(self.fd, path, mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, "inotify_add_watch failed")
+
+    def fileno(self):
+        return self.fd
+
+    def changed(self):
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not data:
+                break
+
+            offset = 0
+            while offset + self.EVENT.size <= len(data):
+                _, _, _, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if name == self.name:
+                    changed = True
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watcher_for(filename):
+    """\
+    Return an inotify watcher for ``filename`` where available and a
+    polling one otherwise.
+    """
+    try:
+        return InotifyWatcher(filename)
+    except (OSError, AttributeError, TypeError):
+        return StatWatcher(filename)
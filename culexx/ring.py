@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -
+#
+# This file is part of culexx released under the MIT license.
+# See the NOTICE for more information.
+
+import bisect
+import errno
+import hashlib
+import mmap
+import os
+import select
+import struct
+import time
+
+from . import util
+
+
+class RingMessage(object):
+    """\
+    A message read back from a ring. It quacks like the paho message so
+    the usual signal handlers can take it.
+    """
+
+    __slots__ = ("topic", "payload", "qos", "retain", "timestamp", "mid")
+
+    def __init__(self, topic, payload, qos=0, retain=False, timestamp=0.0):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.timestamp = timestamp
+        self.mid = 0
+
+
+class RingBuffer(object):
+    """\
+    A single producer, single consumer message queue in anonymous shared
+    memory.
+
+    The arbiter creates one per worker slot before forking, its network
+    thread is the only producer and the worker owning the slot the only
+    consumer. Messages are stored as a fixed header followed by the raw
+    topic and payload bytes, so nothing is pickled. Head and tail are
+    ever increasing byte offsets, each only written by one side.
+    """
+
+    # head, tail, produced, consumed, consumer pid
+    HEADER = 64
+    HEAD = 0
+    TAIL = 8
+    PRODUCED = 16
+    CONSUMED = 24
+    CONSUMER = 32
+
+    # total length, topic length, qos, retain, receive time
+    RECORD = struct.Struct("=IHBBd")
+
+    # marks the unused end of the buffer, the next record is at offset 0
+    WRAP = 0xFFFFFFFF
+
+    def __init__(self, capacity):
+        self.capacity = (capacity + 7) & ~7
+        self.buf = mmap.mmap(-1, self.HEADER + self.capacity)
+        self.rfd, self.wfd = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            util.set_non_blocking(fd)
+            util.close_on_exec(fd)
+        self.next_tail = None
+
+    def _get(self, offset):
+        return struct.unpack_from("=Q", self.buf, offset)[0]
+
+    def _set(self, offset, value):
+        struct.pack_into("=Q", self.buf, offset, value)
+
+    @property
+    def consumer(self):
+        return self._get(self.CONSUMER)
+
+    @consumer.setter
+    def consumer(self, pid):
+        self._set(self.CONSUMER, pid)
+
+    def pending(self):
+        return self._get(self.PRODUCED) - self._get(self.CONSUMED)
+
+    def put(self, topic, payload, qos=0, retain=False, timestamp=None):
+        """\
+        Append a message. Returns False when the ring is full.
+        """
+        if not isinstance(topic, bytes):
+            topic = topic.encode("utf-8")
+        if not isinstance(payload, bytes):
+            payload = bytes(payload)
+
+        size = self.RECORD.size + len(topic) + len(payload)
+        aligned = (size + 7) & ~7
+        if aligned > self.capacity:
+            raise ValueError("message of %d bytes doesn't fit in the ring"
+                    % size)
+
+        head = self._get(self.HEAD)
+        tail = self._get(self.TAIL)
+        pos = head % self.capacity
+        start = head
+        if pos + aligned > self.capacity:
+            skip = self.capacity - pos
+            if head + skip + aligned - tail > self.capacity:
+                return False
+            struct.pack_into("=I", self.buf, self.HEADER + pos, self.WRAP)
+            head += skip
+            pos = 0
+        elif head + aligned - tail > self.capacity:
+            return False
+
+        offset = self.HEADER + pos
+        self.RECORD.pack_into(self.buf, offset, size, len(topic), qos,
+                bool(retain), timestamp or time.time())
+        offset += self.RECORD.size
+        self.buf[offset:offset + len(topic)] = topic
+        offset += len(topic)
+        self.buf[offset:offset + len(payload)] = payload
+
+        # publish the record, then the count
+        self._set(self.HEAD, head + aligned)
+        self._set(self.PRODUCED, self._get(self.PRODUCED) + 1)
+
+        # the consumer saw an empty ring, wake it up
+        if tail == start:
+            try:
+                os.write(self.wfd, b'.')
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EINTR):
+                    raise
+        return True
+
+    def get(self):
+        """\
+        Return the oldest message or None. The message stays in the ring
+        until ``commit`` is called, so a consumer dying half way through a
+        handler doesn't lose it.
+        """
+        tail = self._get(self.TAIL)
+        if tail == self._get(self.HEAD):
+            return None
+
+        pos = tail % self.capacity
+        if struct.unpack_from("=I", self.buf, self.HEADER + pos)[0] == self.WRAP:
+            tail += self.capacity - pos
+            self._set(self.TAIL, tail)
+            pos = 0
+
+        offset = self.HEADER + pos
+        size, topic_len, qos, retain, timestamp = \
+                self.RECORD.unpack_from(self.buf, offset)
+        start = offset + self.RECORD.size
+        topic = self.buf[start:start + topic_len]
+        payload = self.buf[start + topic_len:offset + size]
+        if str is not bytes:
+            topic = topic.decode("utf-8")
+
+        self.next_tail = tail + ((size + 7) & ~7)
+        return RingMessage(topic, payload, qos, bool(retain), timestamp)
+
+    def commit(self):
+        if self.next_tail is None:
+            return
+        self._set(self.TAIL, self.next_tail)
+        self._set(self.CONSUMED, self._get(self.CONSUMED) + 1)
+        self.next_tail = None
+
+    def wait(self, timeout):
+        """\
+        Block the consumer until the ring has data or ``timeout`` expires.
+        """
+        try:
+            while os.read(self.rfd, 512):
+                pass
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+        if self._get(self.TAIL) != self._get(self.HEAD):
+            return
+        try:
+            select.select([self.rfd], [], [], timeout)
+        except (select.error, OSError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+    def close(self):
+        for fd in (self.rfd, self.wfd):
+            os.close(fd)
+        self.buf.close()
+
+
+class HashRing(object):
+    """\
+    Consistent hashing of keys onto nodes. Changing the node set only
+    moves the keys of the nodes added or removed.
+    """
+
+    def __init__(self, nodes, replicas=64):
+        self.replicas = replicas
+        ring = []
+        for node in nodes:
+            for i in range(replicas):
+                ring.append((self.hash("%s-%s" % (node, i)), node))
+        ring.sort()
+        self.keys = [h for h, _ in ring]
+        self.nodes = [n for _, n in ring]
+
+    @staticmethod
+    def hash(key):
+        if not isinstance(key, bytes):
+            key = key.encode("utf-8")
+        return struct.unpack_from(">Q", hashlib.md5(key).digest())[0]
+
+    def get(self, key):
+        if not self.keys:
+            raise LookupError("no nodes in the hash ring")
+        i = bisect.bisect(self.keys, self.hash(key)) % len(self.keys)
+        return self.nodes[i]
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -
+#
+# This file is part of culexx released under the MIT license.
+# See the NOTICE for more information.
+
+import functools
+import heapq
+import os
+import random
+import struct
+import threading
+import time
+
+from . import util
+from .logging import default_logger as log
+from .metrics import Histogram
+
+# magic, correlation id, reply topic length
+REQUEST = struct.Struct(">4sQH")
+MAGIC = b"\xc1\x7eRQ"
+
+# first byte of a response
+OK = b"\x00"
+ERROR = b"\x01"
+
+
+class RPCError(Exception):
+    """ The remote handler failed or the request couldn't be made """
+
+
+class RPCTimeout(RPCError):
+    """ No response came in time """
+
+
+def pack_request(correlation_id, reply_topic, payload):
+    reply_topic = reply_topic.encode("utf-8")
+    return REQUEST.pack(MAGIC, correlation_id, len(reply_topic)) + \
+            reply_topic + util.payload_bytes(payload)
+
+
+def unpack_request(payload):
+    """\
+    Return (correlation id, reply topic, body) of a request, or None if
+    ``payload`` isn't one.
+    """
+    if not isinstance(payload, bytes) or not payload.startswith(MAGIC) or \
+            len(payload) < REQUEST.size:
+        return None
+    _, correlation_id, length = REQUEST.unpack_from(payload)
+    end = REQUEST.size + length
+    if len(payload) < end:
+        return None
+    return (correlation_id, payload[REQUEST.size:end].decode("utf-8"),
+            payload[end:])
+
+
+def rpc(func):
+    """\
+    Turn a topic handler into an RPC endpoint: its return value is
+    published back to the caller of ``Mosqtt.request``, an exception is
+    raised there as an ``RPCError``. Plain messages on the topic reach
+    the handler as before.
+
+    The response is published by the client that handled the request,
+    so fanout workers, which have no broker connection, can't answer:
+    the arbiter refuses to start with RPC handlers in that mode.
+    """
+    @functools.wraps(func)
+    def handler(self, payload):
+        request = unpack_request(payload)
+        if request is None:
+            return func(self, payload)
+        correlation_id, reply_topic, body = request
+        try:
+            result = func(self, body)
+        except Exception as e:
+            log.exception("RPC handler %s failed", func.__name__)
+            response = ERROR + ("%s: %s" % (type(e).__name__, e)) \
+                    .encode("utf-8")
+            result = None
+        else:
+            response = OK + util.payload_bytes(result)
+        self.publish_absolute(reply_topic, response, 1)
+        return result
+    handler.rpc = True
+    return handler
+
+
+class Future(object):
+    """\
+    The pending result of a request, with the interface of
+    ``concurrent.futures.Future`` that callers use.
+    """
+
+    def __init__(self, client, correlation_id, deadline):
+        self.client = client
+        self.correlation_id = correlation_id
+        self.deadline = deadline
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        # the network thread finishes it while others add callbacks
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._event.is_set()
+
+    def _wait(self, timeout):
+        if timeout is None:
+            timeout = max(0, self.deadline - time.time())
+        if not self._event.wait(timeout):
+            self.client.sweep()
+        if not self.done():
+            raise RPCTimeout("no response to request %016x"
+                    % self.correlation_id)
+
+    def result(self, timeout=None):
+        """\
+        Wait for the response, by default until the request times out.
+        """
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, result=None, exception=None):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                log.exception("Exception in RPC callback")
+
+    def set_result(self, result):
+        self._finish(result=result)
+
+    def set_exception(self, exception):
+        self._finish(exception=exception)
+
+
+class RPCClient(object):
+    """\
+    Makes requests for a Mosqtt client and matches the responses.
+
+    Each process subscribes once to ``<client id>/_rpc/<process id>/+``,
+    a request carries a random correlation id and the topic to answer on
+    in a small envelope before its payload. Pending requests are kept in
+    a table of at most ``max_pending`` entries and a heap of deadlines,
+    expired ones are swept on every request and response and when a
+    caller gives up waiting.
+    """
+
+    def __init__(self, mosq, timeout=10.0, max_pending=10000):
+        self.mosq = mosq
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        # correlation id -> (future, start, topic)
+        self.pending = {}
+        self.deadlines = []
+        self.latency = {}
+        self.timeouts = 0
+        self.pid = None
+        self.prefix = None
+
+    def reply_prefix(self):
+        # a forked worker needs its own reply topic
+        pid = os.getpid()
+        if self.pid != pid:
+            self.pid = pid
+            self.prefix = "%s/_rpc/%x%04x" % (self.mosq.client_id, pid,
+                    random.getrandbits(16))
+            with self.lock:
+                self.pending.clear()
+                self.deadlines = []
+            # the receiver connected before the fork came along with it
+            sig_on_connect = self.mosq.signal_mapper.sig_on_connect
+            sig_on_connect.disconnect(self.resubscribe, sender=self.mosq)
+            sig_on_connect.connect(self.resubscribe, sender=self.mosq,
+                    weak=False)
+            self.subscribe()
+        return self.prefix
+
+    def subscribe(self):
+        # not through Mosqtt.subscribe, the workers' share group would
+        # hand the responses to any of them
+        self.mosq.mqtt_client.subscribe(self.prefix + "/+", 1)
+
+    def resubscribe(self, sender, **kwargs):
+        self.subscribe()
+
+    def request(self, topic, payload, timeout=None, qos=1):
+        prefix = self.reply_prefix()
+        now = time.time()
+        self.sweep(now)
+        deadline = now + (self.timeout if timeout is None else timeout)
+        with self.lock:
+            if len(self.pending) >= self.max_pending:
+                raise RPCError("%d requests pending" % len(self.pending))
+            correlation_id = random.getrandbits(64)
+            while correlation_id in self.pending:
+                correlation_id = random.getrandbits(64)
+            future = Future(self, correlation_id, deadline)
+            self.pending[correlation_id] = (future, now, topic)
+            heapq.heappush(self.deadlines, (deadline, correlation_id))
+
+        body = pack_request(correlation_id,
+                "%s/%016x" % (prefix, correlation_id), payload)
+        try:
+            self.mosq.publish(topic, body, qos)
+        except Exception:
+            with self.lock:
+                self.pending.pop(correlation_id, None)
+                try:
+                    self.deadlines.remove((deadline, correlation_id))
+                except ValueError:
+                    # already swept
+                    pass
+                else:
+                    heapq.heapify(self.deadlines)
+            raise
+        return future
+
+    def handle_reply(self, msg):
+        """\
+        Resolve the request ``msg`` answers. Returns False if it isn't a
+        response.
+        """
+        prefix = self.prefix
+        topic = msg.topic
+        if prefix is None or not topic.startswith(prefix) or \
+                topic[len(prefix):len(prefix) + 1] != "/":
+            return False
+        try:
+            correlation_id = int(topic[len(prefix) + 1:], 16)
+        except ValueError:
+            return True
+
+        now = time.time()
+        # responses are published like any message, traced ones included
+        tracer = self.mosq.tracer
+        trace = tracer.receive(msg, now) if tracer is not None else None
+        with self.lock:
+            entry = self.pending.pop(correlation_id, None)
+        if entry is not None:
+            future, start, request_topic = entry
+            self.observe(request_topic, now - start)
+            payload = msg.payload
+            if payload[:1] == ERROR:
+                future.set_exception(RPCError(
+                    payload[1:].decode("utf-8", "replace")))
+            else:
+                future.set_result(payload[1:])
+        if trace is not None:
+            tracer.finish(trace, topic)
+        self.sweep(now)
+        return True
+
+    def observe(self, topic, seconds):
+        h = self.latency.get(topic)
+        if h is None:
+            h = self.latency[topic] = Histogram()
+        h.add(seconds)
+        metrics = self.mosq.metrics
+        if metrics is not None:
+            metrics.rpc_done(topic, seconds)
+
+    def sweep(self, now=None):
+        """\
+        Fail the requests past their deadline. Returns how many there
+        were.
+        """
+        now = now or time.time()
+        expired = []
+        with self.lock:
+            deadlines = self.deadlines
+            while deadlines and deadlines[0][0] <= now:
+                _, correlation_id = heapq.heappop(deadlines)
+                entry = self.pending.pop(correlation_id, None)
+                if entry is not None:
+                    expired.append(entry)
+            # answered requests leave their deadline behind
+            if len(deadlines) > 2 * len(self.pending) + 64:
+                self.deadlines = [(f.deadline, c) for c, (f, _, _) in
+                        self.pending.items()]
+                heapq.heapify(self.deadlines)
+        for future, start, topic in expired:
+            self.timeouts += 1
+            future.set_exception(RPCTimeout("no response on %s after "
+                "%.3fs" % (topic, now - start)))
+        return len(expired)
+
+    def summary(self, quantiles=(0.5, 0.9, 0.99)):
+        """\
+        Return topic -> (count, mean, {quantile: seconds}).
+        """
+        return dict((topic, (h.count, h.mean,
+                dict((q, h.percentile(q)) for q in quantiles)))
+            for topic, h in self.latency.items())
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -
+#
+# This file is part of culexx released under the MIT license.
+# See the NOTICE for more information.
+
+import heapq
+import itertools
+import os
+import threading
+import time
+
+from . import util
+from .logging import default_logger as log
+from .topics import TopicTree, validate_filter
+
+
+class Aggregate(object):
+    """\
+    An aggregate updated one value at a time. ``merge`` adds up the
+    aggregate of another part of the window, so a sliding window only
+    combines a few partial aggregates instead of going over its values.
+    """
+
+    def add(self, value):
+        raise NotImplementedError()
+
+    def merge(self, other):
+        raise NotImplementedError()
+
+    def result(self):
+        raise NotImplementedError()
+
+
+class Count(Aggregate):
+
+    def __init__(self):
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+
+    def merge(self, other):
+        self.count += other.count
+
+    def result(self):
+        return self.count
+
+
+class Sum(Aggregate):
+
+    def __init__(self):
+        self.total = 0
+
+    def add(self, value):
+        self.total += value
+
+    def merge(self, other):
+        self.total += other.total
+
+    def result(self):
+        return self.total
+
+
+class Mean(Aggregate):
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+
+    def result(self):
+        return self.total / self.count if self.count else None
+
+
+class Reduce(Aggregate):
+    """\
+    Folds the values with ``fn(a, b)``, which must be associative for
+    partial results to be merged, like ``min``, ``max`` or
+    ``operator.add``.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.value = None
+        self.empty = True
+
+    def add(self, value):
+        if self.empty:
+            self.value = value
+            self.empty = False
+        else:
+            self.value = self.fn(self.value, value)
+
+    def merge(self, other):
+        if not other.empty:
+            self.add(other.value)
+
+    def result(self):
+        return self.value
+
+
+AGGREGATES = {
+    "count": Count,
+    "sum": Sum,
+    "mean": Mean,
+    "min": lambda: Reduce(min),
+    "max": lambda: Reduce(max),
+}
+
+
+class Timer(object):
+    """\
+    Runs the callbacks of every stream at their due time from a single
+    thread, started on the first ``schedule`` in a process.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.heap = []
+        self.seq = itertools.count()
+        self.pid = None
+
+    def schedule(self, due, fn, *args):
+        entry = [due, next(self.seq), fn, args]
+        with self.cond:
+            heapq.heappush(self.heap, entry)
+            self.cond.notify()
+            # threads don't survive a fork
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                thread = threading.Thread(target=self.run,
+                        name="culexx-timer")
+                thread.daemon = True
+                thread.start()
+        return entry
+
+    def cancel(self, entry):
+        with self.cond:
+            entry[2] = None
+            if entry in self.heap:
+                self.heap.remove(entry)
+                heapq.heapify(self.heap)
+                self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.time()
+                    if self.heap and self.heap[0][0] <= now:
+                        entry = heapq.heappop(self.heap)
+                        break
+                    self.cond.wait(self.heap[0][0] - now if self.heap
+                            else None)
+            fn = entry[2]
+            if fn is not None:
+                try:
+                    fn(*entry[3])
+                except Exception:
+                    log.exception("Exception in timer callback %r", fn)
+
+
+default_timer = Timer()
+
+
+class Stream(object):
+    """\
+    A windowed aggregation of the messages on a topic filter::
+
+        mosq.stream("/temperature/+").window(60, every=10) \\
+                .aggregate("mean").publish("/temperature/mean")
+
+    Payloads go through ``value`` (``float`` by default, None passes them
+    unchanged) and into ``aggregate``. A window of ``seconds`` is
+    emitted every ``every`` seconds, once at its end when ``every`` is
+    left out (a tumbling window). Windows are aligned on multiples of
+    ``every`` since the epoch.
+
+    The window is split in panes of ``every`` seconds keeping one
+    partial aggregate each, so memory is bounded by the number of panes
+    whatever the message rate. With ``per_topic`` every topic is
+    aggregated on its own, for at most ``MAX_GROUPS`` topics per pane.
+    Empty windows aren't emitted.
+    """
+
+    MAX_GROUPS = 10000
+
+    def __init__(self, mosq, topic_filter, value=float, per_topic=False,
+            timer=None):
+        validate_filter(topic_filter)
+        self.mosq = mosq
+        self.topic_filter = topic_filter
+        self.value = value
+        self.per_topic = per_topic
+        self.timer = timer or default_timer
+        self.size = None
+        self.step = None
+        self.panes_per_window = 0
+        self.factory = None
+        self.emit = None
+        self.lock = threading.Lock()
+        # pane number -> {topic or None: Aggregate}
+        self.panes = {}
+        self.entry = None
+        self.dropped = 0
+        self.on_close = None
+
+    def window(self, seconds, every=None):
+        every = every or seconds
+        if seconds <= 0 or every <= 0 or every > seconds:
+            raise ValueError("invalid window of %ss every %ss"
+                    % (seconds, every))
+        panes = int(round(float(seconds) / every))
+        if abs(panes * every - seconds) > 1e-9:
+            raise ValueError("a window must last a multiple of its step")
+        self.size = seconds
+        self.step = every
+        self.panes_per_window = panes
+        return self
+
+    def aggregate(self, fn):
+        """\
+        Aggregate with ``fn``: the name of an aggregate in
+        ``AGGREGATES``, an ``Aggregate`` class or a function reducing
+        two values to one.
+        """
+        if not callable(fn):
+            self.factory = AGGREGATES[fn]
+        elif isinstance(fn, type) and issubclass(fn, Aggregate):
+            self.factory = fn
+        else:
+            self.factory = lambda: Reduce(fn)
+        return self
+
+    def publish(self, topic, qos=0, retain=False):
+        """\
+        Publish every result to ``topic``, where ``{topic}`` stands for
+        the aggregated topic with ``per_topic``.
+        """
+        def emit(group, start, end, result):
+            out = topic.format(topic=group) if self.per_topic else topic
+            self.mosq.publish(out, util.payload_bytes(result), qos, retain)
+        return self.sink(emit)
+
+    def sink(self, fn):
+        """\
+        Call ``fn(topic, start, end, result)`` with every result, and
+        start the stream. ``topic`` is None unless ``per_topic``.
+        """
+        if self.step is None or self.factory is None:
+            raise ValueError("a stream needs a window and an aggregate")
+        self.emit = fn
+        due = (int(time.time() // self.step) + 1) * self.step
+        self.entry = self.timer.schedule(due, self.tick, due)
+        return self
+
+    def close(self):
+        if self.entry is not None:
+            self.timer.cancel(self.entry)
+            self.entry = None
+        self.emit = None
+        if self.on_close is not None:
+            self.on_close(self)
+
+    def add(self, topic, payload, now=None):
+        if self.emit is None:
+            return
+        value = payload
+        if self.value is not None:
+            try:
+                value = self.value(payload)
+            except (TypeError, ValueError):
+                self.dropped += 1
+                return
+        pane = int((now or time.time()) // self.step)
+        group = topic if self.per_topic else None
+        with self.lock:
+            aggregates = self.panes.get(pane)
+            if aggregates is None:
+                aggregates = self.panes[pane] = {}
+            agg = aggregates.get(group)
+            if agg is None:
+                if len(aggregates) >= self.MAX_GROUPS:
+                    self.dropped += 1
+                    return
+                agg = aggregates[group] = self.factory()
+            agg.add(value)
+
+    def tick(self, due):
+        """\
+        Emit the window ending at ``due`` and forget the pane leaving it.
+        """
+        last = int(round(due / self.step)) - 1
+        first = last - self.panes_per_window + 1
+        with self.lock:
+            if self.panes_per_window == 1:
+                totals = self.panes.pop(last, {})
+            else:
+                totals = {}
+                for pane in range(first, last + 1):
+                    for group, agg in self.panes.get(pane, {}).items():
+                        total = totals.get(group)
+                        if total is None:
+                            total = totals[group] = self.factory()
+                        total.merge(agg)
+            for pane in [p for p in self.panes if p <= first]:
+                del self.panes[pane]
+
+        emit = self.emit
+        if emit is None:
+            return
+        self.entry = self.timer.schedule(due + self.step, self.tick,
+                due + self.step)
+        for group in sorted(totals):
+            try:
+                emit(group, due - self.size, due, totals[group].result())
+            except Exception:
+                log.exception("Stream on %s failed to emit",
+                        self.topic_filter)
+
+
+class StreamSet(object):
+    """\
+    The streams of a client, found by the topics they match.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tree = TopicTree()
+
+    def __len__(self):
+        return len(self.tree)
+
+    def add(self, stream):
+        with self.lock:
+            self.tree.add(stream.topic_filter, stream)
+        stream.on_close = self.remove
+
+    def remove(self, stream):
+        with self.lock:
+            self.tree.remove(stream.topic_filter, stream)
+
+    def filters(self):
+        return [topic_filter for topic_filter, _ in self.tree.items()]
+
+    def match(self, topic):
+        return self.tree.match(topic)
+
+    def feed(self, topic, payload, now=None):
+        for stream in self.tree.match(topic):
+            stream.add(topic, payload, now)
@@ -0,0 +1,103 @@
+from __future__ import absolute_import
+
+from nose.plugins.skip import SkipTest
+from nose.tools import raises
+from mock import Mock, patch
+
+from .. import util
+from ..base import Base
+from ..config import Config
+from ..errors import ConfigError
+
+
+def test_parse_cpu_list():
+    assert util.parse_cpu_list('0-3,8,10-11') == [0, 1, 2, 3, 8, 10, 11]
+    assert util.parse_cpu_list(' 2, 1,1-2,') == [1, 2]
+    assert util.parse_cpu_list('') == []
+
+
+@raises(ValueError)
+def test_parse_cpu_list_rejects_garbage():
+    util.parse_cpu_list('0-a')
+
+
+def test_set_cpu_affinity():
+    cpus = util.get_cpu_affinity()
+    if cpus is None:
+        raise SkipTest("CPU affinity is not supported here")
+    try:
+        assert util.set_cpu_affinity(cpus[:1])
+        assert util.get_cpu_affinity() == cpus[:1]
+    finally:
+        util.set_cpu_affinity(cpus)
+    assert util.get_cpu_affinity() == cpus
+
+
+class TestCpuAffinitySetting:
+
+    def setUp(self):
+        self.cfg = Config()
+
+    def test_default_is_off(self):
+        assert self.cfg.cpu_affinity is None
+
+    def test_cpu_list(self):
+        self.cfg.set('cpu_affinity', '0-3,8')
+        assert self.cfg.cpu_affinity == '0-3,8'
+        self.cfg.set('cpu_affinity', 'auto')
+        assert self.cfg.cpu_affinity == 'auto'
+
+    @raises(ConfigError)
+    def test_invalid_cpu_list(self):
+        self.cfg.set('cpu_affinity', '1-x')
+
+    @raises(ConfigError)
+    def test_empty_cpu_list(self):
+        self.cfg.set('cpu_affinity', ',')
+
+
+class TestCpusForSlot:
+
+    def setUp(self):
+        self.base = Base.__new__(Base)
+        self.base.cfg = Config()
+        self.base.log = Mock()
+
+    def pool(self, cpu_affinity, master_cpu=None):
+        self.base.cfg.set('cpu_affinity', cpu_affinity)
+        with patch.object(util, 'available_cpus', return_value=[0, 1, 2, 8]):
+            if master_cpu is not None:
+                self.base.cfg.set('master_cpu', str(master_cpu))
+            with patch.object(util, 'set_cpu_affinity') as set_cpu_affinity:
+                self.base.init_affinity()
+        if master_cpu is not None:
+            set_cpu_affinity.assert_called_once_with([master_cpu])
+        return self.base.cpus_for_slot
+
+    def test_off(self):
+        self.base.cpu_pool = None
+        assert self.base.cpus_for_slot(0) is None
+
+    def test_round_robin(self):
+        cpus_for_slot = self.pool('0-3')
+        assert [cpus_for_slot(s) for s in range(5)] == \
+                [[0], [1], [2], [3], [0]]
+
+    def test_several_cpus_per_worker(self):
+        self.base.cfg.set('cpus_per_worker', '2')
+        cpus_for_slot = self.pool('0-2,8', master_cpu=8)
+        assert [cpus_for_slot(s) for s in range(3)] == \
+                [[0, 1], [2, 0], [1, 2]]
+
+    def test_master_cpu_alone(self):
+        cpus_for_slot = self.pool(None, master_cpu=8)
+        assert [cpus_for_slot(s) for s in range(2)] == [[0, 1, 2]] * 2
+
+    @raises(ConfigError)
+    def test_master_cpu_not_available(self):
+        with patch.object(util, 'available_cpus', return_value=[0, 1]):
+            self.base.cfg.set('master_cpu', '8')
+
+    def test_more_cpus_per_worker_than_available(self):
+        self.base.cfg.set('cpus_per_worker', '4')
+        assert self.pool('2,3')(1) == [2, 3]
@@ -0,0 +1,102 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import time
+
+from ..archive import Archive, INDEX_SUFFIX, read_index
+
+
+class TestArchive:
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.archive = Archive(self.dir, 'archive-1', segment_size=4096,
+                index_interval=512).start()
+
+    def tearDown(self):
+        self.archive.close()
+        shutil.rmtree(self.dir)
+
+    def fill(self, count=200):
+        for i in range(count):
+            topic = 'site/%d/%s' % (i % 4, 'temp' if i % 2 else 'hum')
+            self.archive.append(topic, b'%04d' % i + b'.' * 40, 1000.0 + i)
+        self.archive.flush()
+
+    def test_read_by_topic_and_time(self):
+        self.fill()
+        assert len(self.archive.segments()) > 1
+        recs = list(self.archive.read('site/1/#', 1050, 1100))
+        assert [r[0] for r in recs] == \
+                [1000.0 + i for i in range(50, 101) if i % 4 == 1]
+        assert all(r[1] == 'site/1/temp' for r in recs)
+        assert recs[0][2].startswith(b'0053')
+        assert len(list(self.archive.read())) == 200
+
+    def test_index_is_sparse(self):
+        self.fill()
+        path = self.archive.segments()[0]
+        entries = read_index(path + INDEX_SUFFIX)
+        assert 1 < len(entries) < 20
+        start, end, earliest, latest, topics = entries[0]
+        assert earliest == 1000.0
+        assert set(topics) == set(['site/0/hum', 'site/1/temp',
+            'site/2/hum', 'site/3/temp'])
+
+    def test_unindexed_tail_is_read(self):
+        self.archive.append('a', b'x', 5.0)
+        self.archive.flush()
+        os.unlink(self.archive.segments()[0] + INDEX_SUFFIX)
+        assert list(self.archive.read('a')) == [(5.0, 'a', b'x', 0, False)]
+
+    def test_retention_by_size(self):
+        self.archive.retention_bytes = 8192
+        self.fill(400)
+        self.archive.enforce_retention()
+        paths = self.archive.segments()
+        assert sum(os.path.getsize(p) for p in paths) <= 8192 + 4096
+        assert not os.path.exists(
+                self.archive.writer.segment_path(1) + INDEX_SUFFIX)
+        recs = list(self.archive.read())
+        assert recs[-1][0] == 1399.0
+
+    def test_retention_by_age(self):
+        self.fill(400)
+        old = self.archive.segments()[0]
+        os.utime(old, (time.time() - 100, time.time() - 100))
+        self.archive.retention_age = 50
+        assert self.archive.enforce_retention() == [old]
+
+    def test_retention_spares_other_writers(self):
+        other = Archive(self.dir, 'archive-2', segment_size=4096,
+                index_interval=512).start()
+        try:
+            other.append('b', b'x' * 100, 1.0)
+            other.flush()
+            open_segment = other.writer.path
+            self.archive.retention_bytes = 6000
+            self.fill(400)
+            self.archive.enforce_retention()
+            assert os.path.exists(open_segment)
+            other.append('b', b'y' * 100, 2.0)
+            other.flush()
+            assert [r[2][:1] for r in other.read('b')] == [b'x', b'y']
+        finally:
+            other.close()
+
+    def test_write_errors_keep_draining(self):
+        self.archive.append('a', None, 1.0)
+        self.archive.append('a', b'x', 2.0)
+        self.archive.flush()
+        assert self.archive.failed == 1
+        assert self.archive.thread.is_alive()
+        assert [r[2] for r in self.archive.read('a')] == [b'x']
+
+    def test_append_drops_when_full(self):
+        archive = Archive(self.dir, 'archive-2', segment_size=4096,
+                index_interval=512, queue_size=2)
+        # not started, nothing drains the queue
+        assert archive.append('a', b'x') and archive.append('a', b'y')
+        assert not archive.append('a', b'z')
+        assert archive.dropped == 1
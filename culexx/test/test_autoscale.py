@@ -0,0 +1,75 @@
+from __future__ import absolute_import
+
+from ..autoscale import Autoscaler
+from ..worker import WorkerStatus
+
+
+def status(backlog=0, latency=0.0):
+    return {'backlog': backlog, 'latency': latency}
+
+
+class TestAutoscaler:
+
+    def setUp(self):
+        self.scaler = Autoscaler(1, 4, up_backlog=100, down_backlog=10,
+                max_latency=0.5, up_cooldown=10, down_cooldown=60)
+        self.scaler.last_change = 0
+
+    def test_clamps_current_count(self):
+        assert self.scaler.target(0, [], now=100) == 1
+        assert self.scaler.target(6, [], now=100) == 4
+
+    def test_no_statuses_keeps_count(self):
+        assert self.scaler.target(2, [], now=100) == 2
+
+    def test_scale_up_on_backlog(self):
+        assert self.scaler.target(1, [status(backlog=250)], now=100) == 3
+
+    def test_scale_up_on_latency(self):
+        assert self.scaler.target(1, [status(latency=0.8)], now=100) == 2
+
+    def test_scale_up_bounded_by_max(self):
+        assert self.scaler.target(2, [status(5000), status(5000)], now=100) == 4
+
+    def test_scale_up_cooldown(self):
+        assert self.scaler.target(1, [status(backlog=150)], now=100) == 2
+        assert self.scaler.target(2, [status(300), status(300)], now=105) == 2
+        assert self.scaler.target(2, [status(300), status(300)], now=111) == 4
+
+    def test_scale_down_one_at_a_time(self):
+        statuses = [status(), status(), status()]
+        assert self.scaler.target(3, statuses, now=100) == 2
+        assert self.scaler.target(2, statuses[:2], now=130) == 2
+        assert self.scaler.target(2, statuses[:2], now=161) == 1
+        assert self.scaler.target(1, statuses[:1], now=300) == 1
+
+    def test_scale_down_hysteresis(self):
+        # 15 messages spread over one worker less would be above the
+        # scale down threshold
+        assert self.scaler.target(2, [status(10), status(5)], now=100) == 2
+
+    def test_no_scale_down_while_latency_high(self):
+        statuses = [status(latency=0.3), status(latency=0.3)]
+        assert self.scaler.target(2, statuses, now=100) == 2
+
+
+class TestWorkerStatus:
+
+    def setUp(self):
+        self.status = WorkerStatus()
+
+    def tearDown(self):
+        self.status.close()
+
+    def test_initial_values(self):
+        assert self.status.read() == {'heartbeat': 0.0, 'latency': 0.0,
+                'backlog': 0, 'processed': 0, 'state': WorkerStatus.BOOTING,
+                'startup': 0.0, 'rss': 0, 'shared': 0, 'recycle': 0,
+                'profile': 0.0, 'memory': 0}
+
+    def test_update(self):
+        self.status.update(backlog=12, latency=0.25,
+                state=WorkerStatus.RUNNING)
+        assert self.status.get('backlog') == 12
+        assert self.status.get('latency') == 0.25
+        assert self.status.get('state') == WorkerStatus.RUNNING
@@ -0,0 +1,31 @@
+from __future__ import absolute_import
+
+from ..bench import expected_deliveries, parse_args, run_step, split, \
+        subscriber_topics
+from ..broker import Broker
+
+
+def test_split():
+    assert split(5, 2) == [[0, 2, 4], [1, 3]]
+    assert split(2, 4) == [[0], [1]]
+
+
+def test_fanout():
+    opts = parse_args(['-s', '3', '-t', '4', '--topics-per-subscriber', '2'])
+    assert subscriber_topics(3, opts) == [3, 0]
+    # topics 0..3 are read by 1, 2, 2 and 1 subscribers
+    assert expected_deliveries(opts, [10, 10, 10, 10]) == 60
+    opts.shared = True
+    assert expected_deliveries(opts, [10, 10, 10, 10]) == 40
+
+
+def test_run_step():
+    with Broker() as broker:
+        opts = parse_args(['--broker', '127.0.0.1:%d' % broker.port,
+            '-p', '2', '-s', '2', '-t', '2', '-q', '1', '-d', '0.3',
+            '--drain', '1'])
+        step = run_step(opts, 100)
+    assert step['published'] > 0
+    assert step['expected'] == 2 * step['published']
+    assert step['received'] == step['expected']
+    assert step['latency']['p50'] > 0
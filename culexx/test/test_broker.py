@@ -0,0 +1,91 @@
+from __future__ import absolute_import
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from ..broker import Broker
+
+
+class Collector(object):
+
+    def __init__(self, broker, client_id, subscriptions=()):
+        self.messages = []
+        self.subscribed = threading.Event()
+        self.client = mqtt.Client(client_id)
+        self.client.on_message = self.on_message
+        self.client.on_subscribe = lambda *args: self.subscribed.set()
+        self.client.connect('127.0.0.1', broker.port)
+        self.client.loop_start()
+        if subscriptions:
+            self.client.subscribe(list(subscriptions))
+            assert self.subscribed.wait(5)
+
+    def on_message(self, client, userdata, msg):
+        self.messages.append((msg.topic, msg.payload, msg.qos, msg.retain))
+
+    def wait(self, count, timeout=5):
+        deadline = time.time() + timeout
+        while len(self.messages) < count and time.time() < deadline:
+            time.sleep(0.01)
+        return self.messages
+
+    def close(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+class TestBroker:
+
+    def setUp(self):
+        self.broker = Broker().start()
+        self.clients = []
+
+    def tearDown(self):
+        for c in self.clients:
+            c.close()
+        self.broker.stop()
+
+    def collector(self, client_id, subscriptions=()):
+        c = Collector(self.broker, client_id, subscriptions)
+        self.clients.append(c)
+        return c
+
+    def test_wildcards_and_qos(self):
+        sub = self.collector('sub', [('a/+', 2), ('b/#', 1)])
+        pub = self.collector('pub')
+        pub.client.publish('a/x', b'0', qos=0)
+        pub.client.publish('a/y', b'2', qos=2)
+        pub.client.publish('b/c/d', b'1', qos=2)
+        pub.client.publish('c', b'-', qos=1)
+        messages = sorted(sub.wait(3))
+        time.sleep(0.1)
+        assert messages == [('a/x', b'0', 0, False), ('a/y', b'2', 2, False),
+                ('b/c/d', b'1', 1, False)], messages
+
+    def test_retained(self):
+        pub = self.collector('pub')
+        pub.client.publish('r/1', b'kept', qos=1, retain=True).wait_for_publish()
+        pub.client.publish('r/2', b'gone', qos=1, retain=True).wait_for_publish()
+        pub.client.publish('r/2', b'', qos=1, retain=True).wait_for_publish()
+        sub = self.collector('sub', [('r/#', 1)])
+        assert sub.wait(1) == [('r/1', b'kept', 1, True)]
+        time.sleep(0.1)
+        assert len(sub.messages) == 1
+
+    def test_shared_subscriptions(self):
+        first = self.collector('first', [('$share/g/s/+', 1)])
+        second = self.collector('second', [('$share/g/s/+', 1)])
+        pub = self.collector('pub')
+        for i in range(10):
+            pub.client.publish('s/%d' % i, b'x', qos=1)
+        deadline = time.time() + 5
+        while len(first.messages) + len(second.messages) < 10 and \
+                time.time() < deadline:
+            time.sleep(0.01)
+        assert len(first.messages) == len(second.messages) == 5
+
+    def test_publish_from_the_broker(self):
+        sub = self.collector('sub', [('t', 0)])
+        self.broker.publish('t', u'hi')
+        assert sub.wait(1) == [('t', b'hi', 0, False)]
@@ -0,0 +1,70 @@
+from __future__ import absolute_import
+
+from mock import Mock
+
+from ..cache import LastValueCache
+from ..mosqtt import Mosqtt
+from ..ring import RingMessage
+
+
+class TestLastValueCache:
+
+    def setUp(self):
+        self.cache = LastValueCache(max_entries=3)
+
+    def test_lookup_and_query(self):
+        self.cache.update('s/1/temp', b'20')
+        self.cache.update('s/2/temp', b'21')
+        self.cache.update('s/2/hum', b'50')
+        assert self.cache.get('s/1/temp') == b'20'
+        assert self.cache.get('s/3/temp', b'-') == b'-'
+        assert self.cache.query('s/+/temp') == {'s/1/temp': b'20',
+                's/2/temp': b'21'}
+        assert len(self.cache.query('s/#')) == 3
+        assert self.cache.query('#') == self.cache.query('s/#')
+
+    def test_lru_eviction(self):
+        for i in range(3):
+            self.cache.update('t/%d' % i, b'x')
+        self.cache.get('t/0')
+        self.cache.update('t/3', b'x')
+        assert 't/1' not in self.cache
+        assert 't/0' in self.cache
+        assert self.cache.query('t/+') == dict(
+                ('t/%d' % i, b'x') for i in (0, 2, 3))
+        assert self.cache.evicted == 1
+
+    def test_ttl(self):
+        cache = LastValueCache(ttl=10)
+        cache.update('a', b'old', timestamp=1.0)
+        cache.update('b', b'new')
+        assert cache.get('a') is None
+        assert cache.query('#') == {'b': b'new'}
+        cache.update('c', b'old', timestamp=1.0)
+        assert cache.expire() == 1
+        assert len(cache) == 1
+
+    def test_change_notifications(self):
+        changes = Mock()
+        self.cache.on_change(changes, 's/+')
+        assert self.cache.update('s/1', b'a')
+        assert not self.cache.update('s/1', b'a')
+        self.cache.update('s/1', b'b')
+        self.cache.update('other', b'b')
+        self.cache.update('s/1', b'', retain=True)
+        assert 's/1' not in self.cache
+        assert [c[0] for c in changes.call_args_list] == [('s/1', b'a', None),
+                ('s/1', b'b', b'a'), ('s/1', None, b'b')]
+
+
+class CachingClient(Mosqtt):
+    LAST_VALUE_CACHE_SIZE = 100
+
+
+def test_dispatch_feeds_the_cache():
+    client = CachingClient(name='000')
+    client.signal_mapper.dispatch(None, None,
+            RingMessage(client.normalize_topic('/s/1'), b'7'))
+    assert client.last_value('/s/1') == b'7'
+    assert client.last_values('/s/+') == {'/s/1': b'7'}
+    assert Mosqtt().cache is None
@@ -0,0 +1,144 @@
+from __future__ import absolute_import
+import os
+import shutil
+import sys
+import tempfile
+
+from nose.tools import raises
+from mock import patch
+
+from .. import config, util
+from ..base import Base
+from ..config import Config
+
+
+class TestLazySettings:
+
+    def setUp(self):
+        self.cfg = Config()
+
+    def test_defaults_are_validated_on_first_use(self):
+        with patch.object(config.Chdir, 'validator') as validator:
+            validator.return_value = '/tmp'
+            cfg = Config()
+            assert not validator.called
+            assert cfg.chdir == '/tmp'
+            assert cfg.chdir == '/tmp'
+            validator.assert_called_once_with('.')
+
+    def test_chdir_default_is_the_current_directory(self):
+        assert self.cfg.chdir == os.path.abspath(os.getcwd())
+
+    def test_set_overrides_default(self):
+        self.cfg.set('workers', '4')
+        assert self.cfg.workers == 4
+
+    @raises(ValueError)
+    def test_set_validates(self):
+        self.cfg.set('workers', '-4')
+
+    def test_user_and_group_default_to_current_ids(self):
+        assert self.cfg.uid == os.geteuid()
+        assert self.cfg.gid == os.getegid()
+
+    def test_parser(self):
+        args = self.cfg.parser().parse_args(['-w', '3', 'app:application'])
+        assert args.workers == 3
+        assert args.args == ['app:application']
+
+
+class TestConfigFileCache:
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'culexx.conf.py')
+        self.write('workers = 3\nloglevel = "debug"\n')
+        Base.CONFIG_CACHE.clear()
+        self.base = Base.__new__(Base)
+        self.base.cfg = Config()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, source, mtime=1000000000):
+        with open(self.filename, 'w') as f:
+            f.write(source)
+        os.utime(self.filename, (mtime, mtime))
+
+    def test_load(self):
+        self.base.load_config_from_file(self.filename)
+        assert self.base.cfg.workers == 3
+        assert self.base.cfg.loglevel == 'debug'
+
+    def test_unchanged_file_is_neither_compiled_nor_validated_again(self):
+        self.base.load_config_from_file(self.filename)
+        self.base.cfg = Config()
+        with patch.object(util, 'compile_file') as compile_file:
+            with patch.object(config.Workers, 'validator') as validator:
+                self.base.load_config_from_file(self.filename)
+                assert not compile_file.called
+                assert not validator.called
+        assert self.base.cfg.workers == 3
+
+    def test_changed_file_is_reloaded(self):
+        self.base.load_config_from_file(self.filename)
+        self.write('workers = 5\n', mtime=1000000100)
+        self.base.load_config_from_file(self.filename)
+        assert self.base.cfg.workers == 5
+
+    def test_disk_cache(self):
+        stamp = util.file_stamp(self.filename)
+        with patch.object(sys, 'dont_write_bytecode', False):
+            code = util.compile_file(self.filename, stamp, cache=True)
+        assert os.path.exists(self.filename + util.CACHE_SUFFIX)
+        assert not os.path.exists(self.filename + 'c')
+
+        util._compiled_files.clear()
+        with patch.object(util, 'compile') as compile_:
+            cached = util.compile_file(self.filename, stamp, cache=True)
+            assert not compile_.called
+        assert cached.co_filename == code.co_filename
+
+    def test_disk_cache_not_written_without_bytecode(self):
+        util._compiled_files.clear()
+        with patch.object(sys, 'dont_write_bytecode', True):
+            util.compile_file(self.filename, cache=True)
+        assert os.listdir(self.dir) == [os.path.basename(self.filename)]
+
+
+class TestRereadConfig:
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'culexx.conf.py')
+        self.write('workers = 3\nfanout = False\n', 1000000000)
+        Base.CONFIG_CACHE.clear()
+        self.base = Base.__new__(Base)
+        self.base.cfg = Config()
+        self.base.usage = self.base.prog = None
+        self.base.config_file = self.filename
+        self.base.cli_args = self.base.cfg.parser().parse_args(['-t', '10'])
+        self.base.load_config_from_file(self.filename)
+        self.base.apply_cli_args(self.base.cli_args)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, source, mtime):
+        with open(self.filename, 'w') as f:
+            f.write(source)
+        os.utime(self.filename, (mtime, mtime))
+
+    def test_unchanged(self):
+        assert self.base.reread_config() == ([], [])
+
+    def test_live_and_restart_settings(self):
+        self.write('workers = 5\nfanout = True\nloglevel = "debug"\n'
+                'timeout = 60\n', 1000000100)
+        changed, restart = self.base.reread_config()
+        assert changed == ['loglevel', 'workers']
+        assert restart == ['fanout']
+        assert self.base.cfg.workers == 5
+        assert self.base.cfg.fanout is False
+        # the command line still wins
+        assert self.base.cfg.timeout == 10
@@ -0,0 +1,125 @@
+from __future__ import absolute_import
+from nose.plugins.skip import SkipTest
+from nose.tools import raises
+from mock import Mock
+import threading
+import time
+
+from ..consumer import DROP, MessageIterator
+
+
+def test_iterates_until_closed():
+    it = MessageIterator('/t', maxsize=10)
+    for n in range(3):
+        assert it.put(n)
+    it.close()
+    assert not it.put(3)
+    assert list(it) == [0, 1, 2]
+
+
+def test_drop_policy():
+    it = MessageIterator('/t', maxsize=2, policy=DROP)
+    assert [it.put(n) for n in range(4)] == [True, True, False, False]
+    assert it.dropped == 2
+    assert it.get() == 0
+
+
+def test_pause_waits_for_the_consumer():
+    it = MessageIterator('/t', maxsize=1)
+    it.put(0)
+    done = threading.Event()
+
+    def producer():
+        it.put(1)
+        done.set()
+    t = threading.Thread(target=producer)
+    t.start()
+    assert not done.wait(0.1)
+    assert it.get() == 0
+    assert done.wait(5)
+    t.join()
+    assert it.get() == 1
+    assert it.get(timeout=0.01) is None
+
+
+def test_pause_gives_up_after_timeout():
+    it = MessageIterator('/t', maxsize=1, timeout=0.01)
+    it.put(0)
+    assert not it.put(1)
+    assert it.dropped == 1
+
+
+def test_cancelled_waiter_respects_maxsize():
+    it = MessageIterator('/t', maxsize=1)
+    cancelled = Mock()
+    cancelled.cancelled.return_value = True
+    it._resolve(cancelled, 0)
+    assert list(it.items) == [0]
+    it._resolve(cancelled, 1)
+    assert list(it.items) == [0]
+    assert it.dropped == 1
+    assert not cancelled.set_result.called
+
+
+@raises(ValueError)
+def test_unknown_policy():
+    MessageIterator('/t', policy='spill')
+
+
+def test_async_iteration():
+    try:
+        import asyncio
+    except ImportError:
+        raise SkipTest("no asyncio")
+    it = MessageIterator('/t')
+    it.put(0)
+
+    def feed():
+        time.sleep(0.05)
+        it.put(1)
+        it.close()
+    threading.Thread(target=feed).start()
+
+    async_for = """
+async def consume(it):
+    return [msg async for msg in it]
+"""
+    namespace = {}
+    eval(compile(async_for, '<async_for>', 'exec'), namespace)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        assert loop.run_until_complete(namespace['consume'](it)) == [0, 1]
+    finally:
+        loop.close()
+
+
+def test_client_messages():
+    from ..mosqtt import Mosqtt
+
+    client = Mosqtt(name='000')
+    client._setup = True
+    client.subscribe = Mock()
+    client.unsubscribe = Mock()
+    with client.messages('/orders/+', maxsize=10) as it:
+        client.subscribe.assert_called_once_with('/orders/+')
+        client.signal_mapper.dispatch(None, None, Mock(
+            topic='mqttc-000/orders/1', payload=b'x', qos=1, retain=False))
+        client.signal_mapper.dispatch(None, None, Mock(
+            topic='mqttc-000/other', payload=b'y', qos=1, retain=False))
+        msg = it.get()
+        assert (msg.topic, msg.payload) == ('/orders/1', b'x')
+        assert len(it) == 0
+    client.unsubscribe.assert_called_once_with('/orders/+')
+    assert list(it) == []
+
+
+def test_pause_calls_on_wait():
+    calls = []
+    it = MessageIterator('/t', maxsize=1, timeout=0.05,
+            on_wait=lambda: calls.append(len(it)))
+    it.WAIT_INTERVAL = 0.01
+    it.put(0)
+    assert not it.put(1)
+    assert len(calls) >= 2
+    assert calls[0] == 1
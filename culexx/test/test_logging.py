@@ -0,0 +1,251 @@
+from __future__ import absolute_import
+import logging
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+from ..config import Config
+from ..logging import BufferedFileHandler, Logger, QueueHandler
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def emit(self, record):
+        self.gate.wait()
+        self.messages.append(self.format(record))
+
+
+class TestQueueHandler:
+
+    def setUp(self):
+        self.target = ListHandler()
+        self.target.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        self.log = logging.getLogger('culexx.test.queue')
+        self.log.propagate = False
+        self.log.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        self.target.gate.set()
+        self.handler.close()
+        self.log.removeHandler(self.handler)
+
+    def add(self, maxsize=100):
+        self.handler = QueueHandler(self.target, maxsize)
+        self.log.addHandler(self.handler)
+
+    def test_records_are_written_by_listener(self):
+        self.add()
+        self.log.info('hello %s', 'world')
+        self.handler.close()
+        assert self.target.messages == ['INFO hello world']
+
+    def test_full_queue_drops_and_reports(self):
+        self.target.gate.clear()
+        self.add(maxsize=2)
+        for i in range(10):
+            self.log.info('message %d', i)
+        assert self.handler.dropped >= 6
+        self.target.gate.set()
+        while not self.handler.queue.empty():
+            time.sleep(0.01)
+        self.log.info('last')
+        self.handler.close()
+        assert self.target.messages[-1] == 'INFO last'
+        assert any(m.startswith('WARNING Dropped') for m in self.target.messages)
+
+    def test_exception_text_is_captured(self):
+        self.add()
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            self.log.exception('failed')
+        self.handler.close()
+        assert 'ValueError: boom' in self.target.messages[0]
+
+    def test_respects_target_level(self):
+        self.target.setLevel(logging.WARNING)
+        self.add()
+        self.log.info('ignored')
+        self.log.warning('kept')
+        self.handler.close()
+        assert self.target.messages == ['WARNING kept']
+
+    def test_close_closes_target(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            target = logging.FileHandler(path)
+            self.handler = QueueHandler(target)
+            self.log.addHandler(self.handler)
+            self.log.info('hello')
+            self.handler.close()
+            assert target.stream is None
+            with open(path) as f:
+                assert f.read() == 'hello\n'
+        finally:
+            os.unlink(path)
+
+
+class TestBufferedFileHandler:
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'error.log')
+        self.log = logging.getLogger('culexx.test.file')
+        self.log.propagate = False
+        self.log.setLevel(logging.DEBUG)
+        self.handler = None
+
+    def tearDown(self):
+        if self.handler is not None:
+            self.handler.close()
+            self.log.removeHandler(self.handler)
+        shutil.rmtree(self.dir)
+
+    def add(self, **kwargs):
+        self.handler = BufferedFileHandler(self.path, **kwargs)
+        self.handler.setFormatter(logging.Formatter('%(message)s'))
+        self.log.addHandler(self.handler)
+
+    def read(self, path=None):
+        with open(path or self.path) as f:
+            return f.read()
+
+    def test_buffers_until_size_threshold(self):
+        self.add(buffer_size=16, flush_interval=60)
+        self.log.info('one')
+        assert self.read() == ''
+        self.log.info('two is longer')
+        assert self.read() == 'one\ntwo is longer\n'
+
+    def test_errors_are_written_right_away(self):
+        self.add(flush_interval=60)
+        self.log.error('broken')
+        assert self.read() == 'broken\n'
+
+    def test_after_fork_drops_parent_buffer(self):
+        self.add(flush_interval=60)
+        self.log.info('parent')
+        # as if inherited by a forked worker while another thread held it
+        self.handler.pid = -1
+        self.handler.lock.acquire()
+        self.handler.after_fork()
+        assert self.handler.fd is None
+        assert self.handler.buffer == []
+        self.log.removeHandler(self.handler)
+        self.handler = None
+        assert self.read() == ''
+
+    def test_flush_due_after_interval(self):
+        self.add(flush_interval=60)
+        self.log.info('waiting')
+        self.handler.flush_due()
+        assert self.read() == ''
+        self.handler.flush_due(time.time() + 61)
+        assert self.read() == 'waiting\n'
+
+    def test_close_writes_buffer(self):
+        self.add(flush_interval=60)
+        self.log.info('last words')
+        self.handler.close()
+        self.log.removeHandler(self.handler)
+        self.handler = None
+        assert self.read() == 'last words\n'
+
+    def test_rotates_by_size(self):
+        self.add(buffer_size=0, max_bytes=10, backup_count=2)
+        for msg in ('aaaaaaa', 'bbbbbbb', 'ccccccc', 'ddddddd'):
+            self.log.info(msg)
+        assert self.read() == 'ddddddd\n'
+        assert self.read(self.path + '.1') == 'ccccccc\n'
+        assert self.read(self.path + '.2') == 'bbbbbbb\n'
+        assert not os.path.exists(self.path + '.3')
+
+    def test_reopens_file_rotated_by_another_process(self):
+        self.add(buffer_size=0, max_bytes=10)
+        other = BufferedFileHandler(self.path, buffer_size=0, max_bytes=10)
+        other.setFormatter(logging.Formatter('%(message)s'))
+        self.log.info('aaaaaaa')
+        other.handle(logging.makeLogRecord({'msg': 'bbbbbbb'}))
+        self.log.info('ccccccc')
+        other.close()
+        assert self.read() == 'bbbbbbb\nccccccc\n'
+        assert self.read(self.path + '.1') == 'aaaaaaa\n'
+
+    def test_reopen_after_external_rotation(self):
+        self.add(flush_interval=60)
+        self.log.info('before')
+        os.rename(self.path, self.path + '.old')
+        self.handler.reopen()
+        self.log.error('after')
+        assert self.read(self.path + '.old') == 'before\n'
+        assert self.read() == 'after\n'
+
+
+class TestAfterFork:
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'error.log')
+        self.cfg = Config()
+        self.cfg.set('errorlog', self.path)
+        self.cfg.set('log_queue', True)
+        self.logger = Logger(self.cfg)
+
+    def tearDown(self):
+        self.cfg.set('errorlog', '-')
+        self.cfg.set('log_queue', False)
+        self.logger.setup(self.cfg)
+        shutil.rmtree(self.dir)
+
+    def culexx_handlers(self):
+        return [h for log in (self.logger.error_log, logging.getLogger())
+                for h in log.handlers if getattr(h, '_culexx', False)]
+
+    def test_child_doesnt_wait_on_locks_held_at_fork(self):
+        # as if the listener threads were writing when the worker forked
+        locks = []
+        for h in self.culexx_handlers():
+            locks.extend([h.lock, h.target.lock, h.queue.mutex])
+        held, done = threading.Event(), threading.Event()
+
+        def hold():
+            for lock in locks:
+                lock.acquire()
+            held.set()
+            done.wait()
+            for lock in locks:
+                lock.release()
+        holder = threading.Thread(target=hold)
+        holder.start()
+        held.wait()
+        try:
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    signal.alarm(5)
+                    self.logger.after_fork()
+                    self.logger.setup(self.cfg)
+                    self.logger.error('from the child')
+                    for h in self.culexx_handlers():
+                        h.close()
+                    status = 0
+                finally:
+                    os._exit(status)
+        finally:
+            done.set()
+            holder.join()
+        _, status = os.waitpid(pid, 0)
+        assert status == 0
+        with open(self.path) as f:
+            assert 'from the child' in f.read()
@@ -0,0 +1,58 @@
+from __future__ import absolute_import
+
+from ..memprof import AllocationTracker, count_diff, structure_sizes
+from ..mosqtt import Mosqtt
+
+kept = []
+
+
+class Client(Mosqtt):
+
+    class Meta(object):
+        topic_handlers = {'/grow': 'handle_grow', '/idle': 'handle_idle'}
+
+    def handle_grow(self, payload):
+        kept.append([payload])
+
+    def handle_idle(self, payload):
+        return len([payload] * 10)
+
+
+def test_count_diff():
+    assert count_diff({'list': 3, 'dict': 1}, {'list': 1, 'tuple': 2}) == \
+            {'list': 2, 'dict': 1, 'tuple': -2}
+
+
+class TestMemoryReports:
+
+    def setUp(self):
+        del kept[:]
+        self.client = Client(name='000')
+
+    def test_structure_sizes(self):
+        self.client._subscribe_mids[1] = 'mqttc-000/grow'
+        sizes = structure_sizes(self.client)
+        assert sizes['_subscribe_mids'] == 1
+        assert sizes['subscriptions'] == 0
+        assert sizes['recorder'] == 0
+
+    def test_growth_is_attributed_to_handler(self):
+        tracker = AllocationTracker(frames=8, sample_every=2)
+        tracker.start()
+        self.client.memory = tracker
+        try:
+            for _ in range(20):
+                self.client.topic_mapper.handle_topic('mqttc-000/grow', b'x')
+                self.client.topic_mapper.handle_topic('mqttc-000/idle', b'x')
+            report = tracker.report({'subscriptions': 3})
+        finally:
+            tracker.stop()
+        grow = tracker.total['handle_grow [/grow]']
+        idle = tracker.total['handle_idle [/idle]']
+        assert (grow.calls, grow.sampled) == (20, 10)
+        assert grow.types['list'] == 10
+        assert idle.objects == 0
+        assert 'handle_grow [/grow]' in report
+        assert 'subscriptions' in report
+        # the next report starts over
+        assert tracker.recent['handle_grow [/grow]'].calls == 0
@@ -0,0 +1,193 @@
+from __future__ import absolute_import
+from mock import Mock
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from ..metrics import Histogram, Metrics, MetricsBuffer, MetricsServer, \
+        merge_snapshots, render
+
+
+class TestHistogram:
+
+    def test_value_falls_under_its_bucket_bound(self):
+        for value in (3e-6, 0.001, 0.0123, 0.5, 1.0, 3.7, 100.0):
+            i = Histogram.bucket(value)
+            assert Histogram.upper_bound(i - 1) <= value < \
+                    Histogram.upper_bound(i)
+            assert Histogram.upper_bound(i) <= value * 1.25
+
+    def test_out_of_range_values(self):
+        assert Histogram.bucket(0) == 0
+        assert Histogram.bucket(1e9) == Histogram.SIZE - 1
+
+    def test_percentiles(self):
+        h = Histogram()
+        for i in range(1, 1001):
+            h.add(i / 1000.0)
+        assert h.count == 1000
+        assert 0.5 <= h.percentile(0.5) <= 0.5 * 1.125
+        assert 0.99 <= h.percentile(0.99) <= 1.0
+        assert h.percentile(1.0) == 1.0
+        assert abs(h.mean - 0.5005) < 1e-9
+
+    def test_dump_and_load(self):
+        h = Histogram()
+        h.add(0.25)
+        h.add(2.0)
+        copy = Histogram.load(h.dump())
+        assert copy.counts == h.counts
+        assert (copy.count, copy.sum, copy.max) == (2, 2.25, 2.0)
+
+
+class TestMetrics:
+
+    def test_topic_counters(self):
+        m = Metrics()
+        m.message_in("a/1", 10)
+        m.message_in("a/1", 5)
+        m.message_out("b", 3)
+        assert m.topics == {"a/1": [2, 15, 0, 0], "b": [0, 0, 1, 3]}
+
+    def test_topics_are_capped(self):
+        m = Metrics()
+        m.MAX_TOPICS = 2
+        for topic in ("a", "b", "c", "d"):
+            m.message_in(topic, 1)
+        assert m.topics[Metrics.OTHER] == [2, 2, 0, 0]
+
+    def test_puback_latency(self):
+        m = Metrics()
+        m.message_out("a", 1, mid=7)
+        m.published(7)
+        m.published(8)
+        assert m.puback.count == 1
+        assert not m.inflight
+
+    def test_puback_before_publish_returns(self):
+        m = Metrics()
+        start = time.time()
+        m.published(7)
+        m.message_out("a", 1, mid=7, start=start)
+        assert m.puback.count == 1
+        assert not m.inflight and not m.acked
+
+    def test_stale_ack_of_reused_mid(self):
+        m = Metrics()
+        m.published(7)
+        m.message_out("a", 1, mid=7, start=time.time() + 1)
+        assert m.puback.count == 0
+        assert 7 in m.inflight
+
+    def test_expired_inflight(self):
+        m = Metrics()
+        m.message_out("a", 1, mid=1)
+        m.expire_inflight(now=m.inflight[1] + Metrics.INFLIGHT_TIMEOUT + 1)
+        assert not m.inflight
+
+    def test_merge_snapshots(self):
+        a, b = Metrics(), Metrics()
+        a.message_in("t", 4)
+        b.message_in("t", 6)
+        a.handled("handle_t", 0.01)
+        b.handled("handle_t", 0.02)
+        b.connected()
+        b.connected()
+        merged = merge_snapshots([a.snapshot(), b.snapshot()])
+        assert merged["topics"]["t"] == [2, 10, 0, 0]
+        assert Histogram.load(merged["handlers"]["handle_t"]).count == 2
+        assert merged["reconnects"] == 1
+
+    def test_render(self):
+        m = Metrics()
+        m.message_in('x/"y"', 3)
+        m.handled("handle_x", 0.003)
+        text = render(m.snapshot(), [(42, {"backlog": 3, "latency": 0.1,
+            "processed": 9})])
+        assert 'culexx_messages_received_total{topic="x/\\"y\\""} 1' in text
+        assert 'culexx_handler_seconds_count{handler="handle_x"} 1' in text
+        assert 'culexx_handler_seconds_bucket{handler="handle_x",le="+Inf"} 1' in text
+        assert 'culexx_worker_queue_depth{pid="42"} 3' in text
+        assert "culexx_puback_seconds_count 0" in text
+
+
+class TestMetricsBuffer:
+
+    def test_round_trip(self):
+        buf = MetricsBuffer(4096)
+        try:
+            assert buf.read() is None
+            m = Metrics()
+            m.message_in("t", 2)
+            assert buf.write(m.snapshot())
+            assert buf.read()["topics"] == {"t": [1, 2, 0, 0]}
+        finally:
+            buf.close()
+
+    def test_too_large_snapshot_is_skipped(self):
+        buf = MetricsBuffer(64)
+        try:
+            m = Metrics()
+            for i in range(100):
+                m.message_in("topic/%d" % i, 1)
+            assert not buf.write(m.snapshot())
+            assert buf.overflows == 1
+        finally:
+            buf.close()
+
+
+class TestMetricsServer:
+
+    def test_serves_over_unix_socket(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "metrics.sock")
+        server = MetricsServer("unix:" + path)
+        try:
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(path)
+            client.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+            requests = []
+
+            def respond(method, path):
+                requests.append((method, path))
+                return "200 OK", "culexx_workers 1\n"
+
+            t = threading.Thread(target=server.handle, args=(respond,))
+            t.start()
+            t.join(5)
+            response = b""
+            while True:
+                chunk = client.recv(4096)
+                if not chunk:
+                    break
+                response += chunk
+            client.close()
+        finally:
+            server.close()
+            shutil.rmtree(directory)
+        assert requests == [("GET", "/metrics")]
+        assert response.startswith(b"HTTP/1.0 200 OK")
+        assert response.endswith(b"\r\n\r\nculexx_workers 1\n")
+        assert not os.path.exists(path)
+
+    def test_silent_client_does_not_hold_the_arbiter(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "metrics.sock")
+        server = MetricsServer("unix:" + path)
+        try:
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(path)
+            client.sendall(b"GET /metr")
+            respond = Mock()
+            start = time.time()
+            server.handle(respond)
+            assert time.time() - start < server.DEADLINE + 0.5
+            assert not respond.called
+            assert client.recv(4096) == b""
+            client.close()
+        finally:
+            server.close()
+            shutil.rmtree(directory)
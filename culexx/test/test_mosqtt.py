@@ -4,6 +4,7 @@ from mock import Mock
 import paho.mqtt.client as mosquitto
 
 from ..mosqtt import *
+from ..metrics import Metrics
 
 # class TestClientMeta(MosqttMeta):
 #     def __new__(cls, name, bases, attrs):
@@ -149,6 +150,22 @@ class TestBaseClient:
         self.client.reconnect.assert_called_once_with()
         self.client._mqtt_client.publish.assert_called_once_with('mqttc-test-000/messages', 'hi', 1, False)
 
+    def test_publish_is_counted(self):
+        self.client.metrics = Metrics()
+        self.client._mqtt_client = mosquitto.Mosquitto('mqttc-test-000')
+        self.client._mqtt_client.publish = Mock(return_value=(0, 5))
+        self.client._mqtt_client.loop = Mock(return_value=mosquitto.MQTT_ERR_SUCCESS)
+        self.client.publish('/messages', 'hi')
+        assert self.client.metrics.topics == {'mqttc-test-000/messages': [0, 0, 1, 2]}
+        assert 5 in self.client.metrics.inflight
+
+    @raises(MQTTException)
+    def test_publish_rejected_without_connection(self):
+        # as in the workers of the fanout mode
+        self.client.can_publish = False
+        self.client.publish('/messages', 'hi')
+        assert self.client._mqtt_client is None
+
     @raises(MQTTException)
     def test_failed_publish_when_connection_lost(self):
         self.client._mqtt_client = self.mqttc
@@ -165,4 +182,110 @@ class TestBaseClient:
         self.client.signal_mapper.sig_on_connect.send = Mock(return_value=None)
         self.client.connect()
         self.client._mqtt_client.on_connect(self.client.mqtt_client, None, None)
-        self.client.signal_mapper.sig_on_connect.send.assert_called_once_with(self.client, mosq=self.mqttc, obj=None, rc=None)
\ No newline at end of file
+        self.client.signal_mapper.sig_on_connect.send.assert_called_once_with(self.client, mosq=self.mqttc, obj=None, rc=None)
+
+    def test_update_topics_when_not_connected(self):
+        self.client._mqtt_client = Mock()
+        self.client.update_topics({'/other': 'handle_topic'})
+        assert self.client.topics == {'/other': 'handle_topic'}
+        assert not self.client._mqtt_client.subscribe.called
+
+    def test_update_topics_when_connected(self):
+        self.client._mqtt_client = Mock()
+        self.client._mqtt_client.subscribe = Mock(return_value=(0, 1))
+        self.client._mqtt_client.unsubscribe = Mock(return_value=(0, 2))
+        self.client._setup = True
+        self.client.update_topics({'/other': 'handle_topic'})
+        self.client._mqtt_client.subscribe.assert_called_once_with('mqttc-test-000/other', 0)
+        self.client._mqtt_client.unsubscribe.assert_called_once_with('mqttc-test-000/topic')
+
+
+class LocalClient(Mosqtt):
+    LOCAL_DELIVERY = True
+    SUPPRESS_ECHO = True
+
+    class Meta(object):
+        topic_handlers = {
+            '/local': 'handle_local',
+        }
+
+    def handle_local(self, payload):
+        self.seen.append(payload)
+
+
+class TestLocalDelivery:
+
+    def setUp(self):
+        self.client = LocalClient(name='000')
+        self.client.seen = []
+        self.client._mqtt_client = mosquitto.Mosquitto('mqttc-000')
+        self.client._mqtt_client.publish = Mock(return_value=(0, 1))
+        self.client._mqtt_client.loop = Mock(return_value=mosquitto.MQTT_ERR_SUCCESS)
+        self.client.signal_mapper.sig_on_message.connect(self.on_message,
+                sender=self.client)
+
+    def tearDown(self):
+        self.client.signal_mapper.sig_on_message.disconnect(self.on_message,
+                sender=self.client)
+
+    def on_message(self, sender, msg=None, **kwargs):
+        sender.topic_mapper.handle_topic(msg.topic, msg.payload)
+
+    def echo(self, topic, payload):
+        msg = Mock(topic=topic, payload=payload, qos=1, retain=False)
+        self.client.signal_mapper.dispatch(None, None, msg)
+
+    def published(self):
+        return self.client._mqtt_client.publish.call_args[0][1]
+
+    def test_own_topics_are_delivered_locally(self):
+        self.client.publish('/local', u'hi')
+        assert self.client.seen == [b'hi']
+        self.client._mqtt_client.publish.assert_called_once_with(
+                'mqttc-000/local', self.published(), 1, False)
+        assert self.published().endswith(b'hi')
+        self.client.publish('/remote', 'x')
+        assert self.client.seen == [b'hi']
+
+    def test_wildcard_subscribers_are_delivered_locally(self):
+        self.client.update_topics({'/local': 'handle_local',
+                '/sensors/+': 'handle_local'})
+        consumer = self.client.messages('/orders/#')
+        received = []
+        self.client.signal_mapper.sig_on_message.connect(
+                lambda sender, msg=None, **kw: received.append(msg.topic),
+                sender=self.client, weak=False)
+        self.client.publish('/sensors/1', b'1')
+        self.client.publish('/orders/a/b', b'2')
+        self.client.publish('/other', b'3')
+        assert received == ['mqttc-000/sensors/1', 'mqttc-000/orders/a/b']
+        assert consumer.get(timeout=0).payload == b'2'
+        consumer.close()
+
+    def test_no_local_delivery_in_a_share_group(self):
+        self.client.share_group = 'workers'
+        self.client.publish('/local', b'hi')
+        assert self.client.seen == []
+        self.client._mqtt_client.publish.assert_called_once_with(
+                'mqttc-000/local', b'hi', 1, False)
+
+    def test_echo_is_suppressed_once(self):
+        self.client.publish('/local', b'hi')
+        echo = self.published()
+        self.echo('mqttc-000/local', echo)
+        assert self.client.seen == [b'hi']
+        self.echo('mqttc-000/local', echo)
+        assert self.client.seen == [b'hi', b'hi']
+        assert len(self.client.echoes) == 0
+
+    def test_same_payload_from_another_client_is_kept(self):
+        self.client.publish('/local', b'hi')
+        self.echo('mqttc-000/local', b'hi')
+        assert self.client.seen == [b'hi', b'hi']
+        assert len(self.client.echoes) == 1
+
+    def test_echoes_expire(self):
+        self.client.echoes.timeout = -1
+        self.client.publish('/local', b'hi')
+        self.echo('mqttc-000/local', self.published())
+        assert self.client.seen == [b'hi', b'hi']
@@ -0,0 +1,56 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import threading
+
+from ..mosqtt import Mosqtt
+from ..profiler import SamplingProfiler, handler_codes
+
+
+class Client(Mosqtt):
+
+    class Meta(object):
+        topic_handlers = {'/busy': 'handle_busy'}
+
+    def handle_busy(self, payload):
+        payload.wait(5)
+
+
+class TestSamplingProfiler:
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'profile.folded')
+        self.client = Client(name='000')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_handler_codes(self):
+        codes = handler_codes(self.client)
+        assert list(codes.values()) == ['handle_busy [/busy]']
+
+    def test_samples_are_attributed_to_handlers(self):
+        done = threading.Event()
+        t = threading.Thread(target=self.client.handle_busy, args=(done,),
+                name='busy')
+        t.start()
+        profiler = SamplingProfiler(self.path, duration=10, interval=0.001,
+                handlers=handler_codes(self.client))
+        profiler.start()
+        while profiler.samples < 5:
+            done.wait(0.01)
+        profiler.stop()
+        done.set()
+        t.join()
+
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        busy = [l for l in lines if l.startswith('thread:busy;')]
+        assert busy
+        stack, count = busy[0].rsplit(' ', 1)
+        assert 'handler:handle_busy [/busy]' in stack.split(';')
+        assert int(count) > 0
+        assert profiler.handler_samples['handle_busy [/busy]'] >= 5
+        assert not [l for l in lines if 'culexx-profiler' in l]
@@ -0,0 +1,77 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+
+from mock import Mock
+
+from ..mosqtt import Mosqtt, TopicMapper
+from ..recorder import FlightRecorder, HANDLER, MESSAGE, OK
+
+
+class TestFlightRecorder:
+
+    def test_keeps_last_records_in_order(self):
+        recorder = FlightRecorder(3)
+        for i in range(5):
+            recorder.record(MESSAGE, "/t%d" % i, i)
+        assert len(recorder) == 3
+        assert [r[2] for r in recorder.snapshot()] == ["/t2", "/t3", "/t4"]
+
+    def test_snapshot_before_wrapping(self):
+        recorder = FlightRecorder(3)
+        recorder.record(MESSAGE, "/a", 1)
+        assert [r[2] for r in recorder.snapshot()] == ["/a"]
+
+    def test_dump(self):
+        recorder = FlightRecorder(8)
+        recorder.record(MESSAGE, "/a", 5)
+        recorder.record(HANDLER, "/a", 5, "handle_a", "ValueError('x',)")
+        directory = tempfile.mkdtemp()
+        try:
+            path = recorder.dump_to_dir(directory, "test")
+            with open(path) as f:
+                lines = f.read().splitlines()
+        finally:
+            shutil.rmtree(directory)
+        assert lines[0].endswith("2 of 2 records, test")
+        assert lines[1].endswith("message /a size=5 handler=- ok")
+        assert lines[2].endswith(
+                "handler /a size=5 handler=handle_a ValueError('x',)")
+
+
+class Client(Mosqtt):
+
+    def handle_ok(self, payload):
+        pass
+
+    def handle_fail(self, payload):
+        raise ValueError("bad payload")
+
+
+class TestRecording:
+
+    def setUp(self):
+        self.client = Client(name="000")
+        self.client.topic_mapper = TopicMapper(self.client,
+                {"/ok": "handle_ok", "/fail": "handle_fail"})
+
+    def test_handler_outcomes_are_recorded(self):
+        self.client.topic_mapper.handle_topic("mqttc-000/ok", "abc")
+        self.client.topic_mapper.handle_topic("mqttc-000/fail", "de")
+        records = self.client.recorder.snapshot()
+        assert [r[1:5] for r in records] == [
+                (HANDLER, "/ok", 3, "handle_ok"),
+                (HANDLER, "/fail", 2, "handle_fail")]
+        assert records[0][5] == OK
+        assert "bad payload" in records[1][5]
+
+    def test_messages_are_recorded(self):
+        msg = Mock(topic="mqttc-000/ok", payload="abcd")
+        self.client.signal_mapper.on_message(None, None, msg)
+        assert self.client.recorder.snapshot()[0][1:4] == \
+                (MESSAGE, "mqttc-000/ok", 4)
+
+    def test_recorder_can_be_turned_off(self):
+        self.client.recorder = None
+        self.client.topic_mapper.handle_topic("mqttc-000/ok", "abc")
@@ -0,0 +1,76 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+
+from ..reloader import InotifyWatcher, StatWatcher
+
+
+class TestStatWatcher:
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'culexx.conf.py')
+        self.write('workers = 1\n', 1000000000)
+        self.watcher = StatWatcher(self.filename, interval=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, source, mtime):
+        with open(self.filename, 'w') as f:
+            f.write(source)
+        os.utime(self.filename, (mtime, mtime))
+
+    def test_unchanged(self):
+        assert not self.watcher.changed()
+
+    def test_changed_once(self):
+        self.write('workers = 2\n', 1000000100)
+        assert self.watcher.changed()
+        assert not self.watcher.changed()
+
+    def test_interval(self):
+        self.watcher.interval = 3600
+        self.write('workers = 2\n', 1000000100)
+        assert not self.watcher.changed()
+
+    def test_missing_file(self):
+        os.unlink(self.filename)
+        assert not self.watcher.changed()
+
+
+class TestInotifyWatcher:
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'culexx.conf.py')
+        with open(self.filename, 'w') as f:
+            f.write('workers = 1\n')
+        self.watcher = InotifyWatcher(self.filename)
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.dir)
+
+    def test_unchanged(self):
+        assert not self.watcher.changed()
+
+    def test_write(self):
+        with open(self.filename, 'w') as f:
+            f.write('workers = 2\n')
+        assert self.watcher.changed()
+        assert not self.watcher.changed()
+
+    def test_replace(self):
+        tmp = os.path.join(self.dir, 'new')
+        with open(tmp, 'w') as f:
+            f.write('workers = 2\n')
+        assert not self.watcher.changed()
+        os.rename(tmp, self.filename)
+        assert self.watcher.changed()
+
+    def test_other_files_are_ignored(self):
+        with open(os.path.join(self.dir, 'other.py'), 'w') as f:
+            f.write('')
+        assert not self.watcher.changed()
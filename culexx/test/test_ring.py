@@ -0,0 +1,85 @@
+from __future__ import absolute_import
+
+from ..ring import HashRing, RingBuffer
+
+
+class TestRingBuffer:
+
+    def setUp(self):
+        self.ring = RingBuffer(256)
+
+    def tearDown(self):
+        self.ring.close()
+
+    def test_empty(self):
+        assert self.ring.get() is None
+        assert self.ring.pending() == 0
+
+    def test_put_get_commit(self):
+        assert self.ring.put('mqttc-test-000/topic', b'hi', 1, True)
+        assert self.ring.pending() == 1
+        msg = self.ring.get()
+        assert msg.topic == 'mqttc-test-000/topic'
+        assert msg.payload == b'hi'
+        assert msg.qos == 1
+        assert msg.retain is True
+        assert msg.timestamp > 0
+        self.ring.commit()
+        assert self.ring.pending() == 0
+        assert self.ring.get() is None
+
+    def test_get_without_commit_returns_same_message(self):
+        self.ring.put('a', b'1')
+        self.ring.put('b', b'2')
+        assert self.ring.get().topic == 'a'
+        assert self.ring.get().topic == 'a'
+        self.ring.commit()
+        assert self.ring.get().topic == 'b'
+
+    def test_full(self):
+        count = 0
+        while self.ring.put('t', b'x' * 40):
+            count += 1
+        assert count == 256 // 64
+        self.ring.get()
+        self.ring.commit()
+        assert self.ring.put('t', b'x' * 40)
+
+    def test_wraps_around_in_order(self):
+        for i in range(50):
+            payload = ('%d' % i).encode('ascii') * (i % 7 + 1)
+            assert self.ring.put('topic/%d' % i, payload)
+            msg = self.ring.get()
+            self.ring.commit()
+            assert msg.topic == 'topic/%d' % i
+            assert msg.payload == payload
+
+    def test_too_large(self):
+        try:
+            self.ring.put('t', b'x' * 512)
+        except ValueError:
+            return
+        assert False, 'expected ValueError'
+
+
+class TestHashRing:
+
+    def setUp(self):
+        self.keys = ['device/%d' % i for i in range(1000)]
+
+    def test_stable(self):
+        ring = HashRing(range(4))
+        assert [ring.get(k) for k in self.keys] == \
+                [HashRing(range(4)).get(k) for k in self.keys]
+
+    def test_spread(self):
+        ring = HashRing(range(4))
+        nodes = set(ring.get(k) for k in self.keys)
+        assert nodes == set(range(4))
+
+    def test_adding_a_node_moves_few_keys(self):
+        before = HashRing(range(4))
+        after = HashRing(range(5))
+        moved = [k for k in self.keys if before.get(k) != after.get(k)]
+        assert all(after.get(k) == 4 for k in moved)
+        assert len(moved) < len(self.keys) // 2
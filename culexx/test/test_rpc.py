@@ -0,0 +1,192 @@
+from __future__ import absolute_import
+from nose.tools import raises
+from mock import Mock
+import threading
+import time
+import paho.mqtt.client as mosquitto
+
+from ..base import Base
+from ..broker import Broker
+from ..config import Config
+from ..mosqtt import Mosqtt
+from ..rpc import RPCClient, RPCError, RPCTimeout, pack_request, rpc, \
+        unpack_request
+
+
+class Calculator(Mosqtt):
+
+    RECORDER_SIZE = 0
+    COLLECT_METRICS = True
+
+    class Meta(object):
+        topic_handlers = {
+            '/add': 'handle_add',
+            '/fail': 'handle_fail',
+        }
+
+    @rpc
+    def handle_add(self, payload):
+        return sum(int(n) for n in payload.split(b","))
+
+    @rpc
+    def handle_fail(self, payload):
+        raise ValueError("no")
+
+
+def test_envelope():
+    payload = pack_request(7, u'mqttc-000/_rpc/1/7', b'body')
+    assert unpack_request(payload) == (7, u'mqttc-000/_rpc/1/7', b'body')
+    assert unpack_request(b'body') is None
+    assert unpack_request(payload[:20]) is None
+
+
+def test_plain_messages_reach_the_handler():
+    client = Calculator(name='000')
+    assert client.handle_add(b'1,2') == 3
+
+
+class TestRequest:
+
+    def setUp(self):
+        self.client = Calculator(name='000')
+        self.client._mqtt_client = mosquitto.Mosquitto('mqttc-000')
+        self.client._mqtt_client.publish = Mock(return_value=(0, 1))
+        self.client._mqtt_client.subscribe = Mock(return_value=(0, 2))
+        self.client._mqtt_client.loop = Mock(
+                return_value=mosquitto.MQTT_ERR_SUCCESS)
+
+    def serve(self):
+        # run the handler on the request, then route its response back
+        publish = self.client._mqtt_client.publish
+        topic, payload = publish.call_args[0][:2]
+        self.client.topic_mapper.handle_topic(topic, payload)
+        topic, payload = publish.call_args[0][:2]
+        self.client.signal_mapper.dispatch(None, None,
+                Mock(topic=topic, payload=payload, qos=1, retain=False))
+
+    def test_response(self):
+        future = self.client.request('/add', b'1,2,3')
+        assert not future.done()
+        subscribed = self.client._mqtt_client.subscribe.call_args[0][0]
+        assert subscribed.startswith('mqttc-000/_rpc/')
+        assert subscribed.endswith('/+')
+        self.serve()
+        assert future.result() == b'6'
+        assert not self.client.rpc.pending
+        assert self.client.rpc.summary()['/add'][0] == 1
+        assert '/add' in self.client.metrics.snapshot()['rpc']
+
+    @raises(RPCError)
+    def test_remote_exception(self):
+        future = self.client.request('/fail', b'')
+        self.serve()
+        try:
+            future.result()
+        except RPCError as e:
+            assert 'ValueError: no' in str(e)
+            raise
+
+    def test_timeout(self):
+        future = self.client.request('/add', b'1', timeout=0)
+        done = []
+        future.add_done_callback(done.append)
+        assert self.client.rpc.sweep(time.time() + 1) == 1
+        assert done == [future]
+        assert isinstance(future.exception(), RPCTimeout)
+        # a late response is dropped
+        self.serve()
+        assert self.client.rpc.timeouts == 1
+
+    def test_response_goes_through_publish(self):
+        self.client.request('/add', b'1,2')
+        self.client.publish_absolute = Mock()
+        publish = self.client._mqtt_client.publish
+        self.client.topic_mapper.handle_topic(*publish.call_args[0][:2])
+        topic, payload, qos = self.client.publish_absolute.call_args[0]
+        assert topic.startswith('mqttc-000/_rpc/')
+        assert (payload, qos) == (b'\x003', 1)
+
+    def test_failed_publish_forgets_the_request(self):
+        self.client._mqtt_client.publish.side_effect = ValueError('down')
+        try:
+            self.client.request('/add', b'1')
+        except ValueError:
+            pass
+        else:
+            assert False, "publish didn't fail"
+        assert not self.client.rpc.pending
+        assert not self.client.rpc.deadlines
+
+    def test_one_resubscribe_per_fork(self):
+        rpc = self.client.request('/add', b'1').client
+        for _ in range(3):
+            rpc.pid = None
+            rpc.reply_prefix()
+        sig_on_connect = self.client.signal_mapper.sig_on_connect
+        receivers = [r for r in sig_on_connect.receivers_for(self.client)
+                if r == rpc.resubscribe]
+        assert len(receivers) == 1
+
+    @raises(RPCError)
+    def test_pending_requests_are_bounded(self):
+        self.client.RPC_MAX_PENDING = 2
+        for _ in range(3):
+            self.client.request('/add', b'1')
+
+
+@raises(RuntimeError)
+def test_fanout_rejects_rpc_handlers():
+    arbiter = Base.__new__(Base)
+    arbiter.cfg = Config()
+    arbiter.log = Mock()
+    arbiter.num_workers = 1
+    arbiter.callable = Calculator(name='000')
+    arbiter.callable.connect = Mock()
+    try:
+        arbiter.init_fanout()
+    except RuntimeError as e:
+        assert '/add, /fail' in str(e)
+        assert not arbiter.callable.connect.called
+        raise
+
+
+class Server(Calculator):
+
+    def __init__(self, *args, **kwargs):
+        Calculator.__init__(self, *args, **kwargs)
+        self.subscribed = threading.Event()
+        sm = self.signal_mapper
+        sm.sig_on_message.connect(self.on_message, sender=self, weak=False)
+        sm.sig_on_subscribe.connect(self.on_subscribe, sender=self,
+                weak=False)
+
+    def on_message(self, sender, msg=None, **kwargs):
+        self.topic_mapper.handle_topic(msg.topic, msg.payload)
+
+    def on_subscribe(self, sender, **kwargs):
+        self.subscribed.set()
+
+
+def test_over_the_broker():
+    with Broker() as broker:
+        server = Server(name='000', broker='127.0.0.1', port=broker.port)
+        server.session_suffix = '-server'
+        server.connect(loop_forever=False)
+        client = Calculator(name='000', broker='127.0.0.1', port=broker.port)
+        client.connect(loop_forever=False)
+        client.mqtt_client.loop_stop()
+        try:
+            server.setup_subscriptions()
+            assert server.subscribed.wait(5)
+            client.rpc = RPCClient(client)
+            client.rpc.reply_prefix()
+            client.mqtt_client.loop(0.1)
+
+            future = client.request('/add', b'20,22')
+            limit = time.time() + 5
+            while not future.done() and time.time() < limit:
+                client.mqtt_client.loop(0.05)
+            assert future.result(0) == b'42'
+        finally:
+            client.disconnect()
+            server.disconnect()
@@ -0,0 +1,151 @@
+from __future__ import absolute_import
+from nose.tools import raises
+from mock import Mock
+import operator
+import threading
+import time
+
+from ..mosqtt import Mosqtt
+from ..stream import Count, Mean, Reduce, Stream, Timer
+
+
+def test_aggregates_merge():
+    a, b = Mean(), Mean()
+    for v in (1, 2, 3):
+        a.add(v)
+    b.add(6)
+    a.merge(b)
+    assert a.result() == 3.0
+    assert Mean().result() is None
+
+    a, b = Reduce(operator.add), Reduce(operator.add)
+    a.add(1)
+    a.merge(b)
+    b.add(2)
+    a.merge(b)
+    assert a.result() == 3
+
+
+def test_timer_runs_in_order():
+    timer = Timer()
+    fired = []
+    done = threading.Event()
+    now = time.time()
+    timer.schedule(now + 0.05, fired.append, 2)
+    timer.schedule(now + 0.02, fired.append, 1)
+    timer.cancel(timer.schedule(now + 0.03, fired.append, 3))
+    timer.schedule(now + 0.06, done.set)
+    assert done.wait(5)
+    assert fired == [1, 2]
+
+
+class TestStream:
+
+    def setUp(self):
+        self.results = []
+
+    def sink(self, topic, start, end, result):
+        self.results.append((topic, start, end, result))
+
+    def start(self, stream):
+        stream.sink(self.sink)
+        # ticks are driven by the test
+        stream.timer.cancel(stream.entry)
+        return stream
+
+    def test_tumbling(self):
+        s = self.start(Stream(None, '/t').window(10).aggregate('max'))
+        for now, payload in ((100, b'1'), (105, b'7'), (109.9, b'3'),
+                (110, b'2')):
+            s.add('/t', payload, now)
+        s.add('/t', b'nan?', 101)
+        s.tick(110)
+        s.tick(120)
+        s.tick(130)
+        assert self.results == [(None, 100, 110, 7.0), (None, 110, 120, 2.0)]
+        assert s.dropped == 1
+        assert not s.panes
+        s.close()
+
+    def test_sliding(self):
+        s = self.start(Stream(None, '/t', value=None).window(30, every=10)
+                .aggregate(Count))
+        for now in (100, 115, 125, 126):
+            s.add('/t', b'x', now)
+        for due in (110, 120, 130, 140, 150, 160):
+            s.tick(due)
+        assert [r[3] for r in self.results] == [1, 2, 4, 3, 2]
+        assert self.results[0][1:3] == (80, 110)
+        # only the panes of the next window are kept
+        assert len(s.panes) <= 3
+        s.close()
+
+    def test_per_topic(self):
+        s = self.start(Stream(None, '/t/+', per_topic=True).window(10)
+                .aggregate('sum'))
+        s.add('/t/a', b'1', 100)
+        s.add('/t/b', b'2', 101)
+        s.add('/t/a', b'3', 102)
+        s.tick(110)
+        assert [(r[0], r[3]) for r in self.results] == \
+                [('/t/a', 4.0), ('/t/b', 2.0)]
+        s.close()
+
+    @raises(ValueError)
+    def test_window_must_fit_its_step(self):
+        Stream(None, '/t').window(25, every=10)
+
+    @raises(ValueError)
+    def test_needs_an_aggregate(self):
+        Stream(None, '/t').window(10).sink(self.sink)
+
+
+class StreamClient(Mosqtt):
+
+    RECORDER_SIZE = 0
+
+    class Meta(object):
+        topic_handlers = {'/temp': 'handle_temp'}
+
+    def handle_temp(self, payload):
+        self.seen = payload
+
+
+def message(topic, payload):
+    return Mock(topic=topic, payload=payload, qos=0, retain=False)
+
+
+def test_client_streams():
+    client = StreamClient(name='000')
+    client.publish = Mock()
+    s = client.stream('/temp').window(3600).aggregate('mean') \
+            .publish('/temp/mean')
+    s.timer.cancel(s.entry)
+    client.signal_mapper.dispatch(None, None, message('mqttc-000/temp', b'1'))
+    client.signal_mapper.dispatch(None, None, message('mqttc-000/temp', b'2'))
+    s.tick((int(time.time() // 3600) + 1) * 3600)
+    client.publish.assert_called_once_with('/temp/mean', b'1.5', 0, False)
+    s.close()
+    assert len(client.topic_mapper.streams) == 0
+
+
+def test_shared_client_streams():
+    client = StreamClient(name='000')
+    client._mqtt_client = Mock()
+    client._mqtt_client.subscribe.return_value = (0, 1)
+    client.share_group = 'workers'
+    s = client.stream('/temp').window(3600).aggregate('count').sink(Mock())
+    s.timer.cancel(s.entry)
+    client.setup_subscriptions()
+    # the handler shares the load, the stream sees everything
+    assert [c[0][0] for c in client._mqtt_client.subscribe.call_args_list] \
+            == ['$share/workers/mqttc-000/temp', 'mqttc-000/temp']
+
+    client.signal_mapper.dispatch(None, None, message('mqttc-000/temp', b'1'))
+    client.stream_owner = False
+    client.signal_mapper.dispatch(None, None, message('mqttc-000/temp', b'1'))
+    client._mqtt_client.subscribe.reset_mock()
+    client.setup_subscriptions()
+    assert client._mqtt_client.subscribe.call_count == 1
+    assert sum(a.result() for p in s.panes.values() for a in p.values()) == 1
+    s.close()
@@ -0,0 +1,65 @@
+from __future__ import absolute_import
+
+from nose.tools import raises
+
+from ..topics import TopicTree, topic_matches, validate_filter
+
+
+def test_topic_matches():
+    assert topic_matches('a/b', 'a/b')
+    assert topic_matches('a/+', 'a/b')
+    assert not topic_matches('a/+', 'a/b/c')
+    assert topic_matches('a/#', 'a')
+    assert topic_matches('a/#', 'a/b/c')
+    assert topic_matches('+/+/c', 'a/b/c')
+    assert not topic_matches('a/b', 'a')
+    assert not topic_matches('#', '$SYS/x')
+    assert topic_matches('$SYS/#', '$SYS/x')
+
+
+@raises(ValueError)
+def test_hash_must_be_last():
+    validate_filter('a/#/b')
+
+
+@raises(ValueError)
+def test_wildcards_fill_a_level():
+    validate_filter('a/b+')
+
+
+class TestTopicTree:
+
+    def setUp(self):
+        self.tree = TopicTree()
+        for f in ('a/b', 'a/+', 'a/#', '#', '+/b', 'x/y', '$SYS/+'):
+            self.tree.add(f, f)
+
+    def test_match(self):
+        assert sorted(self.tree.match('a/b')) == \
+                sorted(['a/b', 'a/+', 'a/#', '#', '+/b'])
+        assert sorted(self.tree.match('a')) == ['#', 'a/#']
+        assert self.tree.match('$SYS/load') == ['$SYS/+']
+
+    def test_remove_prunes(self):
+        assert len(self.tree) == 7
+        assert self.tree.remove('x/y', 'x/y')
+        assert not self.tree.remove('x/y', 'x/y')
+        assert 'x' not in self.tree.root.children
+        assert len(self.tree) == 6
+
+    def test_matches_agree_with_topic_matches(self):
+        filters = [f for f, _ in self.tree.items()]
+        for topic in ('a/b', 'a/c/d', 'q/b', 'x/y', '$SYS/a', 'a'):
+            expected = sorted(f for f in filters if topic_matches(f, topic))
+            assert sorted(self.tree.match(topic)) == expected, topic
+
+
+def test_find_topics_by_filter():
+    tree = TopicTree()
+    for t in ('a', 'a/b', 'a/c', 'a/b/c', 'x/b', '$SYS/a'):
+        tree.add(t, t)
+    assert sorted(tree.find('a/+')) == ['a/b', 'a/c']
+    assert sorted(tree.find('a/#')) == ['a', 'a/b', 'a/b/c', 'a/c']
+    assert sorted(tree.find('+/b')) == ['a/b', 'x/b']
+    assert '$SYS/a' not in tree.find('#')
+    assert tree.find('$SYS/+') == ['$SYS/a']
@@ -0,0 +1,84 @@
+from __future__ import absolute_import
+import time
+
+from mock import Mock
+
+from ..metrics import Metrics, render
+from ..mosqtt import Mosqtt
+from ..tracing import Tracer, HANDLER, QUEUE, TOTAL, TRANSIT
+
+
+class Message(object):
+
+    def __init__(self, payload, topic='mqttc-000/t'):
+        self.topic = topic
+        self.payload = payload
+
+
+class TestTracer:
+
+    def setUp(self):
+        self.tracer = Tracer()
+
+    def test_stamp_and_receive(self):
+        msg = Message(self.tracer.stamp(b'hello'))
+        assert len(msg.payload) == Tracer.ENVELOPE.size + 5
+        trace = self.tracer.receive(msg, time.time())
+        assert msg.payload == b'hello'
+        assert trace is not None
+        self.tracer.finish(trace)
+        for stage in (TRANSIT, QUEUE, HANDLER, TOTAL):
+            assert self.tracer.histograms[stage].count == 1
+
+    def test_untraced_payload_is_left_alone(self):
+        msg = Message(b'plain')
+        assert self.tracer.receive(msg) is None
+        assert msg.payload == b'plain'
+
+    def test_text_and_numbers_are_encoded(self):
+        msg = Message(self.tracer.stamp(u'caf\xe9'))
+        self.tracer.receive(msg)
+        assert msg.payload == u'caf\xe9'.encode('utf-8')
+        msg = Message(self.tracer.stamp(42))
+        self.tracer.receive(msg)
+        assert msg.payload == b'42'
+
+    def test_sampling(self):
+        tracer = Tracer(sample_rate=0.0001)
+        stamped = [p for p in (tracer.stamp(b'x') for i in range(1000))
+                if p != b'x']
+        assert len(stamped) < 10
+
+    def test_slow_messages_are_logged(self):
+        log = Mock()
+        tracer = Tracer(slow=0.5, log=log)
+        msg = Message(tracer.stamp(b'x'))
+        trace = tracer.receive(msg)
+        trace.sent -= 1
+        tracer.finish(trace, msg.topic)
+        assert log.warning.called
+
+
+class TestTracedDispatch:
+
+    def test_handlers_see_the_original_payload(self):
+        client = Mosqtt(name='000')
+        client.tracer = Tracer()
+        client.metrics = Metrics()
+        client.metrics.stages = client.tracer.histograms
+        seen = []
+
+        def handler(sender, **kwargs):
+            seen.append(kwargs['msg'].payload)
+
+        sig = client.signal_mapper.sig_on_message
+        sig.connect(handler, sender=client)
+        try:
+            msg = Message(client.tracer.stamp(b'data'))
+            client.signal_mapper.dispatch(None, None, msg, time.time())
+        finally:
+            sig.disconnect(handler, sender=client)
+        assert seen == [b'data']
+        assert client.metrics.topics['mqttc-000/t'] == [1, 4, 0, 0]
+        text = render(client.metrics.snapshot())
+        assert 'culexx_trace_seconds_count{stage="handler"} 1' in text
@@ -0,0 +1,85 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import time
+
+from ..mosqtt import Mosqtt
+from ..ring import RingMessage
+from ..traffic import Replayer, TrafficRecorder, handler_target, read, \
+        segment_paths
+
+
+class Client(Mosqtt):
+
+    class Meta(object):
+        topic_handlers = {
+            '/temp': 'handle_temp',
+        }
+
+    def __init__(self, *args, **kwargs):
+        Mosqtt.__init__(self, *args, **kwargs)
+        self.seen = []
+
+    def handle_temp(self, payload):
+        self.seen.append(payload)
+
+
+class TestTraffic:
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def record(self, name, messages, segment_size=1024):
+        rec = TrafficRecorder(self.dir, name, segment_size)
+        for received, topic, payload in messages:
+            rec.record(RingMessage(topic, payload, 1, False), received)
+        rec.close()
+        return rec
+
+    def test_segments_roll_over_and_read_back(self):
+        messages = [(100.0 + i, 'mqttc-000/temp', b'%03d' % i + b'x' * 100)
+                for i in range(50)]
+        rec = self.record('traffic-1', messages)
+        assert rec.segment > 1
+        assert len(segment_paths([self.dir])) == rec.segment
+        back = list(read([self.dir]))
+        assert [(r[0], r[1], r[2]) for r in back] == messages
+        assert back[0][3:] == (1, False)
+
+    def test_workers_are_merged_in_time_order(self):
+        self.record('traffic-1', [(1.0, 'a', b'1'), (3.0, 'a', b'3')])
+        self.record('traffic-2', [(2.0, 'b', b'2'), (4.0, 'b', b'4')])
+        assert [r[2] for r in read([self.dir])] == [b'1', b'2', b'3', b'4']
+
+    def test_truncated_segment(self):
+        self.record('traffic-1', [(1.0, 'a', b'1'), (2.0, 'a', b'22')])
+        path = segment_paths([self.dir])[0]
+        with open(path, 'rb+') as f:
+            f.truncate(os.path.getsize(path) - 1)
+        assert [r[2] for r in read([path])] == [b'1']
+
+    def test_replay_speed(self):
+        self.record('traffic-1', [(10.0, 'a', b''), (10.5, 'a', b'')])
+        replayer = Replayer([self.dir], speed=10)
+        start = time.time()
+        assert replayer.run(lambda *rec: None) == 2
+        assert 0.04 < time.time() - start < 0.4
+        replayer = Replayer([self.dir], speed=0)
+        start = time.time()
+        replayer.run(lambda *rec: None)
+        assert time.time() - start < 0.04
+
+    def test_record_and_replay_through_handlers(self):
+        client = Client(name='000')
+        client.traffic = TrafficRecorder(self.dir, 'traffic-1')
+        msg = RingMessage(client.normalize_topic('/temp'), b'21.5')
+        client.signal_mapper.dispatch(None, None, msg)
+        client.traffic.close()
+        assert client.seen == []
+
+        Replayer([self.dir], speed=0).run(handler_target(client))
+        assert client.seen == [b'21.5']
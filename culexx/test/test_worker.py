@@ -0,0 +1,236 @@
+from __future__ import absolute_import
+from mock import Mock, patch
+import gc
+import os
+import sys
+
+from .. import util
+from ..base import Base
+from ..config import Config
+from ..ring import RingBuffer
+from ..worker import Worker, WorkerStatus
+
+
+def make_worker(cfg=None):
+    return Worker(1, 0, Mock(), cfg or Config(), Mock(), WorkerStatus())
+
+
+class TestStartupReport:
+
+    def setUp(self):
+        self.worker = make_worker()
+
+    def tearDown(self):
+        self.worker.status.close()
+
+    def test_ready_reports_startup_and_memory(self):
+        self.worker.spawned -= 2
+        with patch.object(util, 'get_rss', return_value=(8 << 20, 6 << 20)):
+            self.worker.ready()
+        status = self.worker.status.read()
+        assert status['state'] == WorkerStatus.RUNNING
+        assert 2 <= status['startup'] < 10
+        assert (status['rss'], status['shared']) == (8 << 20, 6 << 20)
+
+        # only the first time counts
+        with patch.object(util, 'get_rss') as get_rss:
+            self.worker.ready()
+        assert not get_rss.called
+
+    def test_arbiter_logs_it_once_running(self):
+        arbiter = Base.__new__(Base)
+        arbiter.log = Mock()
+        arbiter.report_worker(self.worker)
+        assert not self.worker.reported
+
+        with patch.object(util, 'get_rss', return_value=(8 << 20, 6 << 20)):
+            self.worker.ready()
+        arbiter.report_worker(self.worker)
+        assert self.worker.reported
+        args = arbiter.log.info.call_args[0]
+        assert args[3:] == (8192, 6144)
+
+
+class TestPreload:
+
+    def setUp(self):
+        self.arbiter = Base.__new__(Base)
+        self.arbiter.log = Mock()
+        self.arbiter.callable = None
+        self.arbiter.load_mosqapp = Mock()
+
+    def tearDown(self):
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
+        gc.enable()
+
+    def test_collector_after_preload(self):
+        self.arbiter.preload()
+        assert self.arbiter.load_mosqapp.called
+        if sys.version_info >= (3, 7):
+            assert gc.isenabled()
+            assert gc.get_freeze_count() > 0
+        else:
+            # nothing but a collection right before forking
+            assert not gc.isenabled()
+
+
+class TestRecycling:
+
+    def setUp(self):
+        cfg = Config()
+        cfg.set('max_messages', '3')
+        self.worker = make_worker(cfg)
+        self.worker.dispatch = Mock()
+
+    def tearDown(self):
+        self.worker.status.close()
+
+    def test_requests_recycling_past_max_messages(self):
+        msg = Mock(topic='/t')
+        for _ in range(2):
+            self.worker.handle_message(None, None, msg)
+        assert not self.worker.status.get('recycle')
+        self.worker.handle_message(None, None, msg)
+        assert self.worker.status.get('recycle')
+        # the count may jump past the limit, asking again is harmless
+        self.worker.processed += 5
+        self.worker.handle_message(None, None, msg)
+        assert self.worker.status.get('recycle')
+        assert self.worker.log.info.call_count == 1
+
+
+class TestRecycleWorkers:
+
+    def setUp(self):
+        self.arbiter = Base.__new__(Base)
+        self.arbiter.log = Mock()
+        self.arbiter.WORKERS = {}
+        self.arbiter.spawn_worker = Mock(side_effect=self.spawn)
+        self.arbiter.retire_worker = Mock()
+        self.old = self.add(100, slot=3)
+
+    def tearDown(self):
+        for worker in self.arbiter.WORKERS.values():
+            worker.status.close()
+
+    def add(self, pid, slot=0):
+        worker = make_worker()
+        worker.pid = pid
+        worker.slot = slot
+        self.arbiter.WORKERS[pid] = worker
+        return worker
+
+    def spawn(self, slot=None):
+        self.new = self.add(101, slot)
+        return 101
+
+    def test_nothing_to_recycle(self):
+        self.arbiter.recycle_workers()
+        assert not self.arbiter.spawn_worker.called
+
+    def test_replacement_takes_over_before_retiring(self):
+        self.old.status.set('recycle', 1)
+        self.arbiter.recycle_workers()
+        self.arbiter.spawn_worker.assert_called_once_with(slot=3)
+        assert self.old.replacement == 101
+        # the old worker is kept out of rotation but not retired yet
+        assert self.arbiter.active_workers() == [self.new]
+
+        self.arbiter.recycle_workers()
+        assert not self.arbiter.retire_worker.called
+        assert self.arbiter.spawn_worker.call_count == 1
+
+        self.new.status.update(state=WorkerStatus.RUNNING)
+        self.arbiter.recycle_workers()
+        self.arbiter.retire_worker.assert_called_once_with(self.old)
+
+    def test_replacement_died_before_ready(self):
+        self.old.status.set('recycle', 1)
+        self.arbiter.recycle_workers()
+        del self.arbiter.WORKERS[101]
+        self.new.status.close()
+        self.arbiter.recycle_workers()
+        assert self.old.replacement is None
+        self.arbiter.recycle_workers()
+        assert self.arbiter.spawn_worker.call_count == 2
+
+
+class TestIdleLatency:
+
+    def setUp(self):
+        self.worker = make_worker()
+        self.worker.latency = 1.0
+
+    def tearDown(self):
+        self.worker.status.close()
+
+    def notify(self):
+        with patch.object(util, 'get_rss', return_value=(0, 0)):
+            self.worker.notify(force=True)
+        return self.worker.status.get('latency')
+
+    def test_fades_while_idle(self):
+        assert abs(self.notify() - 0.9) < 1e-9
+        for _ in range(50):
+            self.notify()
+        assert self.worker.latency < 0.01
+
+    def test_kept_while_busy(self):
+        self.worker.queue.put(None)
+        assert self.notify() == 1.0
+        self.worker.queue.get()
+        self.worker.processed += 1
+        assert self.notify() == 1.0
+        assert self.notify() < 1.0
+
+
+class TestDrainRing:
+
+    def setUp(self):
+        self.worker = make_worker()
+        self.worker.mosq = Mock()
+        self.worker.dispatch = Mock()
+        self.worker.ring = RingBuffer(4096)
+        for n in range(3):
+            self.worker.ring.put('/t', b'%d' % n)
+
+    def tearDown(self):
+        self.worker.ring.close()
+        self.worker.status.close()
+
+    def test_handles_what_is_left(self):
+        self.worker.ring.consumer = os.getpid()
+        self.worker.drain_ring()
+        calls = self.worker.dispatch.call_args_list
+        payloads = [c[0][2].payload for c in calls]
+        assert payloads == [b'0', b'1', b'2']
+        assert self.worker.ring.pending() == 0
+
+    def test_left_to_the_replacement(self):
+        self.worker.ring.consumer = os.getpid() + 1
+        self.worker.drain_ring()
+        assert not self.worker.dispatch.called
+        assert self.worker.ring.pending() == 3
+
+
+class TestReloadLimits:
+
+    def setUp(self):
+        cfg = Config()
+        cfg.set('max_messages', '1000')
+        cfg.set('max_messages_jitter', '1000')
+        self.worker = make_worker(cfg)
+
+    def tearDown(self):
+        self.worker.status.close()
+
+    def test_jitter_kept_unless_changed(self):
+        limit = self.worker.max_messages
+        for _ in range(20):
+            self.worker.init_limits()
+        assert self.worker.max_messages == limit
+
+        self.worker.cfg.set('max_messages', '5000')
+        self.worker.init_limits()
+        assert 5000 <= self.worker.max_messages <= 6000
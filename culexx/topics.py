@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -
+#
+# This file is part of culexx released under the MIT license.
+# See the NOTICE for more information.
+
+
+def split_topic(topic):
+    return topic.split("/")
+
+
+def validate_filter(topic_filter):
+    """\
+    Raise ValueError unless ``topic_filter`` is a valid MQTT topic filter.
+    """
+    if not topic_filter:
+        raise ValueError("empty topic filter")
+    levels = split_topic(topic_filter)
+    for i, level in enumerate(levels):
+        if level == "#":
+            if i != len(levels) - 1:
+                raise ValueError("'#' must be the last level: %r"
+                        % topic_filter)
+        elif level != "+" and ("#" in level or "+" in level):
+            raise ValueError("wildcards must fill a whole level: %r"
+                    % topic_filter)
+
+
+def topic_matches(topic_filter, topic):
+    """\
+    Return True when ``topic`` matches ``topic_filter``. Wildcards in the
+    first level don't match topics starting with ``$``.
+    """
+    if topic.startswith("$") and topic_filter[:1] in ("+", "#"):
+        return False
+    levels = split_topic(topic)
+    filters = split_topic(topic_filter)
+    for i, f in enumerate(filters):
+        if f == "#":
+            return True
+        if i >= len(levels):
+            return False
+        if f != "+" and f != levels[i]:
+            return False
+    return len(filters) == len(levels)
+
+
+class _Node(object):
+
+    __slots__ = ("children", "values")
+
+    def __init__(self):
+        self.children = {}
+        self.values = None
+
+
+class TopicTree(object):
+    """\
+    Maps topic filters to values and finds the values of every filter
+    matching a topic, walking one branch of the tree per topic level
+    instead of testing every filter.
+    """
+
+    def __init__(self):
+        self.root = _Node()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, topic_filter, value):
+        node = self.root
+        for level in split_topic(topic_filter):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _Node()
+            node = child
+        if node.values is None:
+            node.values = []
+        if value not in node.values:
+            node.values.append(value)
+            self.count += 1
+
+    def remove(self, topic_filter, value):
+        """\
+        Remove ``value`` from ``topic_filter``. Returns False if it wasn't
+        there.
+        """
+        path = [self.root]
+        for level in split_topic(topic_filter):
+            node = path[-1].children.get(level)
+            if node is None:
+                return False
+            path.append(node)
+        node = path[-1]
+        if not node.values or value not in node.values:
+            return False
+        node.values.remove(value)
+        self.count -= 1
+        if not node.values:
+            node.values = None
+
+        # prune the branches left empty
+        levels = split_topic(topic_filter)
+        for i in range(len(levels), 0, -1):
+            node = path[i]
+            if node.values or node.children:
+                break
+            del path[i - 1].children[levels[i - 1]]
+        return True
+
+    def get(self, topic_filter):
+        node = self.root
+        for level in split_topic(topic_filter):
+            node = node.children.get(level)
+            if node is None:
+                return []
+        return list(node.values or ())
+
+    def match(self, topic):
+        """\
+        Return the values of all filters matching ``topic``.
+        """
+        levels = split_topic(topic)
+        result = []
+        dollar = topic.startswith("$")
+        self._match(self.root, levels, 0, result, dollar)
+        return result
+
+    def _match(self, node, levels, i, result, dollar):
+        children = node.children
+        wildcards = not (dollar and i == 0)
+
+        if wildcards:
+            hash_node = children.get("#")
+            if hash_node is not None and hash_node.values:
+                result.extend(hash_node.values)
+
+        if i == len(levels):
+            if node.values:
+                result.extend(node.values)
+            return
+
+        child = children.get(levels[i])
+        if child is not None:
+            self._match(child, levels, i + 1, result, dollar)
+        if wildcards:
+            child = children.get("+")
+            if child is not None:
+                self._match(child, levels, i + 1, result, dollar)
+
+    def find(self, topic_filter):
+        """\
+        Return the values stored under topics (not filters) matching
+        ``topic_filter``, the reverse of ``match``.
+        """
+        result = []
+        self._find(self.root, split_topic(topic_filter), 0, result)
+        return result
+
+    def _find(self, node, levels, i, result):
+        if i == len(levels):
+            if node.values:
+                result.extend(node.values)
+            return
+        level = levels[i]
+        if level == "#":
+            stack = [(node, i == 0)]
+            while stack:
+                node, top = stack.pop()
+                if node.values:
+                    result.extend(node.values)
+                for name, child in node.children.items():
+                    if not (top and name.startswith("$")):
+                        stack.append((child, False))
+            return
+        if level == "+":
+            for name, child in node.children.items():
+                if not (i == 0 and name.startswith("$")):
+                    self._find(child, levels, i + 1, result)
+            return
+        child = node.children.get(level)
+        if child is not None:
+            self._find(child, levels, i + 1, result)
+
+    def items(self):
+        """\
+        Yield (topic filter, values) for every filter in the tree.
+        """
+        stack = [(self.root, [])]
+        while stack:
+            node, levels = stack.pop()
+            if node.values:
+                yield "/".join(levels), list(node.values)
+            for level, child in node.children.items():
+                stack.append((child, levels + [level]))
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -
+#
+# This file is part of culexx released under the MIT license.
+# See the NOTICE for more information.
+
+import random
+import struct
+import time
+
+from . import util
+from .metrics import Histogram
+
+# stages of a traced message
+TRANSIT = "transit"
+QUEUE = "queue"
+HANDLER = "handler"
+TOTAL = "total"
+
+STAGES = (TRANSIT, QUEUE, HANDLER, TOTAL)
+
+
+class Trace(object):
+
+    __slots__ = ("trace_id", "sent", "received", "started")
+
+    def __init__(self, trace_id, sent, received, started):
+        self.trace_id = trace_id
+        self.sent = sent
+        self.received = received
+        self.started = started
+
+
+class Tracer(object):
+    """\
+    Measures how long messages take from ``Mosqtt.publish`` to the end of
+    their handlers.
+
+    A sampled share of the published payloads is wrapped in a 20 byte
+    envelope holding a trace id and the publish time. Receivers take the
+    envelope off before the handlers see the payload and add the time
+    spent in the broker and on the network, waiting in the dispatch queue,
+    in the handlers and in total to histograms. The publish and receive
+    times come from different hosts' clocks, so transit times are only as
+    good as their synchronisation.
+
+    Every client exchanging traced messages must have a tracer, an
+    envelope reaching a client without one is handed to the handlers as
+    part of the payload.
+    """
+
+    MAGIC = b"\xc1\x7eTR"
+    ENVELOPE = struct.Struct(">4sQd")
+
+    def __init__(self, sample_rate=1.0, slow=0, log=None):
+        self.sample_rate = sample_rate
+        self.slow = slow
+        self.log = log
+        self.histograms = dict((stage, Histogram()) for stage in STAGES)
+
+    def stamp(self, payload):
+        """\
+        Return ``payload`` wrapped in an envelope if it is sampled.
+        """
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return payload
+        return self.ENVELOPE.pack(self.MAGIC, random.getrandbits(64),
+                time.time()) + util.payload_bytes(payload)
+
+    def receive(self, msg, received=None):
+        """\
+        Take the envelope off ``msg``. Returns the trace to pass to
+        ``finish`` once the handlers ran, or None for untraced messages.
+        """
+        payload = msg.payload
+        if not isinstance(payload, bytes) or \
+                not payload.startswith(self.MAGIC) or \
+                len(payload) < self.ENVELOPE.size:
+            return None
+        _, trace_id, sent = self.ENVELOPE.unpack_from(payload)
+        msg.payload = payload[self.ENVELOPE.size:]
+        started = time.time()
+        return Trace(trace_id, sent, received or started, started)
+
+    def finish(self, trace, topic=None):
+        now = time.time()
+        h = self.histograms
+        h[TRANSIT].add(max(0.0, trace.received - trace.sent))
+        h[QUEUE].add(trace.started - trace.received)
+        h[HANDLER].add(now - trace.started)
+        total = now - trace.sent
+        h[TOTAL].add(max(0.0, total))
+
+        if self.slow and total > self.slow and self.log is not None:
+            self.log.warning("Slow message %016x on %s: %.3fs total, "
+                    "%.3fs transit, %.3fs queued, %.3fs in handlers",
+                    trace.trace_id, topic, total,
+                    trace.received - trace.sent,
+                    trace.started - trace.received, now - trace.started)
+
+    def summary(self, quantiles=(0.5, 0.9, 0.99)):
+        """\
+        Return stage -> (count, mean, {quantile: seconds}).
+        """
+        return dict((stage, (h.count, h.mean,
+                dict((q, h.percentile(q)) for q in quantiles)))
+            for stage, h in self.histograms.items())
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -
+#
+# This file is part of culexx released under the MIT license.
+# See the NOTICE for more information.
+
+from __future__ import print_function
+
+import heapq
+import os
+import struct
+import sys
+import time
+
+from .ring import RingMessage
+
+SUFFIX = ".cxt"
+
+
+class TrafficRecorder(object):
+    """\
+    Appends the messages a client receives to segment files of about
+    ``segment_size`` bytes, named ``<name>-<n>.cxt`` in ``directory``.
+
+    A segment starts with ``MAGIC`` and holds one record per message: the
+    receive time, the topic and payload lengths and the QoS and retain
+    flags, followed by the topic and the payload. Writes are buffered and
+    only reach the file on ``flush``, a segment cut short by a crash reads
+    up to its last complete record.
+    """
+
+    MAGIC = b"CXTRAF1\n"
+    RECORD = struct.Struct(">dHIB")
+
+    def __init__(self, directory, name=None, segment_size=64 * 1024 * 1024,
+            buffer_size=256 * 1024):
+        self.directory = directory
+        self.name = name or "traffic-%s" % os.getpid()
+        self.segment_size = segment_size
+        self.buffer_size = buffer_size
+        self.segment = 0
+        self.file = None
+        self.written = 0
+        self.count = 0
+
+    def segment_path(self, n):
+        return os.path.join(self.directory, "%s-%06d%s" % (self.name, n,
+            SUFFIX))
+
+    def open_segment(self):
+        if self.file is not None:
+            self.file.close()
+        self.segment += 1
+        path = self.segment_path(self.segment)
+        while os.path.exists(path):
+            self.segment += 1
+            path = self.segment_path(self.segment)
+        self.file = open(path, "wb", self.buffer_size)
+        self.file.write(self.MAGIC)
+        self.written = len(self.MAGIC)
+
+    def record(self, msg, received=None):
+        self.write(received or time.time(), msg.topic, msg.payload, msg.qos,
+                msg.retain)
+
+    def write(self, received, topic, payload, qos=0, retain=False):
+        if not isinstance(topic, bytes):
+            topic = topic.encode("utf-8")
+        if not isinstance(payload, bytes):
+            payload = payload.encode("utf-8")
+        flags = (qos or 0) | (retain and 4 or 0)
+        data = self.RECORD.pack(received, len(topic), len(payload), flags) \
+                + topic + payload
+
+        if self.file is None or (self.written + len(data) >
+                self.segment_size and self.written > len(self.MAGIC)):
+            self.open_segment()
+        self.file.write(data)
+        self.written += len(data)
+        self.count += 1
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_segment(path):
+    """\
+    Yield (receive time, topic, payload, qos, retain) for the records of
+    the segment at ``path``.
+    """
+    record = TrafficRecorder.RECORD
+    with open(path, "rb") as f:
+        if f.read(len(TrafficRecorder.MAGIC)) != TrafficRecorder.MAGIC:
+            raise ValueError("%s is not a traffic segment" % path)
+        while True:
+            header = f.read(record.size)
+            if len(header) < record.size:
+                return
+            received, topic_len, payload_len, flags = record.unpack(header)
+            topic = f.read(topic_len)
+            payload = f.read(payload_len)
+            if len(topic) < topic_len or len(payload) < payload_len:
+                return
+            yield (received, topic.decode("utf-8"), payload, flags & 3,
+                    bool(flags & 4))
+
+
+def segment_paths(paths):
+    """\
+    Expand the directories in ``paths`` to the segments they contain.
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(sorted(os.path.join(path, name)
+                for name in os.listdir(path) if name.endswith(SUFFIX)))
+        else:
+            found.append(path)
+    return found
+
+
+def read(paths):
+    """\
+    Yield the records of every segment in ``paths`` in receive order. The
+    segments of one recorder follow each other, those of several workers
+    are interleaved.
+    """
+    recorders = {}
+    for path in segment_paths(paths):
+        name = os.path.basename(path).rsplit("-", 1)[0]
+        recorders.setdefault(name, []).append(path)
+
+    def chain(paths):
+        for path in sorted(paths):
+            for rec in read_segment(path):
+                yield rec
+
+    streams = [chain(p) for p in recorders.values()]
+    if len(streams) == 1:
+        return streams[0]
+    return heapq.merge(*streams)
+
+
+def handler_target(mosq):
+    """\
+    Replay through the topic handlers of ``mosq``.
+    """
+    handle_topic = mosq.topic_mapper.handle_topic
+
+    def deliver(received, topic, payload, qos, retain):
+        handle_topic(topic, payload)
+    return deliver
+
+
+def dispatch_target(mosq):
+    """\
+    Replay through ``SignalMapper.dispatch`` of ``mosq``, like messages
+    coming from the broker.
+    """
+    dispatch = mosq.signal_mapper.dispatch
+
+    def deliver(received, topic, payload, qos, retain):
+        dispatch(None, None, RingMessage(topic, payload, qos, retain,
+            received), received)
+    return deliver
+
+
+def publish_target(client):
+    """\
+    Republish to the recorded topics with the paho ``client``, which must
+    be connected and have its network loop running.
+    """
+    def deliver(received, topic, payload, qos, retain):
+        client.publish(topic, payload, qos, retain)
+    return deliver
+
+
+class Replayer(object):
+    """\
+    Feeds recorded traffic to ``deliver`` keeping the gaps between messages
+    divided by ``speed``, or as fast as possible when ``speed`` is 0.
+    """
+
+    def __init__(self, paths, speed=1.0):
+        self.paths = paths
+        self.speed = speed
+        self.count = 0
+        self.elapsed = 0.0
+        self.max_lag = 0.0
+
+    def run(self, deliver, limit=None):
+        start = time.time()
+        first = None
+        for rec in read(self.paths):
+            if limit is not None and self.count >= limit:
+                break
+            if self.speed:
+                if first is None:
+                    first = rec[0]
+                due = start + (rec[0] - first) / self.speed
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                elif -delay > self.max_lag:
+                    self.max_lag = -delay
+            deliver(*rec)
+            self.count += 1
+        self.elapsed = time.time() - start
+        return self.count
+
+    def summary(self):
+        rate = self.count / self.elapsed if self.elapsed else 0.0
+        return "Replayed %d messages in %.3fs (%.0f/s), at most %.3fs " \
+                "behind schedule" % (self.count, self.elapsed, rate,
+                        self.max_lag)
+
+
+def describe(paths):
+    count = size = 0
+    first = last = None
+    topics = {}
+    for received, topic, payload, qos, retain in read(paths):
+        count += 1
+        size += len(payload)
+        if first is None:
+            first = received
+        last = received
+        topics[topic] = topics.get(topic, 0) + 1
+    print("%d messages, %d payload bytes" % (count, size))
+    if count:
+        span = last - first
+        print("from %s to %s (%.1fs, %.1f messages/s)" % (
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(first)),
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(last)),
+            span, count / span if span else 0.0))
+        for topic, n in sorted(topics.items(), key=lambda t: -t[1])[:20]:
+            print("  %8d  %s" % (n, topic))
+
+
+def main(args=None):
+    import argparse
+    from . import util
+
+    parser = argparse.ArgumentParser(prog="python -m culexx.traffic",
+            description="Describe or replay recorded traffic.")
+    parser.add_argument("paths", nargs="+", metavar="PATH",
+            help="segment files or directories of segments")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--app", metavar="MODULE:VARIABLE",
+            help="replay through the handlers of this application")
+    target.add_argument("--broker", metavar="HOST:PORT",
+            help="republish to this broker")
+    parser.add_argument("--speed", type=float, default=1.0,
+            help="replay this many times faster than recorded, 0 for as "
+                "fast as possible")
+    parser.add_argument("--dispatch", action="store_true",
+            help="replay through the whole dispatch path of --app, "
+                "metrics and flight recorder included")
+    parser.add_argument("-n", "--limit", type=int)
+    opts = parser.parse_args(args)
+
+    if opts.app is None and opts.broker is None:
+        describe(opts.paths)
+        return
+
+    replayer = Replayer(opts.paths, opts.speed)
+    if opts.app is not None:
+        sys.path.insert(0, util.getcwd())
+        mosq = util.import_app(opts.app)
+        deliver = dispatch_target(mosq) if opts.dispatch \
+                else handler_target(mosq)
+        replayer.run(deliver, opts.limit)
+    else:
+        import paho.mqtt.client as mqtt
+        host, _, port = opts.broker.rpartition(":")
+        client = mqtt.Client()
+        client.connect(host or "127.0.0.1", int(port))
+        client.loop_start()
+        try:
+            replayer.run(publish_target(client), opts.limit)
+        finally:
+            client.disconnect()
+            client.loop_stop()
+    print(replayer.summary())
+
+
+if __name__ == "__main__":
+    main()
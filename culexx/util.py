@@ -1,18 +1,21 @@
 import fcntl
-import io
 import os
-import pkg_resources
 import random
 import resource
-import socket
 import sys
-import textwrap
 import time
-import traceback
-import inspect
 import errno
+import marshal
+import numbers
+import struct
 from importlib import import_module
 
+try:
+    from importlib.util import MAGIC_NUMBER
+except ImportError: # python 2
+    import imp
+    MAGIC_NUMBER = imp.get_magic()
+
 from errors import *
 
 DEV_NULL = getattr(os, 'devnull', '/dev/null')
@@ -65,7 +68,7 @@ def import_app(module):
     return app
 
 def load_class(uri):
-    if inspect.isclass(uri):
+    if isinstance(uri, type):
         return uri
 
     components = uri.split('.')
@@ -74,6 +77,7 @@ def load_class(uri):
     try:
         mod = import_module('.'.join(components))
     except:
+        import traceback
         exc = traceback.format_exc()
         raise RuntimeError(
                 "class uri %r invalid or not found: \n\n[%s]" %
@@ -99,6 +103,244 @@ def getcwd():
         cwd = os.getcwd()
     return cwd
 
+class LazyModule(object):
+    """\
+    Stands in for a module that is only imported on first attribute
+    access, keeping heavy dependencies off the import path of commands
+    that never use them.
+    """
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__["_module"] = import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return "<lazy module %r>" % self._name
+
+# file name -> (stamp, code)
+_compiled_files = {}
+# not .pyc, the file is only ever read back by compile_file
+CACHE_SUFFIX = ".culexx-cache"
+
+def file_stamp(filename):
+    st = os.stat(filename)
+    return (getattr(st, "st_mtime_ns", st.st_mtime), st.st_size)
+
+def compile_file(filename, stamp=None, cache=False):
+    """\
+    Compile a python file, reusing the code object from memory, or from
+    ``<filename>.culexx-cache`` when ``cache`` is set, as long as the
+    file's mtime and size match ``stamp``. The cache file isn't written
+    when ``sys.dont_write_bytecode`` is set.
+    """
+    stamp = stamp or file_stamp(filename)
+    cached = _compiled_files.get(filename)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    header = MAGIC_NUMBER + struct.pack("<dQ", float(stamp[0]), stamp[1])
+    cache_file = filename + CACHE_SUFFIX
+    code = None
+
+    if cache:
+        try:
+            with open(cache_file, "rb") as f:
+                data = f.read()
+            if data[:len(header)] == header:
+                code = marshal.loads(data[len(header):])
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            code = None
+
+    if code is None:
+        with open(filename, "rb") as f:
+            code = compile(f.read(), filename, "exec")
+        if cache and not sys.dont_write_bytecode:
+            tmp = "%s.%s" % (cache_file, os.getpid())
+            try:
+                with open(tmp, "wb") as f:
+                    f.write(header + marshal.dumps(code))
+                os.rename(tmp, cache_file)
+            except (IOError, OSError):
+                # the directory may not be writable, that's fine
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+
+    _compiled_files[filename] = (stamp, code)
+    return code
+
+def check_is_writeable(path):
+    try:
+        f = open(path, 'a')
+    except IOError as e:
+        raise RuntimeError("Error: '%s' isn't writable [%r]" % (path, e))
+    f.close()
+
+def diagnostics_path(directory, kind, suffix):
+    """\
+    Return a file name for a diagnostics dump of this process, in the
+    temporary directory when ``directory`` is None.
+    """
+    if directory is None:
+        import tempfile
+        directory = tempfile.gettempdir()
+    return os.path.join(directory, "culexx-%s-%s-%d.%s"
+            % (kind, os.getpid(), int(time.time() * 1000), suffix))
+
+def payload_bytes(payload):
+    """\
+    Return ``payload`` as the bytes paho would send for it.
+    """
+    if payload is None:
+        return b""
+    if isinstance(payload, bytes):
+        return payload
+    if isinstance(payload, numbers.Number):
+        return str(payload).encode("ascii")
+    return payload.encode("utf-8")
+
+def set_non_blocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+
+def close_on_exec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    flags |= fcntl.FD_CLOEXEC
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags)
+
+def set_owner_process(uid, gid):
+    """ set user and group of workers processes """
+    if gid and gid != os.getgid():
+        # versions of python < 2.6.2 don't manage unsigned int for
+        # groups like on osx or fedora
+        os.setgid(abs(gid) & 0x7FFFFFFF)
+    if uid and uid != os.getuid():
+        os.setuid(uid)
+
+def parse_cpu_list(spec):
+    """\
+    Parse a CPU list in the format of taskset and cpusets, e.g.
+    ``0-3,8,10-11``, into a sorted list of CPU numbers.
+    """
+    cpus = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            low, high = part.split("-", 1)
+            cpus.update(range(int(low), int(high) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+# CPUs in the cpu_set_t of glibc
+CPU_SETSIZE = 1024
+
+_libc = None
+
+def _affinity_libc():
+    """\
+    The libc to call sched_{get,set}affinity in, on Pythons without
+    ``os.sched_setaffinity``. None when it doesn't have them.
+    """
+    global _libc
+    if _libc is None:
+        _libc = False
+        try:
+            import ctypes
+            import ctypes.util
+            name = ctypes.util.find_library("c")
+            if name:
+                libc = ctypes.CDLL(name, use_errno=True)
+                if hasattr(libc, "sched_setaffinity") and \
+                        hasattr(libc, "sched_getaffinity"):
+                    _libc = libc
+        except (ImportError, OSError):
+            pass
+    return _libc or None
+
+def _cpu_mask():
+    import ctypes
+    bits = ctypes.sizeof(ctypes.c_ulong) * 8
+    return (ctypes.c_ulong * (CPU_SETSIZE // bits))(), bits
+
+def get_cpu_affinity():
+    """\
+    Return the CPUs the calling process may run on, or None when the
+    platform can't tell.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    libc = _affinity_libc()
+    if libc is None:
+        return None
+    import ctypes
+    mask, bits = _cpu_mask()
+    if libc.sched_getaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)):
+        raise OSError(ctypes.get_errno(), "sched_getaffinity failed")
+    return [cpu for cpu in range(CPU_SETSIZE)
+            if mask[cpu // bits] & (1 << (cpu % bits))]
+
+def available_cpus():
+    cpus = get_cpu_affinity()
+    if cpus:
+        return cpus
+    try:
+        import multiprocessing
+        return list(range(multiprocessing.cpu_count()))
+    except NotImplementedError:
+        return [0]
+
+def set_cpu_affinity(cpus):
+    """\
+    Pin the calling process to ``cpus``. Returns False when the platform
+    doesn't support it.
+    """
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+        return True
+    libc = _affinity_libc()
+    if libc is None:
+        return False
+    import ctypes
+    mask, bits = _cpu_mask()
+    for cpu in cpus:
+        if not 0 <= cpu < CPU_SETSIZE:
+            raise ValueError("invalid CPU %r" % cpu)
+        mask[cpu // bits] |= 1 << (cpu % bits)
+    if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)):
+        raise OSError(ctypes.get_errno(), "sched_setaffinity failed")
+    return True
+
+def get_rss():
+    """\
+    Return the resident and the shared memory of this process in bytes.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            fields = f.read().split()
+        pagesize = resource.getpagesize()
+        return int(fields[1]) * pagesize, int(fields[2]) * pagesize
+    except (IOError, OSError, IndexError, ValueError):
+        # ru_maxrss is the peak in KiB and nothing is known as shared
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, 0
+
+def seed():
+    try:
+        random.seed(os.urandom(64))
+    except NotImplementedError:
+        random.seed('%s.%s' % (time.time(), os.getpid()))
+
 def perform_fork():
     try: 
         if os.fork(): # parent
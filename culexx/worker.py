@@ -0,0 +1,611 @@
+# -*- coding: utf-8 -
+#
+# This file is part of culexx released under the MIT license.
+# See the NOTICE for more information.
+
+import mmap
+import os
+import random
+import signal
+import struct
+import sys
+import time
+
+try:
+    import queue
+except ImportError: # python 2
+    import Queue as queue
+
+from . import util
+from .archive import Archive
+from .memprof import AllocationTracker, structure_sizes
+from .metrics import Metrics
+from .profiler import SamplingProfiler, handler_codes
+from .recorder import FlightRecorder
+from .traffic import TrafficRecorder
+
+
+class WorkerStatus(object):
+    """\
+    A block of anonymous shared memory the worker reports its state in.
+
+    It is allocated by the arbiter before forking so that both processes
+    map the same page; the worker writes, the arbiter only reads, except
+    for the requests it leaves in ``profile`` and ``memory``. Every field is an
+    aligned 8 byte slot so a reader never sees a torn value.
+    """
+
+    BOOTING = 0
+    RUNNING = 1
+    DRAINING = 2
+
+    FIELDS = (
+        ("heartbeat", "d"),
+        ("latency", "d"),
+        ("backlog", "Q"),
+        ("processed", "Q"),
+        ("state", "Q"),
+        ("startup", "d"),
+        ("rss", "Q"),
+        ("shared", "Q"),
+        ("recycle", "Q"),
+        ("profile", "d"),
+        ("memory", "Q"),
+    )
+
+    def __init__(self):
+        self.offsets = {}
+        for i, (name, fmt) in enumerate(self.FIELDS):
+            self.offsets[name] = (i * 8, "=" + fmt)
+        self.buf = mmap.mmap(-1, mmap.PAGESIZE)
+
+    def get(self, name):
+        offset, fmt = self.offsets[name]
+        return struct.unpack_from(fmt, self.buf, offset)[0]
+
+    def set(self, name, value):
+        offset, fmt = self.offsets[name]
+        struct.pack_into(fmt, self.buf, offset, value)
+
+    def update(self, **kwargs):
+        for name, value in kwargs.items():
+            self.set(name, value)
+
+    def read(self):
+        return dict((name, self.get(name)) for name, _ in self.FIELDS)
+
+    def close(self):
+        self.buf.close()
+
+
+class Worker(object):
+
+    SIGNALS = [getattr(signal, "SIG%s" % x) \
+            for x in "HUP QUIT INT TERM USR1 USR2 TTIN CHLD".split()]
+
+    # weight of the newest sample in the handler latency average
+    LATENCY_DECAY = 0.1
+
+    # how often the status block is refreshed while messages flow
+    NOTIFY_INTERVAL = 0.5
+
+    # how long a draining worker waits for messages still in flight
+    DRAIN_SETTLE = 1.0
+
+    # least time between two flight recorder dumps caused by handler errors
+    DUMP_INTERVAL = 60
+
+    def __init__(self, age, ppid, app, cfg, log, status):
+        self.age = age
+        self.pid = "[booting]"
+        self.ppid = ppid
+        self.app = app
+        self.cfg = cfg
+        self.log = log
+        self.status = status
+        self.booted = False
+        self.alive = True
+
+        # arbiter side bookkeeping
+        self.draining = False
+        self.drain_started = None
+        self.reported = False
+        self.replacement = None
+        self.slot = 0
+        self.cpus = None
+        self.ring = None
+        self.metrics_buf = None
+        self.profiler = None
+        self.memory = None
+        self.spawned = time.time()
+
+        self.queue = queue.Queue()
+        self.processed = 0
+        self.latency = 0.0
+        self.last_processed = 0
+        self.acked = 0
+        self.last_notify = 0
+        self.reload_pending = False
+        self.reopen_pending = False
+        self.dump_pending = False
+        self.last_dump = 0
+        # (max_messages, max_messages_jitter) the limit was drawn for
+        self.messages_limit = None
+        self.init_limits()
+
+    def init_limits(self):
+        self.timeout = self.cfg.timeout / 2.0
+        # the jitter is drawn once, a reload keeps it unless the limit
+        # itself changes
+        limit = (self.cfg.max_messages, self.cfg.max_messages_jitter)
+        if limit != self.messages_limit:
+            self.messages_limit = limit
+            self.max_messages = self.cfg.max_messages
+            if self.max_messages > 0:
+                jitter = random.randint(0, self.cfg.max_messages_jitter)
+                self.max_messages += jitter
+        self.max_rss = self.cfg.max_rss * 1024 * 1024
+
+    def __str__(self):
+        return "<Worker %s>" % self.pid
+
+    def notify(self, force=False):
+        """\
+        Refresh the status block read by the arbiter. If the worker
+        doesn't call this within ``cfg.timeout`` seconds it is killed.
+        """
+        now = time.time()
+        if not force and now - self.last_notify < self.NOTIFY_INTERVAL:
+            return
+        self.last_notify = now
+
+        if self.reopen_pending:
+            self.reopen_pending = False
+            self.log.reopen_files()
+        else:
+            self.log.flush_files()
+
+        if self.dump_pending:
+            self.dump_pending = False
+            self.dump_recorder("signal")
+
+        profile = self.status.get("profile")
+        if profile:
+            self.status.set("profile", 0)
+            self.start_profiler(profile)
+
+        if self.status.get("memory"):
+            self.status.set("memory", 0)
+            self.report_memory()
+        elif self.memory is not None and self.cfg.memory_profile_interval \
+                and now - self.memory.last_time >= \
+                    self.cfg.memory_profile_interval:
+            self.report_memory()
+
+        rss, shared = util.get_rss()
+        if self.ring is not None:
+            backlog = self.ring.pending()
+        else:
+            backlog = self.queue.qsize()
+        # the average only moves when messages are handled, let it fade
+        # while idle so an old burst doesn't hold off scaling down
+        if not backlog and self.processed == self.last_processed:
+            self.latency -= self.latency * self.LATENCY_DECAY
+        self.last_processed = self.processed
+        self.status.update(heartbeat=now,
+                backlog=backlog,
+                processed=self.processed,
+                latency=self.latency,
+                rss=rss, shared=shared)
+
+        mosq = getattr(self, "mosq", None)
+        if mosq is not None and mosq.traffic is not None:
+            mosq.traffic.flush()
+        if mosq is not None and mosq.rpc is not None:
+            mosq.rpc.sweep(now)
+
+        if self.metrics_buf is not None and mosq is not None:
+            if not self.metrics_buf.write(mosq.metrics.snapshot()) and \
+                    self.metrics_buf.overflows == 1:
+                self.log.warning("Metrics snapshot of %s doesn't fit in "
+                        "%d bytes, the arbiter keeps the last one",
+                        self, self.metrics_buf.size)
+
+        if self.max_rss and rss > self.max_rss:
+            self.request_recycle("rss %d KiB" % (rss // 1024))
+
+    def request_recycle(self, reason):
+        """\
+        Ask the arbiter for a replacement. The worker keeps handling
+        messages until the replacement is subscribed and it is told to
+        drain.
+        """
+        if self.status.get("recycle"):
+            return
+        self.log.info("Worker requests recycling (pid: %s): %s",
+                self.pid, reason)
+        self.status.set("recycle", 1)
+
+    def init_process(self):
+        """\
+        Called in the child right after the fork. Loads the application,
+        connects to the broker and enters the dispatch loop.
+        """
+        # set enviroment' variables
+        if self.cfg.env:
+            for k, v in self.cfg.env.items():
+                os.environ[k] = v
+
+        os.umask(self.cfg.umask)
+        util.set_owner_process(self.cfg.uid, self.cfg.gid)
+
+        # the log listener threads didn't survive the fork, and the
+        # handlers they used can't be closed safely
+        self.log.after_fork()
+        self.log.setup(self.cfg)
+
+        # pinned once the worker's own handlers are set up, so the message
+        # doesn't go through the ones inherited from the arbiter
+        if self.cpus:
+            if util.set_cpu_affinity(self.cpus):
+                self.log.info("Worker %s pinned to CPUs %s", self.pid,
+                        ",".join(str(c) for c in self.cpus))
+            else:
+                self.log.warning("CPU affinity is not supported here")
+
+        # reseed the random number generator
+        util.seed()
+
+        self.init_signals()
+        self.status.update(state=WorkerStatus.BOOTING)
+        self.notify(force=True)
+
+        self.mosq = self.app.mosq_app
+
+        # records of a preloaded application belong to the master
+        size = self.cfg.flight_recorder_size
+        self.mosq.recorder = FlightRecorder(size) if size else None
+        self.mosq.metrics = Metrics() if self.metrics_buf is not None else None
+        self.mosq.tracer = None
+        if self.cfg.trace_sample_rate:
+            from .tracing import Tracer
+            self.mosq.tracer = Tracer(self.cfg.trace_sample_rate,
+                    self.cfg.trace_slow, self.log)
+            if self.mosq.metrics is not None:
+                self.mosq.metrics.stages = self.mosq.tracer.histograms
+
+        self.mosq.traffic = None
+        if self.cfg.traffic_dir:
+            self.mosq.traffic = TrafficRecorder(self.cfg.traffic_dir,
+                    "traffic-%s" % self.pid, self.cfg.traffic_segment_size)
+
+        self.mosq.archive = None
+        if self.cfg.archive_dir:
+            self.mosq.archive = Archive(self.cfg.archive_dir,
+                    "archive-%s" % self.pid,
+                    segment_size=self.cfg.archive_segment_size,
+                    retention_bytes=self.cfg.archive_retention_bytes,
+                    retention_age=self.cfg.archive_retention_age).start()
+
+        if self.cfg.memory_profile:
+            self.start_memory_tracing()
+        if self.cfg.topic_handlers:
+            self.mosq.update_topics(self.app.app_topics())
+        self.booted = True
+        try:
+            self.run()
+        finally:
+            if self.mosq.traffic is not None:
+                self.mosq.traffic.close()
+            if self.mosq.archive is not None:
+                self.mosq.archive.close()
+
+    def init_signals(self):
+        # reset signaling
+        [signal.signal(s, signal.SIG_DFL) for s in self.SIGNALS]
+        # init new signaling
+        signal.signal(signal.SIGQUIT, self.handle_quit)
+        signal.signal(signal.SIGTERM, self.handle_exit)
+        signal.signal(signal.SIGINT, self.handle_quit)
+        signal.signal(signal.SIGHUP, self.handle_hup)
+        signal.signal(signal.SIGUSR1, self.handle_usr1)
+        signal.signal(signal.SIGUSR2, self.handle_usr2)
+        signal.signal(signal.SIGTTIN, self.handle_ttin)
+
+        # Don't let the signals handled in the loop interrupt system calls
+        signal.siginterrupt(signal.SIGTERM, False)
+        signal.siginterrupt(signal.SIGQUIT, False)
+        signal.siginterrupt(signal.SIGHUP, False)
+        signal.siginterrupt(signal.SIGUSR1, False)
+        signal.siginterrupt(signal.SIGUSR2, False)
+        signal.siginterrupt(signal.SIGTTIN, False)
+
+    def run(self):
+        if self.ring is not None:
+            return self.run_ring()
+
+        mosq = self.mosq
+
+        # every worker keeps its own session but they share the load of
+        # the topics through a shared subscription
+        mosq.share_group = self.cfg.proc_name
+        mosq.session_suffix = "-w%s" % self.age
+        # streams see every message in one worker only
+        mosq.stream_owner = self.slot == 0
+
+        # messages are queued by the network thread and dispatched from
+        # here, so the queue length is the backlog reported to the arbiter
+        self.dispatch = mosq.signal_mapper.dispatch
+        mosq.signal_mapper.on_message = self.enqueue
+        # a full consumer pauses this loop, the arbiter must still see it
+        # alive
+        mosq.on_pause = self.notify
+        mosq.signal_mapper.sig_on_connect.connect(self.handle_connect,
+                sender=mosq, weak=False)
+        mosq.signal_mapper.sig_on_subscribe.connect(self.handle_subscribe,
+                sender=mosq, weak=False)
+
+        mosq.connect(loop_forever=False)
+
+        while self.alive:
+            self.notify()
+
+            if self.ppid != os.getppid():
+                self.log.info("Parent changed, shutting down: %s", self)
+                break
+
+            if self.reload_pending:
+                self.reload()
+
+            self.process(self.timeout)
+
+        self.drain()
+
+    def run_ring(self):
+        """\
+        Consume the shared memory ring the arbiter fans messages out to.
+        The worker holds no broker connection of its own.
+        """
+        mosq = self.mosq
+
+        # the arbiter set up its own subscription on the same application
+        # object before forking, undo it here
+        mosq.signal_mapper.__dict__.pop("on_message", None)
+        mosq._mqtt_client = None
+        mosq._setup = False
+        mosq.can_publish = False
+        # the arbiter sees every message and runs the streams
+        mosq.stream_owner = False
+        self.dispatch = mosq.signal_mapper.dispatch
+        mosq.on_pause = self.notify
+
+        pid = os.getpid()
+        ring = self.ring
+        self.ready()
+
+        while self.alive:
+            self.notify()
+
+            if self.ppid != os.getppid():
+                self.log.info("Parent changed, shutting down: %s", self)
+                break
+
+            if self.reload_pending:
+                self.reload()
+
+            # a replacement waits until the worker it replaces has exited
+            if ring.consumer != pid:
+                time.sleep(0.1)
+                continue
+
+            msg = ring.get()
+            if msg is None:
+                ring.wait(min(self.timeout, 1.0))
+                continue
+            self.handle_message(mosq, None, msg, msg.timestamp)
+            ring.commit()
+
+        self.drain_ring()
+
+    def drain_ring(self):
+        """\
+        Handle the messages left in the ring before exiting, until it is
+        empty or the graceful timeout is over. The arbiter stops writing
+        to it once it stops itself.
+        """
+        self.status.update(state=WorkerStatus.DRAINING)
+        self.notify(force=True)
+
+        ring = self.ring
+        if ring.consumer != os.getpid():
+            return
+        limit = time.time() + self.cfg.graceful_timeout
+        while time.time() < limit:
+            msg = ring.get()
+            if msg is None:
+                break
+            self.handle_message(self.mosq, None, msg, msg.timestamp)
+            ring.commit()
+            self.notify()
+
+        self.notify(force=True)
+
+    def enqueue(self, mosq, obj, msg):
+        # responses are resolved on the network thread, a handler may be
+        # waiting for one
+        rpc = self.mosq.rpc
+        if rpc is not None and rpc.handle_reply(msg):
+            return
+        self.queue.put((mosq, obj, msg, time.time()))
+
+    def process(self, timeout):
+        try:
+            mosq, obj, msg, received = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+        self.handle_message(mosq, obj, msg, received)
+
+    def handle_message(self, mosq, obj, msg, received=None):
+        start = time.time()
+        try:
+            self.dispatch(mosq, obj, msg, received)
+        except Exception:
+            self.log.exception("Error handling message on %s", msg.topic)
+            if start - self.last_dump >= self.DUMP_INTERVAL:
+                self.last_dump = start
+                self.dump_recorder("handler error")
+        self.processed += 1
+        self.latency += (time.time() - start - self.latency) * self.LATENCY_DECAY
+
+        if self.max_messages and self.processed >= self.max_messages:
+            self.request_recycle("%d messages" % self.processed)
+
+    def drain(self):
+        """\
+        Stop taking new messages and finish the ones already received.
+
+        The worker unsubscribes first so the broker routes the shared
+        subscription to the remaining workers, then keeps dispatching until
+        nothing has arrived for ``DRAIN_SETTLE`` seconds or the graceful
+        timeout is over.
+        """
+        self.status.update(state=WorkerStatus.DRAINING)
+        self.notify(force=True)
+
+        for topic in list(self.mosq.topics):
+            self.mosq.unsubscribe(topic)
+
+        limit = time.time() + self.cfg.graceful_timeout
+        while time.time() < limit:
+            try:
+                mosq, obj, msg, received = \
+                        self.queue.get(timeout=self.DRAIN_SETTLE)
+            except queue.Empty:
+                break
+            self.handle_message(mosq, obj, msg, received)
+            self.notify()
+
+        self.notify(force=True)
+        self.mosq.disconnect()
+
+    def ready(self):
+        if self.status.get("state") == WorkerStatus.RUNNING:
+            return
+        rss, shared = util.get_rss()
+        self.status.update(startup=time.time() - self.spawned,
+                rss=rss, shared=shared)
+        self.status.update(state=WorkerStatus.RUNNING)
+
+    def handle_connect(self, sender, **kwargs):
+        if not self.alive:
+            return
+        self.acked = 0
+        if not sender.topics:
+            self.ready()
+        sender.setup_subscriptions()
+
+    def handle_subscribe(self, sender, **kwargs):
+        self.acked += 1
+        if self.acked >= len(sender.topics):
+            self.ready()
+
+    def reload(self):
+        """\
+        Apply the settings changed in the config file, as told by the
+        arbiter. Settings that need a restart were already reverted.
+        """
+        self.reload_pending = False
+        try:
+            changed, _ = self.app.reread_config()
+        except BaseException:
+            self.log.exception("Failed to reload config file")
+            return
+        self.cfg = self.app.cfg
+        self.log.setup(self.cfg)
+        self.init_limits()
+        if "topic_handlers" in changed and self.ring is None:
+            self.mosq.update_topics(self.app.app_topics())
+
+    def dump_recorder(self, reason):
+        """\
+        Write the flight recorder of the application to the dump directory.
+        """
+        recorder = getattr(getattr(self, "mosq", None), "recorder", None)
+        if recorder is None or not len(recorder):
+            return
+        try:
+            path = recorder.dump_to_dir(self.cfg.diagnostics_dir, reason)
+        except (IOError, OSError) as e:
+            self.log.warning("Failed to dump the flight recorder: %s", e)
+            return
+        self.log.info("Dumped flight recorder to %s (%s)", path, reason)
+
+    def start_profiler(self, duration):
+        if self.profiler is not None and self.profiler.running():
+            self.log.info("Worker %s is already profiling", self.pid)
+            return
+        mosq = getattr(self, "mosq", None)
+        path = util.diagnostics_path(self.cfg.diagnostics_dir, "profile",
+                "folded")
+        self.profiler = SamplingProfiler(path, duration,
+                self.cfg.profile_interval,
+                handler_codes(mosq) if mosq is not None else None, self.log)
+        self.profiler.start()
+        self.log.info("Worker %s profiling for %ss", self.pid, duration)
+
+    def start_memory_tracing(self):
+        self.memory = AllocationTracker(self.cfg.memory_profile_frames,
+                self.cfg.memory_profile_sample)
+        self.memory.start()
+        self.mosq.memory = self.memory
+        self.log.info("Worker %s tracking memory growth", self.pid)
+
+    def report_memory(self):
+        """\
+        Write how memory grew, by topic handler, to the diagnostics
+        directory. The first request only starts tracing.
+        """
+        if self.memory is None:
+            self.start_memory_tracing()
+            return
+
+        mosq = getattr(self, "mosq", None)
+        sizes = structure_sizes(mosq) if mosq is not None else {}
+        if self.ring is not None:
+            sizes["dispatch ring"] = self.ring.pending()
+        else:
+            sizes["dispatch queue"] = self.queue.qsize()
+        report = self.memory.report(sizes)
+
+        path = util.diagnostics_path(self.cfg.diagnostics_dir, "memory",
+                "txt")
+        try:
+            with open(path, "w") as f:
+                f.write(report)
+        except (IOError, OSError) as e:
+            self.log.warning("Failed to write memory report: %s", e)
+            return
+        self.log.info("Wrote memory report to %s", path)
+
+    def handle_hup(self, sig, frame):
+        self.reload_pending = True
+
+    def handle_usr1(self, sig, frame):
+        # the files are reopened from the loop, not in the middle of a write
+        self.reopen_pending = True
+        self.last_notify = 0
+
+    def handle_usr2(self, sig, frame):
+        self.status.set("profile", self.cfg.profile_duration)
+        self.last_notify = 0
+
+    def handle_ttin(self, sig, frame):
+        self.dump_pending = True
+        self.last_notify = 0
+
+    def handle_quit(self, sig, frame):
+        self.alive = False
+
+    def handle_exit(self, sig, frame):
+        self.alive = False
+        sys.exit(0)
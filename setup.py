@@ -5,11 +5,16 @@ setup(name='culexx',
     description='MQTT micro library',
     url='http://github.com/tiabas/culexx',
     author='Kevin Mutyaba',
-    author_email='tiabasnk@gmail.com'
+    author_email='tiabasnk@gmail.com',
     packages=['culexx'],
     install_requires=[
       'paho-mqtt',
     ],
     test_suite='nose.collector',
     tests_require=['nose'],
-    zip_safe=False)
\ No newline at end of file
+    zip_safe=False,
+    entry_points="""
+    [console_scripts]
+    culexx=culexx.base:run
+    culexx-bench=culexx.bench:run
+    """)
\ No newline at end of file